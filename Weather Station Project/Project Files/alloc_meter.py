@@ -0,0 +1,40 @@
+"""
+Heap allocation meter for the central pico's hot paths (final_i2c.py). Copy this file to the
+central pico next to the firmware.
+
+gc.mem_alloc() is read when a measured run starts and when it stops, the difference is the
+number of heap bytes the run allocated. A collection during the run frees memory and usually
+turns the difference negative, such runs are only counted as interrupted. A run that allocates
+nothing reads 0 bytes.
+"""
+import gc
+import struct
+
+
+class AllocMeter:
+    """Bytes allocated by the last measured run and the most by any run, over start()/stop() pairs."""
+
+    def __init__(self):
+        self.start_alloc = 0
+        self.last = 0
+        self.peak = 0
+        # runs measured, and runs a collection interrupted
+        self.runs = 0
+        self.collections = 0
+
+    def start(self):
+        self.start_alloc = gc.mem_alloc()
+
+    def stop(self):
+        allocated = gc.mem_alloc() - self.start_alloc
+        if allocated < 0:
+            self.collections += 1
+            return
+        self.last = allocated
+        self.peak = max(self.peak, allocated)
+        self.runs += 1
+
+    # <IIII last, peak, runs, collections into buffer at offset, returns the offset after them
+    def pack_into(self, buffer, offset):
+        struct.pack_into("<IIII", buffer, offset, self.last, self.peak, self.runs, self.collections)
+        return offset + 16
@@ -0,0 +1,186 @@
+"""
+BME680 acquisition for both picos (final_i2c.py and finalperipheral_documented.py).
+Copy this file to each pico next to the firmware.
+
+The BME680_I2C driver starts a new forced-mode measurement for every property access, so
+reading .temperature, .pressure and .humidity costs three measurement cycles. BME680Burst
+programs oversampling, filter and heater once, then each measure() triggers one forced-mode
+measurement, awaits its conversion time without blocking other tasks, and decodes every
+channel, gas resistance included, from a single 15 byte burst read of the data registers.
+Compensation follows the Bosch reference code in the floating point form of the Adafruit driver.
+"""
+import struct
+import utime
+import uasyncio as asyncio
+
+_CHIP_ID = 0x61
+_REG_CHIP_ID = 0xD0
+_REG_SOFT_RESET = 0xE0
+_REG_COEFF_1 = 0x89
+_REG_COEFF_2 = 0xE1
+_REG_RES_HEAT_VAL = 0x00
+_REG_RES_HEAT_RANGE = 0x02
+_REG_RANGE_SW_ERR = 0x04
+_REG_RES_HEAT_0 = 0x5A
+_REG_GAS_WAIT_0 = 0x64
+_REG_CTRL_GAS_1 = 0x71
+_REG_CTRL_HUM = 0x72
+_REG_CTRL_MEAS = 0x74
+_REG_CONFIG = 0x75
+# meas_status_0 followed by the pressure, temperature, humidity and gas data registers
+_REG_FIELD_0 = 0x1D
+_FIELD_LENGTH = 15
+_NEW_DATA = 0x80
+_GAS_VALID = 0x20
+_HEAT_STAB = 0x10
+_RUN_GAS = 0x10
+_FORCED_MODE = 0x01
+
+# register codes of the oversampling factors and IIR filter sizes
+_OVERSAMPLING = {0: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+_FILTER_SIZES = {0: 0, 1: 1, 3: 2, 7: 3, 15: 4, 31: 5, 63: 6, 127: 7}
+# heater set point (about 320 C) and heating time (0x65: 37 * 4 = 148 ms), as the Adafruit driver uses
+_HEATER_RESISTANCE = 0x73
+_HEATER_WAIT = 0x65
+_HEATER_WAIT_MS = 148
+
+_GAS_RANGE_1 = (2147483647.0, 2147483647.0, 2147483647.0, 2147483647.0, 2147483647.0, 2126008810.0,
+                2147483647.0, 2130303777.0, 2147483647.0, 2147483647.0, 2143188679.0, 2136746228.0,
+                2147483647.0, 2126008810.0, 2147483647.0, 2147483647.0)
+_GAS_RANGE_2 = (4096000000.0, 2048000000.0, 1024000000.0, 512000000.0, 255744255.0, 127110228.0, 64000000.0,
+                32258064.0, 16016016.0, 8000000.0, 4000000.0, 2000000.0, 1000000.0, 500000.0, 250000.0, 125000.0)
+
+
+class BME680Burst:
+    """
+    One forced-mode measurement per measure() call.
+    Oversampling takes the factors 0 (channel skipped), 1, 2, 4, 8 or 16 and filter_size the IIR
+    filter coefficients 0, 1, 3, 7, 15, 31, 63 or 127. With gas=False the heater stays off, which
+    shortens a measurement by the heater's ~150 ms.
+    """
+
+    def __init__(self, i2c, address=0x77, temperature_oversample=8, pressure_oversample=4, humidity_oversample=2,
+                 filter_size=3, gas=True):
+        self.i2c = i2c
+        self.address = address
+        self.gas_enabled = gas
+        self._field = bytearray(_FIELD_LENGTH)
+        self._byte = bytearray(1)
+
+        self._write(_REG_SOFT_RESET, 0xB6)
+        # the reset takes 2 ms, nothing else runs this early so a blocking sleep is fine
+        utime.sleep_ms(5)
+        if self._read(_REG_CHIP_ID) != _CHIP_ID:
+            raise OSError("BME680 not found at address %#x" % address)
+        self._read_calibration()
+
+        self._ctrl_meas = (_OVERSAMPLING[temperature_oversample] << 5) | (_OVERSAMPLING[pressure_oversample] << 2)
+        self._write(_REG_CONFIG, _FILTER_SIZES[filter_size] << 2)
+        # ctrl_hum only takes effect with the next ctrl_meas write, which every measurement does
+        self._write(_REG_CTRL_HUM, _OVERSAMPLING[humidity_oversample])
+        if gas:
+            self._write(_REG_RES_HEAT_0, _HEATER_RESISTANCE)
+            self._write(_REG_GAS_WAIT_0, _HEATER_WAIT)
+        self._write(_REG_CTRL_GAS_1, _RUN_GAS if gas else 0x00)
+
+        # conversion time (Bosch: 1963 us per oversampling cycle plus fixed overheads), rounded up
+        cycles = temperature_oversample + pressure_oversample + humidity_oversample
+        self.measure_ms = (cycles * 1963 + 477 * 9 + 500 + 1000) // 1000 + 1 + (_HEATER_WAIT_MS if gas else 0)
+
+        # latest compensated values, gas resistance (ohm) is None while the heater is off or not stable
+        self.temperature = None
+        self.pressure = None
+        self.humidity = None
+        self.gas = None
+
+    def _read(self, register):
+        self.i2c.readfrom_mem_into(self.address, register, self._byte)
+        return self._byte[0]
+
+    def _write(self, register, value):
+        self._byte[0] = value
+        self.i2c.writeto_mem(self.address, register, self._byte)
+
+    def _read_calibration(self):
+        coeff = self.i2c.readfrom_mem(self.address, _REG_COEFF_1, 25) + self.i2c.readfrom_mem(self.address, _REG_COEFF_2, 16)
+        coeff = [float(i) for i in struct.unpack("<hbBHhbBhhbbHhhBBBHbbbBbHhbb", coeff[1:39])]
+        self._temp_calibration = [coeff[x] for x in (23, 0, 1)]
+        self._pressure_calibration = [coeff[x] for x in (3, 4, 5, 7, 8, 10, 9, 12, 13, 14)]
+        self._humidity_calibration = [coeff[x] for x in (17, 16, 18, 19, 20, 21, 22)]
+        self._gas_calibration = [coeff[x] for x in (25, 24, 26)]
+        # H1 and H2 share a nibble
+        self._humidity_calibration[1] *= 16
+        self._humidity_calibration[1] += self._humidity_calibration[0] % 16
+        self._humidity_calibration[0] /= 16
+        self._heat_range = (self._read(_REG_RES_HEAT_RANGE) & 0x30) / 16
+        self._heat_val = self._read(_REG_RES_HEAT_VAL)
+        self._sw_err = (self._read(_REG_RANGE_SW_ERR) & 0xF0) / 16
+
+    # one forced-mode measurement: (temperature C, pressure hPa, humidity %RH, gas resistance ohm or None)
+    async def measure(self):
+        self._write(_REG_CTRL_MEAS, self._ctrl_meas | _FORCED_MODE)
+        await asyncio.sleep_ms(self.measure_ms)
+        field = self._field
+        for _ in range(10):
+            self.i2c.readfrom_mem_into(self.address, _REG_FIELD_0, field)
+            if field[0] & _NEW_DATA:
+                break
+            await asyncio.sleep_ms(2)
+        else:
+            raise OSError("BME680 measurement timed out")
+        self._compensate(field)
+        return self.temperature, self.pressure, self.humidity, self.gas
+
+    def _compensate(self, field):
+        adc_pres = ((field[2] << 16) | (field[3] << 8) | field[4]) / 16
+        adc_temp = ((field[5] << 16) | (field[6] << 8) | field[7]) / 16
+        adc_hum = (field[8] << 8) | field[9]
+        adc_gas = ((field[13] << 8) | field[14]) >> 6
+        gas_range = field[14] & 0x0F
+
+        calibration = self._temp_calibration
+        var1 = (adc_temp / 8) - (calibration[0] * 2)
+        var2 = (var1 * calibration[1]) / 2048
+        var3 = ((var1 / 2) * (var1 / 2)) / 4096
+        var3 = (var3 * calibration[2] * 16) / 16384
+        t_fine = int(var2 + var3)
+        temp_scaled = ((t_fine * 5) + 128) / 256
+        self.temperature = temp_scaled / 100
+
+        calibration = self._pressure_calibration
+        var1 = (t_fine / 2) - 64000
+        var2 = ((var1 / 4) * (var1 / 4)) / 2048
+        var2 = (var2 * calibration[5]) / 4
+        var2 = var2 + (var1 * calibration[4] * 2)
+        var2 = (var2 / 4) + (calibration[3] * 65536)
+        var1 = ((((var1 / 4) * (var1 / 4)) / 8192) * (calibration[2] * 32) / 8) + ((calibration[1] * var1) / 2)
+        var1 = var1 / 262144
+        var1 = ((32768 + var1) * calibration[0]) / 32768
+        pressure = 1048576 - adc_pres
+        pressure = (pressure - (var2 / 4096)) * 3125
+        pressure = (pressure / var1) * 2
+        var1 = (calibration[8] * (((pressure / 8) * (pressure / 8)) / 8192)) / 4096
+        var2 = ((pressure / 4) * calibration[7]) / 8192
+        var3 = (((pressure / 256) ** 3) * calibration[9]) / 131072
+        pressure += (var1 + var2 + var3 + (calibration[6] * 128)) / 16
+        self.pressure = pressure / 100
+
+        calibration = self._humidity_calibration
+        var1 = (adc_hum - (calibration[0] * 16)) - ((temp_scaled * calibration[2]) / 200)
+        var2 = (calibration[1] * (((temp_scaled * calibration[3]) / 100)
+                                  + (((temp_scaled * ((temp_scaled * calibration[4]) / 100)) / 64) / 100) + 16384)) / 1024
+        var3 = var1 * var2
+        var4 = calibration[5] * 128
+        var4 = (var4 + ((temp_scaled * calibration[6]) / 100)) / 16
+        var5 = ((var3 / 16384) * (var3 / 16384)) / 1024
+        var6 = (var4 * var5) / 2
+        humidity = (((var3 + var6) / 1024) * 1000) / 4096 / 1000
+        self.humidity = min(max(humidity, 0), 100)
+
+        if not self.gas_enabled or (field[14] & (_GAS_VALID | _HEAT_STAB)) != (_GAS_VALID | _HEAT_STAB):
+            self.gas = None
+            return
+        var1 = ((1340 + (5 * self._sw_err)) * _GAS_RANGE_1[gas_range]) / 65536
+        var2 = ((adc_gas * 32768) - 16777216) + var1
+        var3 = (_GAS_RANGE_2[gas_range] * var1) / 512
+        self.gas = (var3 + (var2 / 2)) / var2
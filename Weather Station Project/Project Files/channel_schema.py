@@ -0,0 +1,110 @@
+"""
+Fixed-point wire format of every sensor channel, shared by both picos (final_i2c.py and
+finalperipheral_documented.py) and the GUI (final_gui_app.py). Copy this file to each pico next
+to the firmware.
+
+A channel's value v goes on the wire as the integer round((v - offset) * scale), clamped to the
+range of its 16 bit width (struct code h or H), so a value out of range saturates instead of
+wrapping around. Every payload carrying channel values (aggregations, time series, history
+buckets, stamped samples, the delta encoded series) packs and unpacks them through the Channel
+entries below, with precompiled Struct objects, so adding a channel is one more entry in
+CHANNELS. The history buckets and snapshot sections have fixed 2 byte slots, so widths other
+than h and H are rejected.
+
+SCHEMA_VERSION changes whenever an entry does. The central reports it with command 0x0B,
+<B version followed by one <BBIi (channel id, width code, scale, offset) per channel, and the
+GUI refuses to decode with a schema that differs from its own.
+"""
+import struct
+
+try:
+    from struct import Struct
+except ImportError:
+    class Struct:
+        """struct.Struct for MicroPython, whose struct module has none: the format is checked once."""
+
+        def __init__(self, fmt):
+            self.format = fmt
+            self.size = struct.calcsize(fmt)
+
+        def pack_into(self, buffer, offset, *values):
+            struct.pack_into(self.format, buffer, offset, *values)
+
+        def unpack_from(self, buffer, offset=0):
+            return struct.unpack_from(self.format, buffer, offset)
+
+        def unpack(self, data):
+            return struct.unpack(self.format, data)
+
+SCHEMA_VERSION = 1
+
+# smallest and largest wire integer of each width
+_WIDTH_RANGES = {'h': (-0x8000, 0x7FFF), 'H': (0, 0xFFFF)}
+
+
+class Channel:
+    """Wire format of one channel: value = wire / scale + offset."""
+
+    def __init__(self, channel_id, name, unit, scale, offset, width):
+        if width not in _WIDTH_RANGES:
+            raise ValueError("channel width must be h or H")
+        self.channel_id = channel_id
+        self.name = name
+        self.unit = unit
+        self.scale = scale
+        self.offset = offset
+        self.width = width
+        self.low, self.high = _WIDTH_RANGES[width]
+        self.value_struct = Struct("<" + width)
+        self.size = self.value_struct.size
+
+    # wire integer of value
+    def encode(self, value):
+        raw = int(round((value - self.offset) * self.scale))
+        return self.low if raw < self.low else self.high if raw > self.high else raw
+
+    def decode(self, raw):
+        return raw / self.scale + self.offset
+
+    # packs value into buffer at buffer_offset, returns the offset after it
+    def pack_into(self, buffer, buffer_offset, value):
+        self.value_struct.pack_into(buffer, buffer_offset, self.encode(value))
+        return buffer_offset + self.size
+
+    # packs an already encoded wire integer, returns the offset after it
+    def pack_raw_into(self, buffer, buffer_offset, raw):
+        self.value_struct.pack_into(buffer, buffer_offset, raw)
+        return buffer_offset + self.size
+
+    # the value at buffer_offset (a bytes-like object or memoryview, never sliced)
+    def unpack_from(self, buffer, buffer_offset=0):
+        return self.decode(self.value_struct.unpack_from(buffer, buffer_offset)[0])
+
+    # count consecutive values from buffer_offset
+    def unpack_many(self, buffer, buffer_offset, count):
+        return [self.unpack_from(buffer, buffer_offset + i * self.size) for i in range(count)]
+
+
+# channel ids are the indices, the order of every multi-channel payload. pressure keeps 0.01 hPa from 500 hPa up
+HUMIDITY = Channel(0x00, 'Humidity', '%', 100, 0, 'H')
+TEMPERATURE = Channel(0x01, 'Temperature', '°C', 100, 0, 'h')
+PRESSURE = Channel(0x02, 'Pressure', 'hPa', 100, 500, 'H')
+CHANNELS = (HUMIDITY, TEMPERATURE, PRESSURE)
+
+# bytes of one value of every channel, as in a stamped sample after its time stamp
+VALUES_SIZE = sum(channel.size for channel in CHANNELS)
+# stamped sample of the peripheral's sample characteristic: sequence number, ticks_ms, then every channel
+SAMPLE_STRUCT = Struct("<II" + "".join(channel.width for channel in CHANNELS))
+# one channel entry of the schema command (0x0B): channel id, width code, scale, offset
+SCHEMA_ENTRY_STRUCT = Struct("<BBIi")
+
+
+# packs the schema command's result into buffer at offset, returns the offset after it
+def pack_schema_into(buffer, offset):
+    buffer[offset] = SCHEMA_VERSION
+    offset += 1
+    for channel in CHANNELS:
+        SCHEMA_ENTRY_STRUCT.pack_into(buffer, offset, channel.channel_id, ord(channel.width), channel.scale,
+                                      channel.offset)
+        offset += SCHEMA_ENTRY_STRUCT.size
+    return offset
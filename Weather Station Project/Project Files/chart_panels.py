@@ -0,0 +1,255 @@
+"""
+Chart widgets of the GUI (final_gui_app.py) that are built once and updated in place.
+New data replaces the points of the existing series in one call, or the heights of the
+existing bars, so a refresh does not allocate charts, axes, views or figures and the window
+keeps a flat memory footprint however often it refreshes.
+Line charts only draw a decimated subset of their points (decimation.py) sized to their pixel
+width, recomputed when the chart is zoomed, panned or resized.
+"""
+import numpy as np
+from PyQt5.QtCore import Qt, QDateTime, QPointF
+from PyQt5.QtChart import QChart, QChartView, QLineSeries, QDateTimeAxis, QValueAxis
+from PyQt5.QtGui import QPainter
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QTableWidget, QTableWidgetItem, QPushButton
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from decimation import min_max_decimate
+
+
+class TimeSeriesPanel(QChartView):
+    """
+    One QLineSeries and value axis per variable, sharing a date-time x axis.
+    variables maps each name to a fixed (min, max) range of its axis, or to None to fit the
+    axis to the data on every update.
+    The full data is kept as numpy arrays and the series only get the decimated points of the
+    visible range. Drag a rubber band to zoom in, right click to zoom out, the arrow keys pan.
+    While the whole data range is visible new data widens the x axis, once zoomed or panned the
+    view stays where it is.
+    """
+
+    def __init__(self, title, variables, time_format='hh:mm:ss', parent=None):
+        chart = QChart()
+        chart.setTitle(title)
+        super().__init__(chart, parent)
+        self.setRenderHint(QPainter.Antialiasing)
+        self.setRubberBand(QChartView.HorizontalRubberBand)
+        self.ranges = variables
+        # (xs, ys) numpy arrays per variable, and whether the x axis follows the data range
+        self.data = {}
+        self.follow = True
+        # set while the panel moves the x axis itself, so only user zooms and pans stop following
+        self.updating = False
+
+        self.axis_x = QDateTimeAxis()
+        self.axis_x.setFormat(time_format)
+        self.axis_x.setTickCount(10)  #  number of ticks as needed
+        chart.addAxis(self.axis_x, Qt.AlignBottom)
+        self.axis_x.rangeChanged.connect(self.x_range_changed)
+
+        self.series = {}
+        self.axes_y = {}
+        for variable, y_range in variables.items():
+            series = QLineSeries()
+            series.setName(variable)
+            chart.addSeries(series)
+
+            axis_y = QValueAxis()
+            axis_y.setTitleText(variable)
+            if y_range is not None:
+                axis_y.setRange(*y_range)
+            chart.addAxis(axis_y, Qt.AlignLeft)
+            series.attachAxis(self.axis_x)
+            series.attachAxis(axis_y)
+            self.series[variable] = series
+            self.axes_y[variable] = axis_y
+
+    def set_title(self, title):
+        self.chart().setTitle(title)
+
+    # points: {variable: (epoch ms, values)} two sequences oldest first, variables left out keep their points
+    def update_points(self, points):
+        for variable, (xs, ys) in points.items():
+            xs = np.asarray(xs, dtype=float)
+            ys = np.asarray(ys, dtype=float)
+            self.data[variable] = (xs, ys)
+            if self.ranges[variable] is None and len(ys):
+                self.axes_y[variable].setRange(float(ys.min()) - 1, float(ys.max()) + 1)
+        first, last = self.data_range()
+        if self.follow and first is not None:
+            self.set_x_range(first, last)
+        self.redraw()
+
+    # (first, last) epoch ms over every variable, (None, None) without data
+    def data_range(self):
+        ranges = [(xs[0], xs[-1]) for xs, _ in self.data.values() if len(xs)]
+        if not ranges:
+            return None, None
+        return min(first for first, _ in ranges), max(last for _, last in ranges)
+
+    def set_x_range(self, first, last):
+        self.updating = True
+        try:
+            self.axis_x.setRange(QDateTime.fromMSecsSinceEpoch(int(first)), QDateTime.fromMSecsSinceEpoch(int(last)))
+        finally:
+            self.updating = False
+
+    def x_range_changed(self, start, end):
+        if self.updating:
+            return
+        # zooming back out to the whole data range resumes following it
+        first, last = self.data_range()
+        self.follow = first is None or (start.toMSecsSinceEpoch() <= first and end.toMSecsSinceEpoch() >= last)
+        self.redraw()
+
+    # hands every series the decimated points of the visible x range
+    def redraw(self):
+        x_start = self.axis_x.min().toMSecsSinceEpoch()
+        x_end = self.axis_x.max().toMSecsSinceEpoch()
+        buckets = max(int(self.chart().plotArea().width()), 1)
+        for variable, (xs, ys) in self.data.items():
+            xs, ys = min_max_decimate(xs, ys, x_start, x_end, buckets)
+            # replace() swaps the whole point list with a single repaint
+            self.series[variable].replace([QPointF(x, y) for x, y in zip(xs.tolist(), ys.tolist())])
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.redraw()
+
+    def keyPressEvent(self, event):
+        # pan by a tenth of the visible range
+        step = {Qt.Key_Left: -0.1, Qt.Key_Right: 0.1}.get(event.key())
+        if step is None:
+            super().keyPressEvent(event)
+            return
+        self.chart().scroll(step * self.chart().plotArea().width(), 0)
+
+
+class BarPanel(FigureCanvas):
+    """
+    Matplotlib bar chart with one bar per category. It draws on its own Figure rather than
+    through pyplot, so no figure is left behind in pyplot's registry, and an update only sets
+    the bar heights and labels and schedules a redraw.
+    """
+
+    def __init__(self, categories, colors, parent=None):
+        self.figure = Figure()
+        super().__init__(self.figure)
+        self.setParent(parent)
+        self.axes = self.figure.add_subplot()
+        self.bars = self.axes.bar(categories, [0] * len(categories), color=colors)
+
+    def update_bars(self, values, title, ylabel):
+        for bar, value in zip(self.bars, values):
+            bar.set_height(value)
+        self.axes.set_title(title)
+        self.axes.set_ylabel(ylabel)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.draw_idle()
+
+
+class DiagnosticsPanel(QWidget):
+    """
+    Telemetry of one pico (command 0x0A): heap figures and counters as text above one latency
+    histogram per timed stage. The subplots and their bars are created on the first update, when
+    the bucket bounds are known, later updates only set the bar heights and the text.
+    """
+
+    def __init__(self, stage_names, counter_names, parent=None):
+        super().__init__(parent)
+        self.stage_names = stage_names
+        self.counter_names = counter_names
+        layout = QVBoxLayout(self)
+        self.summary = QLabel()
+        layout.addWidget(self.summary)
+        self.figure = Figure()
+        self.canvas = FigureCanvas(self.figure)
+        layout.addWidget(self.canvas, stretch=1)
+        # stage id -> (axes, bars)
+        self.histograms = {}
+
+    # telemetry: the dict MyApp.parse_response makes of a unit 0x07 payload
+    def update_telemetry(self, title, telemetry):
+        lines = [f"{title}: up {telemetry['uptime_ms'] // 1000} s, heap {telemetry['mem_alloc']} bytes used, "
+                 f"{telemetry['mem_free']} bytes free, {telemetry['collections']} collections seen"]
+        lines.append(', '.join(f"{self.counter_names.get(counter_id, counter_id)}: {value}"
+                               for counter_id, value in telemetry['counters']))
+        self.summary.setText('\n'.join(lines))
+
+        if not self.histograms:
+            labels = [_duration_label(bound) for bound in telemetry['bounds']] + ['more']
+            for row, (stage_id, *_rest) in enumerate(telemetry['stages']):
+                axes = self.figure.add_subplot(len(telemetry['stages']), 1, row + 1)
+                bars = axes.bar(labels, [0] * len(labels), color='blue')
+                axes.tick_params(labelsize='small')
+                self.histograms[stage_id] = (axes, bars)
+            self.figure.tight_layout()
+
+        for stage_id, count, max_us, mean_us, buckets in telemetry['stages']:
+            if stage_id not in self.histograms:
+                continue
+            axes, bars = self.histograms[stage_id]
+            for bar, value in zip(bars, buckets):
+                bar.set_height(value)
+            axes.set_title(f"{self.stage_names.get(stage_id, stage_id)}: {count} timed, mean {mean_us} us, "
+                           f"max {max_us} us", fontsize='small')
+            axes.relim()
+            axes.autoscale_view()
+        self.canvas.draw_idle()
+
+
+class SamplingPanel(QWidget):
+    """
+    Sampling schedule of one pico (command 0x0C): a row per channel with its fastest and slowest
+    sampling period and its deadband, which can be edited, and the period it currently samples at.
+    Apply hands every edited row to on_apply(channel, min_period_ms, max_period_ms, deadband) with
+    the deadband in the channel's units.
+    """
+
+    def __init__(self, channels, on_apply, parent=None):
+        super().__init__(parent)
+        # channel_schema.Channel entries, one row each in channel id order
+        self.channels = channels
+        self.on_apply = on_apply
+        # the schedule last shown, (min ms, max ms, deadband) per channel id, to tell the edited rows apart
+        self.shown = {}
+        layout = QVBoxLayout(self)
+        self.title = QLabel()
+        layout.addWidget(self.title)
+        self.table = QTableWidget(len(channels), 4)
+        self.table.setHorizontalHeaderLabels(['Fastest (ms)', 'Slowest (ms)', 'Deadband', 'Sampling every (ms)'])
+        self.table.setVerticalHeaderLabels([f'{channel.name} ({channel.unit})' for channel in channels])
+        layout.addWidget(self.table, stretch=1)
+        apply_button = QPushButton('Apply')
+        apply_button.setStyleSheet("background-color: lightgrey; color: black;")
+        apply_button.clicked.connect(self.apply)
+        layout.addWidget(apply_button)
+
+    # schedule: the list MyApp.parse_response makes of a unit 0x0A payload
+    def update_schedule(self, title, schedule):
+        self.title.setText(f'{title}: sampling schedule')
+        for channel_id, min_period_ms, max_period_ms, deadband, period_ms in schedule:
+            self.shown[channel_id] = (min_period_ms, max_period_ms, deadband)
+            for column, value in enumerate((min_period_ms, max_period_ms, deadband, period_ms)):
+                item = QTableWidgetItem(f'{value:g}')
+                if column == 3:
+                    item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+                self.table.setItem(channel_id, column, item)
+
+    def apply(self):
+        for channel_id, shown in self.shown.items():
+            try:
+                edited = tuple(float(self.table.item(channel_id, column).text()) for column in range(3))
+            except (AttributeError, ValueError):
+                continue
+            if edited != shown:
+                self.on_apply(channel_id, int(edited[0]), int(edited[1]), edited[2])
+
+
+# upper bucket bound as a short axis label
+def _duration_label(bound_us):
+    if bound_us >= 1000000:
+        return f"{bound_us // 1000000}s"
+    if bound_us >= 1000:
+        return f"{bound_us // 1000}ms"
+    return f"{bound_us}us"
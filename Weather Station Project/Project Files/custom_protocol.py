@@ -0,0 +1,140 @@
+"""
+Framing for the custom protocol spoken over the serial-uart link between the GUI
+(final_gui_app.py) and the central pico (final_i2c.py). This module is copied to the
+central pico next to final_i2c.py, so it only uses what MicroPython provides.
+
+protocol id 0x01 (PROTOCOL_NEWLINE): the dataframe followed by b'\n'. Kept for older tools,
+    a payload byte equal to 0x0A cuts such a frame short.
+protocol id 0x02 (PROTOCOL_FRAMED): the dataframe wrapped as
+        0x00 + COBS(<H length> + <H request id> + dataframe + <H crc16>) + 0x00
+    The central copies the request id of a request into its response, so the host can keep
+    many requests in flight and match responses that come back out of order.
+    COBS removes every 0x00 from the body, so 0x00 only ever marks frame boundaries and a
+    reader can resynchronise on the next 0x00 after a corrupt frame. The leading 0x00 tells
+    the central that a framed request follows (a newline request starts with 0x01).
+"""
+import struct
+from array import array
+
+PROTOCOL_NEWLINE = 0x01
+PROTOCOL_FRAMED = 0x02
+
+FRAME_DELIMITER = b'\x00'
+
+################################## CRC16 ##################################
+# CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF), table driven to keep the per byte cost low on the pico
+_CRC16_TABLE = array('H', [0] * 256)
+for _i in range(256):
+    _crc = _i << 8
+    for _bit in range(8):
+        _crc = ((_crc << 1) ^ 0x1021) & 0xFFFF if _crc & 0x8000 else (_crc << 1) & 0xFFFF
+    _CRC16_TABLE[_i] = _crc
+
+
+# crc of the first `length` bytes of data (all of them by default), indexed so no iterator is allocated
+def crc16(data, crc=0xFFFF, length=None):
+    table = _CRC16_TABLE
+    for i in range(len(data) if length is None else length):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ data[i]]
+    return crc
+################################## CRC16 END ##################################
+
+################################## COBS ##################################
+def cobs_encode(data):
+    out = bytearray(len(data) + len(data) // 254 + 2)
+    return bytes(out[:cobs_encode_into(data, len(data), out, 0)])
+
+
+# COBS-encodes the first `length` bytes of data into out from index `start`, returns the index after them.
+# out needs room for length + length // 254 + 1 bytes
+def cobs_encode_into(data, length, out, start):
+    code_index = start
+    out_index = start + 1
+    code = 1
+    for i in range(length):
+        byte = data[i]
+        if byte == 0:
+            out[code_index] = code
+            code_index = out_index
+            out_index += 1
+            code = 1
+        else:
+            out[out_index] = byte
+            out_index += 1
+            code += 1
+            if code == 0xFF:
+                out[code_index] = code
+                code_index = out_index
+                out_index += 1
+                code = 1
+    out[code_index] = code
+    return out_index
+
+
+# returns None when data is not a valid COBS block
+def cobs_decode(data):
+    out = bytearray(len(data))
+    out_index = 0
+    index = 0
+    length = len(data)
+    while index < length:
+        code = data[index]
+        if code == 0:
+            return None
+        index += 1
+        end = index + code - 1
+        if end > length:
+            return None
+        out[out_index:out_index + code - 1] = data[index:end]
+        out_index += code - 1
+        index = end
+        if code != 0xFF and index < length:
+            out[out_index] = 0
+            out_index += 1
+    return bytes(out[:out_index])
+################################## COBS END ##################################
+
+################################## FRAMES ##################################
+def encode_frame(payload, request_id=0):
+    body = struct.pack("<HH", len(payload), request_id) + payload
+    body += struct.pack("<H", crc16(body))
+    return FRAME_DELIMITER + cobs_encode(body) + FRAME_DELIMITER
+
+
+# takes the bytes between two delimiters, returns (request id, dataframe) or None if the frame is corrupt
+def decode_frame(encoded):
+    body = cobs_decode(encoded)
+    if body is None or len(body) < 6:
+        return None
+    length, request_id = struct.unpack("<HH", body[:4])
+    if length != len(body) - 6:
+        return None
+    if struct.unpack("<H", body[-2:])[0] != crc16(body[:-2]):
+        return None
+    return request_id, body[4:-2]
+
+
+class FrameEncoder:
+    """
+    Builds PROTOCOL_FRAMED frames in preallocated buffers, for the pico's response path.
+    The dataframe is written straight into `payload` (a memoryview of max_payload bytes) and
+    frame() wraps its first `length` bytes in place, so encoding a frame allocates nothing but the
+    memoryview it returns, which stays valid until the next frame() call.
+    """
+
+    def __init__(self, max_payload):
+        self.body = bytearray(max_payload + 6)
+        self.payload = memoryview(self.body)[4:4 + max_payload]
+        self.out = bytearray(len(self.body) + len(self.body) // 254 + 3)
+        self.out_mv = memoryview(self.out)
+
+    def frame(self, length, request_id=0):
+        body = self.body
+        struct.pack_into("<HH", body, 0, length, request_id)
+        struct.pack_into("<H", body, 4 + length, crc16(body, 0xFFFF, 4 + length))
+        out = self.out
+        out[0] = 0
+        end = cobs_encode_into(body, length + 6, out, 1)
+        out[end] = 0
+        return self.out_mv[:end + 1]
+################################## FRAMES END ##################################
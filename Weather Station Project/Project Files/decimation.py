@@ -0,0 +1,43 @@
+"""
+Visual decimation for the GUI's line charts (chart_panels.py).
+A chart cannot show more than a couple of points per pixel column, so the visible part of a
+series is split into one bucket per pixel and only the minimum and maximum of each bucket are
+kept, in time order. The envelope of the line, spikes included, looks the same as with every
+point drawn, and the cost is one vectorised pass over the visible samples plus a binary search
+for the visible range, so zooming and panning over 10^6 samples stays cheap.
+"""
+import numpy as np
+
+
+# (xs, ys) of the points of xs (and their ys) to draw over [x_start, x_end] on a chart `buckets`
+# pixels wide: every visible point when there are few, otherwise the min and max of each pixel bucket.
+# one point on either side of the range is kept so the line runs to the chart edges
+def min_max_decimate(xs, ys, x_start, x_end, buckets):
+    # the binary searches need xs in order, but timestamps rebuilt from sample ages can step back
+    # between pushes. a stable sort keeps samples with equal timestamps in arrival order
+    if len(xs) > 1 and np.any(xs[1:] < xs[:-1]):
+        order = np.argsort(xs, kind='stable')
+        xs = xs[order]
+        ys = ys[order]
+    first = max(int(np.searchsorted(xs, x_start, 'left')) - 1, 0)
+    last = min(int(np.searchsorted(xs, x_end, 'right')) + 1, len(xs))
+    xs = xs[first:last]
+    ys = ys[first:last]
+    if len(xs) <= 2 * buckets:
+        return xs, ys
+
+    # first sample index of every pixel bucket, empty buckets merge into the next one
+    starts = np.unique(np.searchsorted(xs, np.linspace(xs[0], xs[-1], buckets + 1)[:-1]))
+    lengths = np.diff(np.append(starts, len(xs)))
+    bucket_of = np.repeat(np.arange(len(starts)), lengths)
+    keep = np.concatenate((_first_match(ys, np.minimum.reduceat(ys, starts)[bucket_of], bucket_of),
+                           _first_match(ys, np.maximum.reduceat(ys, starts)[bucket_of], bucket_of)))
+    keep = np.unique(keep)
+    return xs[keep], ys[keep]
+
+
+# index of the first sample of each bucket whose value equals the bucket's extreme
+def _first_match(ys, extremes, bucket_of):
+    hits = np.flatnonzero(ys == extremes)
+    _, first = np.unique(bucket_of[hits], return_index=True)
+    return hits[first]
@@ -0,0 +1,111 @@
+"""
+Compact encoding of the combined time series characteristic, used by both picos (final_i2c.py
+and finalperipheral_documented.py). Copy this file to each pico next to the firmware.
+
+Each channel is sent as its oldest value followed by the differences between consecutive
+values, as the wire integers of channel_schema.py. Every number is zig-zag mapped
+(0, -1, 1, -2, ... to 0, 1, 2, 3, ...) and written as a varint, 7 bits per byte with the high
+bit set on all but the last byte, so a slowly changing value costs one byte per sample instead
+of two and hundreds of samples per channel fit in a few ATT payloads:
+
+    <BB  channels, samples per channel
+    per channel: varint base, then (samples - 1) varint deltas, oldest first
+
+A window longer than one ATT payload is paged by the peripheral's series page characteristic.
+"""
+
+# most varint bytes of one value: a 16 bit wire integer or the difference of two takes 17 bits zig-zag mapped
+_VARINT_MAX = 3
+
+
+# most bytes of an encoded series of `samples` samples of `channels` channels
+def series_size(channels, samples):
+    return 2 + channels * samples * _VARINT_MAX
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+# writes value as a zig-zag varint into buffer at offset, returns the offset after it or None when it
+# would pass end
+def write_varint(buffer, offset, end, value):
+    value = _zigzag(value)
+    while True:
+        if offset >= end:
+            return None
+        if value < 0x80:
+            buffer[offset] = value
+            return offset + 1
+        buffer[offset] = (value & 0x7F) | 0x80
+        value >>= 7
+        offset += 1
+
+
+# reads a zig-zag varint from data at offset, returns (value, offset after it)
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return _unzigzag(value), offset
+        shift += 7
+
+
+# packs the newest count samples of every ring buffer (ring_buffer.RingBuffer) as the wire integers of the
+# channel at the same index (channel_schema.Channel) into buffer from offset up to end. returns the offset
+# after them, None when they do not fit
+def pack_series_into(rings, channels, count, buffer, offset, end):
+    if offset + 2 > end:
+        return None
+    buffer[offset] = len(rings)
+    buffer[offset + 1] = count
+    offset += 2
+    for channel in range(len(rings)):
+        ring = rings[channel]
+        encode = channels[channel].encode
+        start = ring.index - count
+        previous = 0
+        for i in range(count):
+            value = encode(ring.values[(start + i) % ring.capacity])
+            offset = write_varint(buffer, offset, end, value - previous)
+            if offset is None:
+                return None
+            previous = value
+    return offset
+
+
+# unpacks the newest count samples of every channel of an encoded series into out at out_offset, channel
+# after channel in the wire format of channels[channel]. returns the offset after them, out_offset unchanged
+# when the series holds fewer samples or other channels
+def unpack_series_into(data, count, out, out_offset, channels):
+    if len(data) < 2 or data[0] != len(channels) or data[1] < count:
+        return out_offset
+    return unpack_window_into(data, count, 0, out, out_offset, channels)[0]
+
+
+# unpacks up to count samples of every channel of an encoded series, the newest skip samples left out, into out
+# at out_offset like unpack_series_into(). returns (offset after them, samples per channel unpacked), nothing
+# unpacked when the series holds other channels
+def unpack_window_into(data, count, skip, out, out_offset, channels):
+    if len(data) < 2 or data[0] != len(channels):
+        return out_offset, 0
+    samples = data[1]
+    last = max(samples - skip, 0)
+    first = max(last - count, 0)
+    offset = 2
+    for channel in channels:
+        value = 0
+        for i in range(samples):
+            delta, offset = read_varint(data, offset)
+            value += delta
+            if first <= i < last:
+                out_offset = channel.pack_raw_into(out, out_offset, value)
+    return out_offset, last - first
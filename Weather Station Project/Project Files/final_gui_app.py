@@ -1,38 +1,164 @@
 import struct
 import sys
-import serial
-from PyQt5.QtCore import Qt, QDateTime
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFrame, QMessageBox
-from PyQt5.QtChart import QChart, QChartView, QLineSeries, QDateTimeAxis, QValueAxis
-from PyQt5.QtGui import QPainter
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from collections import deque
+import numpy as np
+from PyQt5.QtCore import Qt, QDateTime, QTimer
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QPushButton, QFrame, QLabel, \
+    QComboBox, QMessageBox, QStackedWidget, QFileDialog
+from chart_panels import TimeSeriesPanel, BarPanel, DiagnosticsPanel, SamplingPanel
+from custom_protocol import PROTOCOL_FRAMED
+from channel_schema import Struct, CHANNELS, HUMIDITY, TEMPERATURE, PRESSURE, SCHEMA_VERSION, SCHEMA_ENTRY_STRUCT
+from serial_session import SerialSession
+from sample_store import SampleStore
+
+# response layouts, compiled once: the header up to the unit id, snapshot sections, the history result,
+# counts, <I ages and bounds, pairs of <I, allocation meters, registry entries, the telemetry parts and the
+# sampling schedule entries
+_HEADER_STRUCT = Struct("<BBBBBhBB")
+_SECTION_STRUCT = Struct("<BBBB")
+_HISTORY_STRUCT = Struct("<IIB")
+_COUNT_STRUCT = Struct("<H")
+_AGE_STRUCT = Struct("<I")
+_PAIR_STRUCT = Struct("<II")
+_METER_STRUCT = Struct("<4I")
+_REGISTRY_STRUCT = Struct("<BBBB6s")
+_TELEMETRY_STRUCT = Struct("<IIIIBBB")
+_STAGE_STRUCT = Struct("<BIII")
+_COUNTER_STRUCT = Struct("<BI")
+_SAMPLING_STRUCT = Struct("<BIIII")
 
 class MyApp(QWidget):
-    def __init__(self):
+    def __init__(self, port_name='COM5'):
         super().__init__()
 
-        # serial port values for UART comminication
-        self.port_name = 'COM5'
+        # serial port values for UART comminication. The central's port by default, or socket://localhost:7000
+        # to share it with loggers and other viewers through serial_mux.py
+        self.port_name = port_name
         self.baud_rate = 115000
+        # seconds to wait for a response frame, and how often a request is resent when none arrives
+        self.response_timeout = 5
+        self.max_retries = 2
+
+        # custom protocol version: PROTOCOL_FRAMED (COBS + CRC16) or PROTOCOL_NEWLINE (legacy b'\n' frames)
+        self.protocol_id = PROTOCOL_FRAMED
 
         # Devices and service mappings with custom protocol ids
         self.devices = ['i2c sensor', 'BLE sensor']
         self.device_mappings = {'i2c sensor': 0x01, 'BLE sensor': 0x02}
         self.device_type_mappings = {'i2c sensor': 0x01, 'BLE sensor': 0x02}
-        self.operation_mapping = {'read': 0x01, 'write': 0x02, 'registry': 0x03}
+        self.operation_mapping = {'read': 0x01, 'write': 0x02, 'registry': 0x03, 'subscribe': 0x04,
+                                  'unsubscribe': 0x05}
         self.service_mappings = {'HTP guages': 0x01, 'Humidity Aggregation': 0x02, 'Pressure Aggregation': 0x03,
-                                 'Temperature Aggregation': 0x04, 'Time Series': 0x05}
+                                 'Temperature Aggregation': 0x04, 'Time Series': 0x05, 'Snapshot': 0x06,
+                                 'History': 0x07, 'Samples Since': 0x08, 'Allocations': 0x09,
+                                 'Diagnostics': 0x0A, 'Devices': 0x01, 'Schema': 0x0B, 'Sampling': 0x0C,
+                                 'Series Window': 0x0D}
+        # aggregation scopes, sent as params [scope, length] with the aggregation commands.
+        # length 0 asks for the length configured on the device (SAMPLE_WINDOW / TIME_WINDOW_S)
+        self.aggregation_scopes = {'Last N samples': 0x01, 'Last T seconds': 0x02, 'Lifetime': 0x00}
+        # history ranges: (rollup tier, seconds back from now). tiers are 1 s, 1 min and 1 h buckets
+        self.history_ranges = {'Last 2 minutes': (0x00, 120), 'Last 2 hours': (0x01, 7200),
+                               'Last 2 days': (0x02, 172800)}
+        # history channel ids by name. values are decoded with channel_schema.py, checked against the central's
+        # schema (command 0x0B) on every connect: schema_error says why decoding is refused when they differ
+        self.history_channels = {channel.name: channel.channel_id for channel in CHANNELS}
+        self.schema_error = None
+        # channel of each aggregation, by command id and by service name
+        self.aggregation_channels = {0x02: HUMIDITY, 0x03: PRESSURE, 0x04: TEMPERATURE}
+        # service names of the snapshot sections, by command id
+        self.snapshot_sections = {0x02: 'Humidity Aggregation', 0x03: 'Pressure Aggregation',
+                                  0x04: 'Temperature Aggregation', 0x05: 'Time Series'}
         # Devices list
         self.devices = ['i2c sensor', 'BLE sensor']
+        # the central numbers every sensor node it finds (registry operation 0x03, command 'Devices'), the
+        # device buttons follow its registry, refreshed every registry_period_ms while it answers.
+        # until the first answer the buttons show the central's own sensor and the first node
+        self.registry_period_ms = 10000
+        # (connected, address) per device name, from the last registry answer
+        self.device_states = {}
+
+        # stamped samples already fetched per device: the sequence number to ask for next and
+        # (host epoch ms, humidity, temperature, pressure) tuples, so Time Series only fetches new samples
+        # charts decimate to their pixel width, so the cache can hold far more samples than a chart shows
+        self.time_series_length = 100000
+        self.time_series_cache = {device: {'next_seq': 0, 'samples': deque(maxlen=self.time_series_length)}
+                                  for device in self.devices}
+        # requests one Time Series refresh may spend catching up with the central
+        self.max_catch_up_requests = 10
+        # every stamped sample received is also kept on disk, with downsampled tiers for long ranges
+        self.store_path = 'samples.sqlite3'
+        self.store = SampleStore(self.store_path)
+        # most rows one Stored History view loads, coarser tiers are used beyond that
+        self.stored_history_points = 200000
+
+        # live mode: the central pushes new samples of the selected device every live_period_ms,
+        # only when there are new ones
+        self.live_period_ms = 1000
+        self.live_on_change = True
+        self.live_request_id = None
+        self.live_device = None
+        self.selected_device = self.devices[0]
+
+        # chart widgets are created on first use and then updated in place: one time series panel,
+        # one history panel, one bar panel per aggregation and the snapshot grid with its own panels
+        self.time_series_ranges = {'Humidity': (0, 100), 'Temperature': (0, 30), 'Pressure': (800, 1200)}
+        self.time_series_panel = None
+        self.history_panel = None
+        self.bar_panels = {}
+        self.snapshot_grid = None
+        self.snapshot_panels = {}
+        self.diagnostics_panel = None
+        # names of the telemetry stages and counters (telemetry.py on the picos), by id
+        self.telemetry_stages = {0x00: 'Sensor read', 0x01: 'Encode', 0x02: 'BLE read', 0x03: 'UART turnaround',
+                                 0x04: 'Loop jitter'}
+        self.telemetry_counters = {0x00: 'Requests', 0x01: 'Errors', 0x02: 'Reconnects', 0x03: 'Dropped frames',
+                                   0x04: 'Samples', 0x05: 'Publishes'}
+        # sampling schedule of the device shown, edits are written back with command 0x0C
+        self.sampling_panel = None
+        self.sampling_device = None
+
+        # dashboard mode: the snapshot grid kept current by subscriptions to the snapshot and to the samples
+        # of every device, pushed on change at the selected interval. Pushes only update
+        # dashboard_sections and the sample caches, the grid is redrawn at most once per display frame
+        self.dashboard_intervals = {'Every 1 s': 1000, 'Every 5 s': 5000, 'Every 30 s': 30000}
+        # device per subscription request id, None for the snapshot subscription
+        self.dashboard_subscriptions = {}
+        self.dashboard_sections = {}
+        self.dashboard_interval_ms = None
+        # a subscription the central refused for want of a free slot is asked for again after dashboard_retry_ms,
+        # the request ids of those retries are kept so the refusal is only shown once
+        self.dashboard_retry_ms = 5000
+        self.dashboard_retries = set()
 
         # services for each device
         self.device_services = {
-            'i2c sensor': ['Humidity Aggregation', 'Pressure Aggregation', 'Temperature Aggregation', 'Time Series'],
-            'BLE sensor': ['Humidity Aggregation', 'Pressure Aggregation', 'Temperature Aggregation', 'Time Series']
+            'i2c sensor': ['Humidity Aggregation', 'Pressure Aggregation', 'Temperature Aggregation', 'Time Series',
+                           'History', 'Stored History', 'Allocations', 'Diagnostics', 'Sampling'],
+            'BLE sensor': ['Humidity Aggregation', 'Pressure Aggregation', 'Temperature Aggregation', 'Time Series',
+                           'History', 'Stored History', 'Diagnostics', 'Sampling']
         }
+        # services of every other sensor node
+        self.node_services = self.device_services['BLE sensor']
+
+        # the port stays open for the lifetime of the window, all serial I/O happens on the session thread
+        self.session = SerialSession(self.port_name, self.baud_rate, self.protocol_id, self.response_timeout,
+                                     self.max_retries)
+        self.session.answered.connect(self.deliver)
+        self.session.failed.connect(lambda callback, message: self.show_error_message(message))
+        self.session.pushed.connect(self.handle_push)
+        self.session.connection_changed.connect(self.show_connection_state)
 
         self.init_ui()
+        self.session.start()
+
+        refresh_rate = QApplication.primaryScreen().refreshRate() if QApplication.primaryScreen() else 0
+        self.frame_ms = max(1, int(1000 / refresh_rate)) if refresh_rate > 0 else 16
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.timeout.connect(self.redraw_dashboard)
+        self.registry_timer = QTimer(self)
+        self.registry_timer.setSingleShot(True)
+        self.registry_timer.timeout.connect(self.refresh_registry)
 
     def init_ui(self):
         self.setStyleSheet("background-color: black; color: white;")
@@ -43,11 +169,53 @@ class MyApp(QWidget):
         self.devices_layout = QHBoxLayout()
         self.devices_layout.setAlignment(Qt.AlignTop)
 
-        for device_name in self.devices:
-            device_button = QPushButton(device_name, self)
-            device_button.setStyleSheet("background-color: lightgrey; color: black;")
-            device_button.clicked.connect(lambda _, device=device_name: self.show_services(device))
-            self.devices_layout.addWidget(device_button)
+        # one button per device, rebuilt whenever the registry changes
+        self.device_buttons_layout = QHBoxLayout()
+        self.devices_layout.addLayout(self.device_buttons_layout)
+        self.show_device_buttons()
+
+        # one snapshot round-trip refreshes every service of every device
+        refresh_button = QPushButton('Refresh All', self)
+        refresh_button.setStyleSheet("background-color: lightgrey; color: black;")
+        refresh_button.clicked.connect(self.show_snapshot)
+        self.devices_layout.addWidget(refresh_button)
+
+        # live Time Series of the selected device, pushed by the central
+        self.live_button = QPushButton('Live', self)
+        self.live_button.setCheckable(True)
+        self.live_button.setStyleSheet("background-color: lightgrey; color: black;")
+        self.live_button.toggled.connect(self.toggle_live)
+        self.devices_layout.addWidget(self.live_button)
+
+        # every service of every device at once, refreshed by the central at the selected interval
+        self.dashboard_button = QPushButton('Dashboard', self)
+        self.dashboard_button.setCheckable(True)
+        self.dashboard_button.setStyleSheet("background-color: lightgrey; color: black;")
+        self.dashboard_button.toggled.connect(self.toggle_dashboard)
+        self.devices_layout.addWidget(self.dashboard_button)
+        self.dashboard_combo = QComboBox(self)
+        self.dashboard_combo.setStyleSheet("background-color: lightgrey; color: black;")
+        self.dashboard_combo.addItems(list(self.dashboard_intervals))
+        self.dashboard_combo.currentTextChanged.connect(self.restart_dashboard)
+        self.devices_layout.addWidget(self.dashboard_combo)
+
+        # time scope of the Avg/Min/Max bars
+        self.scope_combo = QComboBox(self)
+        self.scope_combo.setStyleSheet("background-color: lightgrey; color: black;")
+        self.scope_combo.addItems(list(self.aggregation_scopes))
+        self.devices_layout.addWidget(self.scope_combo)
+
+        # time range of the History chart
+        self.history_combo = QComboBox(self)
+        self.history_combo.setStyleSheet("background-color: lightgrey; color: black;")
+        self.history_combo.addItems(list(self.history_ranges))
+        self.devices_layout.addWidget(self.history_combo)
+
+        # raw samples of the selected device stored so far, as csv
+        export_button = QPushButton('Export CSV', self)
+        export_button.setStyleSheet("background-color: lightgrey; color: black;")
+        export_button.clicked.connect(self.export_samples)
+        self.devices_layout.addWidget(export_button)
 
         layout.addLayout(self.devices_layout)
 
@@ -61,16 +229,85 @@ class MyApp(QWidget):
         self.services_frame = QFrame()
         self.services_frame.setStyleSheet("background-color: black; color: white; border: 2px solid lightgrey;")
         self.services_frame_layout = QVBoxLayout(self.services_frame)
+        # holds every chart widget created so far, only the current one is shown
+        self.services_stack = QStackedWidget()
+        self.services_frame_layout.addWidget(self.services_stack)
 
         layout.addWidget(self.services_frame, stretch=1)
 
         self.setLayout(layout)
         self.setGeometry(100, 100, 800, 600)
-        self.setWindowTitle('Pico Data Reader')
+        self.show_connection_state(False)
 
         self.show()
 
+    def show_connection_state(self, connected):
+        self.setWindowTitle('Pico Data Reader' if connected else f'Pico Data Reader ({self.port_name} not connected)')
+        if connected:
+            self.refresh_registry()
+            self.request(self.devices[0], 'Schema', 'read', [], self.check_schema)
+
+    def show_device_buttons(self):
+        for i in reversed(range(self.device_buttons_layout.count())):
+            self.device_buttons_layout.itemAt(i).widget().setParent(None)
+        for device_name in self.devices:
+            connected, address = self.device_states.get(device_name, (True, None))
+            device_button = QPushButton(device_name if connected else f'{device_name} (offline)', self)
+            device_button.setStyleSheet("background-color: lightgrey; color: black;")
+            if address is not None:
+                device_button.setToolTip(address)
+            device_button.clicked.connect(lambda _, device=device_name: self.show_services(device))
+            self.device_buttons_layout.addWidget(device_button)
+
+    # schema: the central's schema command result, decoding is refused until it matches channel_schema.py
+    def check_schema(self, schema):
+        channels = [(channel.channel_id, channel.width, channel.scale, channel.offset) for channel in CHANNELS]
+        if schema['version'] == SCHEMA_VERSION and schema['channels'] == channels:
+            self.schema_error = None
+            return
+        self.schema_error = (f"The central encodes values with channel schema version {schema['version']}, "
+                             f"this GUI decodes version {SCHEMA_VERSION}. Update the firmware or the GUI")
+        self.show_error_message(self.schema_error)
+
+    # asks the central for its device registry, answered by update_registry
+    def refresh_registry(self):
+        self.registry_timer.stop()
+        self.request(self.devices[0], 'Devices', 'registry', [], self.update_registry)
+
+    # button name of a device id: the central's own sensor, then the sensor nodes in the order they were found
+    def device_name(self, device_id):
+        if device_id == 0x01:
+            return 'i2c sensor'
+        elif device_id == 0x02:
+            return 'BLE sensor'
+        return f'BLE sensor {device_id - 1}'
+
+    # registry: [(device id, device type id, connected, address)], the central's own sensor first
+    def update_registry(self, registry):
+        devices = []
+        for device_id, device_type_id, connected, address in registry:
+            device = self.device_name(device_id)
+            devices.append(device)
+            self.device_mappings[device] = device_id
+            self.device_type_mappings[device] = device_type_id
+            self.device_states[device] = (connected, address if device_type_id == 0x02 else None)
+            self.device_services.setdefault(device, list(self.node_services))
+            self.time_series_cache.setdefault(device, {'next_seq': 0, 'samples': deque(maxlen=self.time_series_length)})
+        if devices != self.devices:
+            self.devices = devices
+            # the snapshot grid has a row per device, it is built again on its next use
+            if self.snapshot_grid is not None:
+                self.services_stack.removeWidget(self.snapshot_grid)
+                self.snapshot_grid.deleteLater()
+                self.snapshot_grid = None
+                self.snapshot_panels = {}
+            # the dashboard subscribes to the samples of every device
+            self.restart_dashboard()
+        self.show_device_buttons()
+        self.registry_timer.start(self.registry_period_ms)
+
     def show_services(self, selected_device):
+        self.selected_device = selected_device
         # Clear existing service buttons
         for i in reversed(range(self.services_layout.count())):
             self.services_layout.itemAt(i).widget().setParent(None)
@@ -88,122 +325,333 @@ class MyApp(QWidget):
 
 
     def show_service_data(self, device, service):
-        serial_port = serial.Serial(self.port_name, self.baud_rate)
         #conditionals for selected services
         if service == 'Time Series':
-            try:
-                self.send_request(serial_port, device, service, "read", None)
-                htp_arr = self.receive_response(serial_port)
-                self.show_time_series_chart(htp_arr)
-            except Exception as e:
-                self.show_error_message(str(e))
-            finally:
-                serial_port.close()
+            show = lambda: self.show_time_series_chart(list(self.time_series_cache[device]['samples']))
+            if self.streaming(device):
+                # a subscription already keeps the cache current
+                show()
+            else:
+                self.fetch_new_samples(device, show)
         elif service in ['Humidity Aggregation', 'Pressure Aggregation', 'Temperature Aggregation']:
-
-            try:
-                self.send_request(serial_port, device, service, "read", None)
-                aggr_arr = self.receive_response(serial_port)
-                print("aggr",aggr_arr)
-                print("service",service)
-                self.show_bar_graph(service,aggr_arr)
-            except Exception as e:
-                self.show_error_message(str(e))
-            finally:
-                serial_port.close()
+            scope_name = self.scope_combo.currentText()
+            self.request(device, service, "read", [self.aggregation_scopes[scope_name], 0],
+                         lambda aggr_arr: self.show_bar_graph(service, aggr_arr, scope_name))
+        elif service == 'History':
+            range_name = self.history_combo.currentText()
+            tier, range_s = self.history_ranges[range_name]
+            # one request per channel, pipelined in one batch
+            requests = [(device, service, "read", [channel_id, tier, range_s, 0])
+                        for channel_id in self.history_channels.values()]
+            self.request_many(requests, lambda histories: self.show_history_chart(
+                dict(zip(self.history_channels, histories)), range_name))
+        elif service == 'Stored History':
+            self.show_stored_history(device)
+        elif service == 'Allocations':
+            self.request(device, service, "read", [], self.show_allocations)
+        elif service == 'Diagnostics':
+            self.request(device, service, "read", [], lambda telemetry: self.show_diagnostics(device, telemetry))
+        elif service == 'Sampling':
+            self.request(device, service, "read", [], lambda schedule: self.show_sampling(device, schedule))
         else:
             # Other services can be added further
             print("place holder")
 
-    def show_time_series_chart(self, htp_arr):
-        chart = QChart()
-        chart.setTitle('Time Series Chart')
-
-
-        humidity_values = list(map(lambda x: x / 100.0, htp_arr[:10]))
-        temperature_values = list(map(lambda x: x / 100.0, htp_arr[10:20]))
-        pressure_values = list(map(lambda x: x / 10.0, htp_arr[20:]))
-
-        data = {'Humidity': humidity_values, 'Temperature': temperature_values, 'Pressure': pressure_values}
-
-        for variable, values in data.items():
-            series = QLineSeries()
-            series.setName(variable)
-
-            for i, value in enumerate(values):
-                series.append(i * 10000, value)
-
-            chart.addSeries(series)
-
-            axis_y = QValueAxis()
-            axis_y.setTitleText(variable)
-
-            # Setting individual ranges for each Y-axis
-            if variable == 'Humidity':
-                axis_y.setRange(0, 100)
-            elif variable == 'Temperature':
-                axis_y.setRange(0, 30)
-            elif variable == 'Pressure':
-                axis_y.setRange(800, 1200)
-
-            chart.addAxis(axis_y, Qt.AlignLeft)
-            series.attachAxis(axis_y)
-
-        axis_x = QDateTimeAxis()
-        axis_x.setFormat('mm:ss')
-        axis_x.setTickCount(10)  #  number of ticks as needed
-        chart.addAxis(axis_x, Qt.AlignBottom)
-
-        chart_view = QChartView(chart)
-        chart_view.setRenderHint(QPainter.Antialiasing)
-
-        # Clear existing content in the service frame layout
-        for i in reversed(range(self.services_frame_layout.count())):
-            self.services_frame_layout.itemAt(i).widget().setParent(None)
-
-        # Adding the chart view to the service frame
-        self.services_frame_layout.addWidget(chart_view)
-
-    def show_bar_graph(self, aggregation_type,aggregation_arr):
-
-        categories = ['Avg', 'Min', 'Max']
-        values = [x / 100.0 for x in aggregation_arr]  # to get the float value
-         #setting the units and data format based on the service selected
-        if aggregation_type == 'Humidity Aggregation':
-            unit = '%'
-            print("hum agg:" , values)
-        elif aggregation_type == 'Pressure Aggregation':
-            values= [x / 10.0 for x in aggregation_arr]
-            unit = 'hPa'
-            print("pres agg:" , values)
-        elif aggregation_type == 'Temperature Aggregation':
-            print ("temp agg:",values)
-
-            unit = '°C'
+    def show_snapshot(self):
+        device_ids = [self.device_mappings[device] for device in self.devices]
+        self.request(self.devices[0], 'Snapshot', "read", device_ids, self.show_snapshot_sections)
+
+    # live: the time series column shows the stamped sample caches instead of the snapshot's time series
+    def show_snapshot_sections(self, sections, live=False):
+        if self.snapshot_grid is None:
+            # one row per device: the three aggregations followed by the time series
+            self.snapshot_grid = QWidget()
+            grid_layout = QGridLayout(self.snapshot_grid)
+            for row, device in enumerate(self.devices):
+                grid_layout.addWidget(QLabel(device), row, 0)
+                for column, command_id in enumerate(sorted(self.snapshot_sections), start=1):
+                    if command_id == 0x05:
+                        panel = TimeSeriesPanel('Time Series Chart', self.time_series_ranges, 'mm:ss')
+                    else:
+                        panel = BarPanel(['Avg', 'Min', 'Max'], ['blue', 'green', 'red'])
+                    self.snapshot_panels[(device, command_id)] = panel
+                    grid_layout.addWidget(panel, row, column)
+
+        for (device, command_id), panel in self.snapshot_panels.items():
+            service = self.snapshot_sections[command_id]
+            values = sections.get((self.device_mappings[device], command_id))
+            if command_id == 0x05 and live:
+                panel.set_title('Time Series Chart')
+                panel.update_points(self.time_series_points(self.time_series_cache[device]['samples']))
+            elif command_id == 0x05:
+                panel.set_title('Time Series Chart' if values is not None else f'{service} not available')
+                panel.update_points(self.time_series_points(self.snapshot_samples(values) if values is not None else []))
+            elif values is None:
+                panel.update_bars([0, 0, 0], f'{service} not available', '')
+            else:
+                self.update_bar_panel(panel, service, values)
+
+        self.set_service_widget(self.snapshot_grid)
+
+    # shows widget in the service frame, widgets shown before stay in the stack to be shown again
+    def set_service_widget(self, widget):
+        if self.services_stack.indexOf(widget) < 0:
+            self.services_stack.addWidget(widget)
+        self.services_stack.setCurrentWidget(widget)
+
+    # asks the central only for the samples newer than the cached ones, and keeps asking while it has more.
+    # done() runs once the cache caught up
+    def fetch_new_samples(self, device, done, rounds=None):
+        rounds = self.max_catch_up_requests if rounds is None else rounds
+
+        def merge(response):
+            if self.merge_samples(device, response) and rounds > 1:
+                self.fetch_new_samples(device, done, rounds - 1)
+            else:
+                done()
+        self.request(device, 'Samples Since', "read", [self.time_series_cache[device]['next_seq']], merge)
+
+    # adds the samples of an incremental time series response to the device's cache, returns True
+    # when the central holds more samples than the response carried
+    def merge_samples(self, device, response):
+        cache = self.time_series_cache[device]
+        # the central reports ages, anchor them to the host clock
+        now_ms = QDateTime.currentMSecsSinceEpoch()
+        if response['next_seq'] < cache['next_seq']:
+            # the sensor restarted its sequence numbers (rebooted), the cached samples are from before that
+            cache['samples'].clear()
+        samples = [(now_ms - age_ms, humidity, temperature, pressure)
+                   for age_ms, humidity, temperature, pressure in response['samples']]
+        cache['samples'].extend(samples)
+        self.store.add_samples(device, samples)
+        cache['next_seq'] = response['next_seq']
+        return response['next_seq'] < response['latest_seq']
+
+    # True when a live or dashboard subscription streams the device's samples into its cache
+    def streaming(self, device):
+        return ((self.live_request_id is not None and self.live_device == device)
+                or device in self.dashboard_subscriptions.values())
+
+    def toggle_live(self, checked):
+        if checked:
+            # both modes stream samples into the same caches, only one of them runs at a time
+            self.dashboard_button.setChecked(False)
+            self.live_device = self.selected_device
+            flags = 0x01 if self.live_on_change else 0x00
+            since_seq = self.time_series_cache[self.live_device]['next_seq']
+            self.live_request_id = self.session.subscribe(self.build_request(
+                self.live_device, 'Samples Since', 'subscribe', [self.live_period_ms, flags, since_seq]))
         else:
-            values = []
-            unit = ''
-
-        # Create bar graph using Matplotlib
-        fig, ax = plt.subplots()
-        ax.bar(categories, values, color=['blue', 'green', 'red'])
-        ax.set_ylabel(f'{aggregation_type} ({unit})')
-        ax.set_title(f'{aggregation_type} Bar Graph')
-
-        # Display Matplotlib plot in a PyQt window
-        mpl_canvas = FigureCanvas(fig)
-        mpl_canvas.setGeometry(0, 0, 400, 300)  # Adjust the size as needed
-
-        # Clear existing content in the service frame layout
-        for i in reversed(range(self.services_frame_layout.count())):
-            self.services_frame_layout.itemAt(i).widget().setParent(None)
-
-        # Add the Matplotlib canvas to the service frame
-        self.services_frame_layout.addWidget(mpl_canvas)
-
-    def send_request(self, serial_port, device, command, operation, params_arr):
+            self.stop_live()
+
+    def stop_live(self):
+        if self.live_request_id is None:
+            return
+        self.session.unsubscribe(self.live_request_id, self.build_request(
+            self.live_device, 'Samples Since', 'unsubscribe', [self.live_request_id]))
+        self.live_request_id = None
+
+    def toggle_dashboard(self, checked):
+        if not checked:
+            self.stop_dashboard()
+            return
+        self.live_button.setChecked(False)
+        self.dashboard_interval_ms = self.dashboard_intervals[self.dashboard_combo.currentText()]
+        self.dashboard_subscriptions = {}
+        for device in [None] + self.devices:
+            self.subscribe_dashboard(device)
+        self.show_snapshot_sections(self.dashboard_sections, live=True)
+
+    # subscribes to the snapshot of every device (device None) or to the samples of device, returns the request id
+    def subscribe_dashboard(self, device):
+        # 0x01: the central only pushes responses that changed
+        if device is None:
+            device_ids = [self.device_mappings[device] for device in self.devices]
+            request_id = self.session.subscribe(self.build_request(
+                self.devices[0], 'Snapshot', 'subscribe', [self.dashboard_interval_ms, 0x01] + device_ids))
+        else:
+            since_seq = self.time_series_cache[device]['next_seq']
+            request_id = self.session.subscribe(self.build_request(
+                device, 'Samples Since', 'subscribe', [self.dashboard_interval_ms, 0x01, since_seq]))
+        self.dashboard_subscriptions[request_id] = device
+        return request_id
+
+    # asks again for a refused dashboard subscription, unless the dashboard stopped or subscribed it again since
+    def retry_dashboard(self, device):
+        if self.dashboard_button.isChecked() and device not in self.dashboard_subscriptions.values():
+            self.dashboard_retries.add(self.subscribe_dashboard(device))
+
+    def stop_dashboard(self):
+        for request_id, device in self.dashboard_subscriptions.items():
+            self.session.unsubscribe(request_id, self.build_request(
+                device or self.devices[0], 'Snapshot', 'unsubscribe', [request_id]))
+        self.dashboard_subscriptions = {}
+        self.dashboard_retries = set()
+        self.redraw_timer.stop()
+
+    def restart_dashboard(self):
+        if self.dashboard_subscriptions:
+            self.stop_dashboard()
+            self.toggle_dashboard(True)
+
+    def handle_push(self, request_id, response_command):
+        if request_id != self.live_request_id and request_id not in self.dashboard_subscriptions:
+            # pushed before the unsubscribe went out
+            return
+        if response_command[-1] in (0x02, 0x03, 0x05):
+            # the central refused the subscription (0x05: no free slot or params missing), or ended it after
+            # pushing an error repeating the command would not clear (0x02 unsupported, 0x03 bad params)
+            self.subscription_ended(request_id, response_command[-1])
+            return
+        try:
+            response = self.parse_response(response_command)
+        except (ConnectionError, ValueError, IndexError, struct.error) as e:
+            # the central keeps pushing, the next one may succeed
+            print("live update failed", e)
+            return
+        if request_id == self.live_request_id:
+            self.merge_samples(self.live_device, response)
+            if response['samples']:
+                self.show_time_series_chart(list(self.time_series_cache[self.live_device]['samples']))
+            return
+
+        device = self.dashboard_subscriptions[request_id]
+        if device is None:
+            # only the newest snapshot gets drawn, one still waiting for its frame is dropped
+            self.dashboard_sections = response
+        else:
+            # samples are incremental, every push is merged but the cache is bounded
+            self.merge_samples(device, response)
+        # coalesce: pushes arriving before the next frame share one redraw
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start(self.frame_ms)
+
+    # the central holds no subscription for request_id any more. it is unsubscribed all the same, so the session
+    # stops resending it after a reconnect and a central that kept it frees its slot
+    def subscription_ended(self, request_id, error_id):
+        if request_id == self.live_request_id:
+            device = self.live_device
+            self.stop_live()
+            self.live_button.setChecked(False)
+            what = f"Live updates of {device}"
+        else:
+            device = self.dashboard_subscriptions.pop(request_id)
+            self.session.unsubscribe(request_id, self.build_request(
+                device or self.devices[0], 'Snapshot', 'unsubscribe', [request_id]))
+            what = "The dashboard snapshot" if device is None else f"Dashboard samples of {device}"
+            if error_id == 0x05:
+                # no free slot on the central, one frees up when another client unsubscribes
+                QTimer.singleShot(self.dashboard_retry_ms, lambda: self.retry_dashboard(device))
+                if request_id in self.dashboard_retries:
+                    self.dashboard_retries.discard(request_id)
+                    return
+                self.show_error_message(f"{what} refused by the central (error id 0x05), "
+                                        f"asking again every {self.dashboard_retry_ms // 1000} s")
+                return
+        self.show_error_message(f"{what} ended by the central (error id {error_id:#04x}), they are not updated")
+
+    def redraw_dashboard(self):
+        if self.dashboard_subscriptions:
+            self.show_snapshot_sections(self.dashboard_sections, live=True)
+
+    # the snapshot's time series carries no time stamps, spread its samples 10 s apart
+    def snapshot_samples(self, htp_arr):
+        block = len(htp_arr) // 3
+        return [(i * 10000, htp_arr[i], htp_arr[block + i], htp_arr[2 * block + i]) for i in range(block)]
+
+    # samples: (epoch ms, humidity, temperature, pressure), oldest first
+    def show_time_series_chart(self, samples):
+        if self.time_series_panel is None:
+            self.time_series_panel = TimeSeriesPanel('Time Series Chart', self.time_series_ranges)
+        self.time_series_panel.update_points(self.time_series_points(samples))
+        self.set_service_widget(self.time_series_panel)
+
+    # {variable: (epoch ms, values)} of the time series samples
+    def time_series_points(self, samples):
+        columns = np.array(samples, dtype=float).reshape(-1, 4).T
+        return {variable: (columns[0], columns[index]) for index, variable in enumerate(self.time_series_ranges, start=1)}
+
+    def show_history_chart(self, histories, range_name):
+        if self.history_panel is None:
+            self.history_panel = TimeSeriesPanel('History', {f'{variable} (avg)': None for variable in self.history_channels},
+                                                 'dd.MM hh:mm:ss')
+        self.history_panel.set_title(f'History ({range_name})')
+
+        # the central reports bucket ages, anchor them to the host clock
+        now_ms = QDateTime.currentMSecsSinceEpoch()
+        points = {}
+        for variable, history in histories.items():
+            # buckets arrive newest first, empty buckets (count 0) are left out
+            buckets = [(now_ms - history['newest_age_ms'] - i * history['bucket_ms'], avg)
+                       for i, (low, avg, high, count) in reversed(list(enumerate(history['buckets']))) if count]
+            points[f'{variable} (avg)'] = ([x for x, _ in buckets], [y for _, y in buckets])
+        self.history_panel.update_points(points)
+        self.set_service_widget(self.history_panel)
+
+    # the history range selected for the device, read from the sample store (raw samples while they fit the budget)
+    def show_stored_history(self, device):
+        range_name = self.history_combo.currentText()
+        _, range_s = self.history_ranges[range_name]
+        now_ms = QDateTime.currentMSecsSinceEpoch()
+        bucket_ms, rows = self.store.query(device, now_ms - range_s * 1000, now_ms, self.stored_history_points)
+        if self.history_panel is None:
+            self.history_panel = TimeSeriesPanel('History', {f'{variable} (avg)': None for variable in self.history_channels},
+                                                 'dd.MM hh:mm:ss')
+        resolution = f'{bucket_ms // 1000} s buckets' if bucket_ms else 'raw samples'
+        self.history_panel.set_title(f'Stored history of {device} ({range_name}, {resolution})')
+        # rows are (epoch ms, humidity, temperature, pressure), the channel order of history_channels
+        columns = np.array(rows, dtype=float).reshape(-1, 4).T
+        self.history_panel.update_points({f'{variable} (avg)': (columns[0], columns[index])
+                                          for index, variable in enumerate(self.history_channels, start=1)})
+        self.set_service_widget(self.history_panel)
+
+    def export_samples(self):
+        device = self.selected_device
+        path, _ = QFileDialog.getSaveFileName(self, 'Export samples', f'{device}.csv', 'CSV files (*.csv)')
+        if not path:
+            return
+        try:
+            with open(path, 'w', newline='') as file:
+                count = self.store.export_csv(file, device, 0, QDateTime.currentMSecsSinceEpoch())
+            print("exported", count, "samples to", path)
+        except OSError as e:
+            self.show_error_message(str(e))
+
+    def show_bar_graph(self, aggregation_type,aggregation_arr, scope_name='Last N samples'):
+        panel = self.bar_panels.get(aggregation_type)
+        if panel is None:
+            panel = self.bar_panels[aggregation_type] = BarPanel(['Avg', 'Min', 'Max'], ['blue', 'green', 'red'])
+        self.update_bar_panel(panel, aggregation_type, aggregation_arr, scope_name)
+        self.set_service_widget(panel)
+
+    def update_bar_panel(self, panel, aggregation_type, aggregation_arr, scope_name='Last N samples'):
+        # values arrive decoded, the unit comes from the channel of the selected service
+        channel = self.aggregation_channels.get(self.service_mappings.get(aggregation_type))
+        values = list(aggregation_arr) if channel is not None else []
+        unit = channel.unit if channel is not None else ''
+
+        panel.update_bars(values, f'{aggregation_type} Bar Graph ({scope_name})', f'{aggregation_type} ({unit})')
+
+    # queues requests (device, command, operation, params) as one pipelined batch on the session.
+    # callback gets the parsed results in request order, on the GUI thread, once all of them are answered
+    def request_many(self, requests, callback):
+        dataframes = [self.build_request(*request) for request in requests]
+        self.session.submit(dataframes, callback)
+
+    def request(self, device, command, operation, params_arr, callback):
+        self.request_many([(device, command, operation, params_arr)], lambda results: callback(results[0]))
+
+    # answered signal of the session: parses a batch and hands the results to its callback
+    def deliver(self, callback, response_commands):
+        try:
+            results = [self.parse_response(response_command) for response_command in response_commands]
+            callback(results)
+        except Exception as e:
+            self.show_error_message(str(e))
+
+    def build_request(self, device, command, operation, params_arr):
         #custom protocol request dataframe construction
-        protocol_id = 0x01
+        protocol_id = self.protocol_id
         channel_id = 0x01
         device_id = self.device_mappings[device]
         device_type_id = self.device_type_mappings[device]
@@ -214,41 +662,183 @@ class MyApp(QWidget):
 
         header_bytes = bytes([protocol_id, channel_id, device_id, device_type_id, operation_id])
         command = header_bytes + struct.pack("<h", command_id) + bytes([nparams])
-        #sending the custom request dataframe over serial port
-        serial_port.write(command + b'\n')
-
-    def receive_response(self, serial_port):
-        #deconstructing the custom protocol dataframe recieved over serial-uart interface
-        response_command = serial_port.readline()[:-1]
-        protocol_id = response_command[0]
-        channel_id = response_command[1]
-        device_id = response_command[2]
-        device_type_id = response_command[3]
-        operation_id = response_command[4]
-        command = struct.unpack("<h", response_command[5:7])[0]
+        # params follow the header as <I values
+        if nparams:
+            command += struct.pack(f"<{nparams}I", *params_arr)
+        return command
+
+    def parse_response(self, response_command):
+        #deconstructing the custom protocol dataframe recieved over serial-uart interface.
+        #every field is read in place from a memoryview with precompiled Structs, nothing is sliced
+        view = memoryview(response_command)
+        (protocol_id, channel_id, device_id, device_type_id, operation_id, command, nresults,
+         unit_id) = _HEADER_STRUCT.unpack_from(view)
         print(command)
-        nresults = response_command[7]
-        unit_id = response_command[8]  # datatype
         # 0x02 for array type, set the timeserinit id accordingly in central pico
+        error_id = response_command[-1]
+        # error id 0x01 is sent by the central when the sensor is not reachable (BLE link down)
+        if error_id == 0x01:
+            raise ConnectionError("Sensor is not connected to the central, try again shortly")
+        elif error_id != 0x00:
+            raise ValueError(f"Central returned error id {error_id:#04x}")
+        if self.schema_error is not None and unit_id in (0x02, 0x03, 0x04, 0x05, 0x0B):
+            raise ValueError(self.schema_error)
 
         #conditionals for the data type recieved and the command type
-        if unit_id == 0x02 and command==0x05:
+        offset = _HEADER_STRUCT.size
+        if unit_id == 0x03:
+            # sectioned payload (snapshot): {(device_id, command_id): values}, None for unavailable sections
+            result = {}
+            for _ in range(nresults):
+                section_device, section_command, nvalues, section_error = _SECTION_STRUCT.unpack_from(view, offset)
+                offset += _SECTION_STRUCT.size
+                values = self.unpack_values(view, offset, section_command, nvalues)
+                offset += 2 * nvalues
+                result[(section_device, section_command)] = values if section_error == 0x00 else None
+            print("sections:", result)
+        elif unit_id == 0x04:
+            # rollup buckets (min, avg, max, count), newest first
+            bucket_ms, newest_age_ms, history_channel = _HISTORY_STRUCT.unpack_from(view, offset)
+            channel = CHANNELS[history_channel]
+            offset += _HISTORY_STRUCT.size
+            buckets = []
+            for _ in range(nresults):
+                low, avg, high = channel.unpack_many(view, offset, 3)
+                count = _COUNT_STRUCT.unpack_from(view, offset + 3 * channel.size)[0]
+                buckets.append((low, avg, high, count))
+                offset += 3 * channel.size + _COUNT_STRUCT.size
+            result = {'bucket_ms': bucket_ms, 'newest_age_ms': newest_age_ms, 'buckets': buckets}
+            print("history:", result)
+        elif unit_id == 0x05:
+            # stamped samples (age ms, humidity, temperature, pressure), oldest first
+            next_seq, latest_seq = _PAIR_STRUCT.unpack_from(view, offset)
+            offset += _PAIR_STRUCT.size
+            samples = []
+            for _ in range(nresults):
+                age_ms = _AGE_STRUCT.unpack_from(view, offset)[0]
+                offset += _AGE_STRUCT.size
+                values = []
+                for channel in CHANNELS:
+                    values.append(channel.unpack_from(view, offset))
+                    offset += channel.size
+                samples.append((age_ms, *values))
+            result = {'next_seq': next_seq, 'latest_seq': latest_seq, 'samples': samples}
+            print("samples:", result)
+        elif unit_id == 0x06:
+            # central heap: in use and free bytes, then (last, peak, runs, interrupted runs) per allocation meter
+            mem_alloc, mem_free = _PAIR_STRUCT.unpack_from(view, offset)
+            offset += _PAIR_STRUCT.size
+            meters = [_METER_STRUCT.unpack_from(view, offset + _METER_STRUCT.size * i) for i in range(nresults)]
+            result = {'mem_alloc': mem_alloc, 'mem_free': mem_free, 'meters': meters}
+            print("allocations:", result)
+        elif unit_id == 0x08:
+            # device registry: (device id, device type id, connected, address) per device, the central's own first
+            result = []
+            for i in range(nresults):
+                device_id, device_type_id, connected, _, address = \
+                    _REGISTRY_STRUCT.unpack_from(view, offset + _REGISTRY_STRUCT.size * i)
+                result.append((device_id, device_type_id, bool(connected), address.hex(':')))
+            print("registry:", result)
+        elif unit_id == 0x09:
+            # channel schema: version, then (channel id, width code, scale, offset) per channel
+            entries = [SCHEMA_ENTRY_STRUCT.unpack_from(view, offset + 1 + SCHEMA_ENTRY_STRUCT.size * i)
+                       for i in range(nresults)]
+            result = {'version': response_command[offset],
+                      'channels': [(channel_id, chr(width), scale, value_offset)
+                                   for channel_id, width, scale, value_offset in entries]}
+            print("schema:", result)
+        elif unit_id == 0x07:
+            # telemetry: heap figures, bucket bounds (us), per stage (id, count, max us, mean us, bucket counts)
+            # and per counter (id, value), laid out as in telemetry.py
+            uptime_ms, mem_alloc, mem_free, collections, nbuckets, nstages, ncounters = \
+                _TELEMETRY_STRUCT.unpack_from(view, offset)
+            offset += _TELEMETRY_STRUCT.size
+            bounds = [_AGE_STRUCT.unpack_from(view, offset + 4 * i)[0] for i in range(nbuckets - 1)]
+            offset += 4 * (nbuckets - 1)
+            stages = []
+            for _ in range(nstages):
+                stage_id, count, max_us, mean_us = _STAGE_STRUCT.unpack_from(view, offset)
+                offset += _STAGE_STRUCT.size
+                buckets = [_COUNT_STRUCT.unpack_from(view, offset + 2 * i)[0] for i in range(nbuckets)]
+                offset += 2 * nbuckets
+                stages.append((stage_id, count, max_us, mean_us, buckets))
+            counters = [_COUNTER_STRUCT.unpack_from(view, offset + _COUNTER_STRUCT.size * i) for i in range(ncounters)]
+            result = {'uptime_ms': uptime_ms, 'mem_alloc': mem_alloc, 'mem_free': mem_free,
+                      'collections': collections, 'bounds': bounds, 'stages': stages, 'counters': counters}
+            print("telemetry:", result)
+        elif unit_id == 0x0A:
+            # sampling schedule: (channel id, min period ms, max period ms, deadband, current period ms) per
+            # channel, the deadband sent in the channel's wire integers and given here in its units
             result = []
-            print(response_command)
-
-            print("nresults", nresults)
-            result = struct.unpack("<30H", response_command[9:9 + 2 * nresults])
-            #result=[x / 100.0 for x in result]
-            print("result_arr:", result)
-        elif  command in (0x04,0x03,0x02) :
-            print(response_command[9:])
-            result = struct.unpack("<3H", response_command[9:9 + 2 * nresults])
-            print("aggr_arr",result)
+            for i in range(nresults):
+                channel_id, min_period_ms, max_period_ms, deadband, period_ms = \
+                    _SAMPLING_STRUCT.unpack_from(view, offset + _SAMPLING_STRUCT.size * i)
+                result.append((channel_id, min_period_ms, max_period_ms, deadband / CHANNELS[channel_id].scale,
+                               period_ms))
+            print("sampling:", result)
+        elif unit_id == 0x0B:
+            # series window: samples held per channel, then humidity, temperature and pressure blocks, oldest first
+            held = _COUNT_STRUCT.unpack_from(view, offset)[0]
+            offset += _COUNT_STRUCT.size
+            blocks = []
+            for channel in CHANNELS:
+                blocks.append(channel.unpack_many(view, offset, nresults))
+                offset += nresults * channel.size
+            result = {'held': held, 'samples': list(zip(*blocks))}
+            print("series window:", result)
+        elif command in (0x02, 0x03, 0x04, 0x05):
+            # aggregations (avg, min, max) and the time series (humidity, temperature and pressure blocks)
+            result = self.unpack_values(view, offset, command, nresults)
+            print("values:", result)
         else:
-            result = struct.unpack("<h", response_command[9:11])[0]
+            result = _COUNT_STRUCT.unpack_from(view, offset)[0]
             print("entered else")
         return result
 
+    # nvalues channel values of a command's result at offset: one channel for an aggregation, equal blocks
+    # of every channel for the time series
+    def unpack_values(self, view, offset, command, nvalues):
+        if command == 0x05:
+            block = nvalues // len(CHANNELS)
+            values = []
+            for channel in CHANNELS:
+                values.extend(channel.unpack_many(view, offset, block))
+                offset += block * channel.size
+            return values
+        return self.aggregation_channels[command].unpack_many(view, offset, nvalues)
+
+    # heap allocation meters of the central, in the order the central sends them
+    def show_allocations(self, allocations):
+        lines = [f"Heap: {allocations['mem_alloc']} bytes used, {allocations['mem_free']} bytes free"]
+        for name, (last, peak, runs, collections) in zip(('Per sample', 'Per request'), allocations['meters']):
+            lines.append(f"{name}: {last} bytes last, {peak} bytes peak over {runs} runs "
+                         f"({collections} interrupted by a collection)")
+        msg_box = QMessageBox(self)
+        msg_box.setIcon(QMessageBox.Information)
+        msg_box.setText("Central allocations")
+        msg_box.setInformativeText('\n'.join(lines))
+        msg_box.exec_()
+
+    def show_diagnostics(self, device, telemetry):
+        if self.diagnostics_panel is None:
+            self.diagnostics_panel = DiagnosticsPanel(self.telemetry_stages, self.telemetry_counters)
+        self.diagnostics_panel.update_telemetry(device, telemetry)
+        self.set_service_widget(self.diagnostics_panel)
+
+    def show_sampling(self, device, schedule):
+        if self.sampling_panel is None:
+            self.sampling_panel = SamplingPanel(CHANNELS, self.write_sampling)
+        self.sampling_device = device
+        self.sampling_panel.update_schedule(device, schedule)
+        self.set_service_widget(self.sampling_panel)
+
+    # writes one channel's schedule to the device shown, the answer carries the whole schedule in use
+    def write_sampling(self, channel_id, min_period_ms, max_period_ms, deadband):
+        device = self.sampling_device
+        raw_deadband = int(round(deadband * CHANNELS[channel_id].scale))
+        self.request(device, 'Sampling', 'write', [channel_id, min_period_ms, max_period_ms, raw_deadband],
+                     lambda schedule: self.show_sampling(device, schedule))
+
 #method for popping up a small error window in case of exceptions or other error ids passed in dataframe
     def show_error_message(self, message):
         msg_box = QMessageBox()
@@ -257,7 +847,16 @@ class MyApp(QWidget):
         msg_box.setInformativeText(message)
         msg_box.exec_()
 
+    def closeEvent(self, event):
+        self.registry_timer.stop()
+        self.stop_live()
+        self.stop_dashboard()
+        self.session.stop()
+        self.store.close()
+        super().closeEvent(event)
+
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    ex = MyApp()
+    # an optional port name (or pyserial URL) replaces COM5
+    ex = MyApp(*sys.argv[1:2])
     sys.exit(app.exec_())
@@ -1,139 +1,216 @@
+import gc
 import machine
 from machine import Pin, I2C
-from bme680 import BME680_I2C
+from bme680_burst import BME680Burst
 import struct
 import aioble
 import bluetooth
 import uasyncio as asyncio
+from utime import ticks_ms, ticks_us, ticks_diff, ticks_add
+from custom_protocol import PROTOCOL_NEWLINE, PROTOCOL_FRAMED, FrameEncoder, decode_frame
+from ring_buffer import ChannelStats, SampleLog, AGGREGATION_SCOPES, SCOPE_LIFETIME, SCOPE_LAST_N, SCOPE_LAST_T
+from rollups import ChannelRollups, ROLLUP_TIERS, BUCKET_SIZE, bucket_offsets
+from alloc_meter import AllocMeter
+from delta_codec import unpack_series_into, unpack_window_into, series_size
+from channel_schema import CHANNELS, HUMIDITY, TEMPERATURE, PRESSURE, VALUES_SIZE, SAMPLE_STRUCT, pack_schema_into
+from sampling import AdaptiveSampler, ENTRY_FORMAT, ENTRY_SIZE, WRITE_FORMAT
+from telemetry import (Telemetry, STAGES, STAGE_SENSOR_READ, STAGE_ENCODE, STAGE_BLE_READ, STAGE_UART_TURNAROUND,
+                       STAGE_LOOP_JITTER, COUNTER_REQUESTS, COUNTER_ERRORS, COUNTER_RECONNECTS, COUNTER_DROPPED_FRAMES,
+                       COUNTER_SAMPLES, COUNTER_PUBLISHES)
 ############################# CONFIGS FOR ALL INTERFACES #######################################
 # config for i2c interface with BME680 sensor
 i2c = I2C(0, scl=Pin(1), sda=Pin(0))
-bme_sensor = BME680_I2C(i2c=i2c)
+# oversampling x8/x4/x2 (temperature/pressure/humidity), IIR filter coefficient 3, gas heater on
+bme_sensor = BME680Burst(i2c, temperature_oversample=8, pressure_oversample=4, humidity_oversample=2,
+                         filter_size=3, gas=True)
 
 #config for uart-serial interface
 uart = machine.UART(1, baudrate=115000, tx=4, rx=5)
 
+# print every sample and response for debugging. printing allocates on every loop, keep it off otherwise
+DEBUG = False
+
 # BLE config for the sensor service
 _ENV_SENSE_UUID = bluetooth.UUID(0x181A)
-#BLE time series charactersetics
-_ENV_SENSE_TEMP_UUID = bluetooth.UUID(0x2A27)
-_ENV_SENSE_PRES_UUID = bluetooth.UUID(0x2A25)
-_ENV_SENSE_HUM_UUID = bluetooth.UUID(0x2A26)
+#BLE combined time series characteristic, delta encoded (see delta_codec.py)
+_ENV_SENSE_SERIES_UUID = bluetooth.UUID(0x2AB4)
+#BLE series page characteristic, a longer window of the same series in pages: <HH (offset, samples) written, notified back
+_ENV_SENSE_SERIES_PAGE_UUID = bluetooth.UUID(0x2AB6)
 #BLE aggregation characterestics
 _ENV_SENSE_PRES_AGGR_UUID = bluetooth.UUID(0x2A20)
 _ENV_SENSE_TEMP_AGGR_UUID = bluetooth.UUID(0x2A1C)
 _ENV_SENSE_HUM_AGGR_UUID = bluetooth.UUID(0x2A24)
+#BLE rollup history query (write) and result (notify) characteristics
+_ENV_SENSE_HISTORY_QUERY_UUID = bluetooth.UUID(0x2AB0)
+_ENV_SENSE_HISTORY_RESULT_UUID = bluetooth.UUID(0x2AB1)
+#BLE stamped sample characteristic, every sample with its sequence number and ticks_ms
+_ENV_SENSE_SAMPLE_UUID = bluetooth.UUID(0x2AB2)
+#BLE telemetry characteristic, the peripheral's telemetry payload (see telemetry.py) in pages: <H offset written, notified back
+_ENV_SENSE_TELEMETRY_UUID = bluetooth.UUID(0x2AB3)
+#BLE sampling schedule characteristic, written and read back by the sampling command (see sampling.py)
+_ENV_SENSE_SAMPLING_UUID = bluetooth.UUID(0x2AB5)
+# ATT MTU asked for right after connecting, so notifications and reads carry up to MTU - 3 bytes
+_BLE_MTU = 247
+aioble.config(mtu=_BLE_MTU)
 ######################### CONFIGS FOR ALL INTERFACES END #######################################
 
 
 ######################## VARIABLES FOR STORING PROCESSING RESULTS ###################
-temperature_values = []
-pressure_values = []
-humidity_values = []
-
-avg_temperature = 0
-min_temperature = float('inf')  # Initialize to positive infinity
-max_temperature = float('-inf')  # Initialize to negative infinity
-
-avg_pressure = 0
-min_pressure = float('inf')
-max_pressure = float('-inf')
-
-avg_humidity = 0
-min_humidity = float('inf')
-max_humidity = float('-inf')
-#packed values(binary encoded values) to send over the custom protocol
+# samples kept per channel for the last-N aggregation scope, can go up to a few thousand
+SAMPLE_WINDOW = 10
+# seconds covered by the last-T aggregation scope, the peripheral uses the same value
+TIME_WINDOW_S = 60
+# fastest sensor_task sampling period (ms), the buffers below are sized for it. the period stretches up to
+# SAMPLE_PERIOD_MAX_MS while the values stay within their deadbands (humidity %, temperature C, pressure hPa),
+# the packed payloads are only refreshed when one moves past its deadband or every PUBLISH_HEARTBEAT_MS.
+# command 0x0C reads and writes the schedule of each channel
+SAMPLE_PERIOD_MS = 100
+SAMPLE_PERIOD_MAX_MS = 2000
+SAMPLE_DEADBANDS = (0.5, 0.05, 0.05)
+PUBLISH_HEARTBEAT_MS = 10000
+# samples per channel in the time series payload (the <10H blocks of command 0x05)
+TIME_SERIES_LENGTH = 10
+# most samples per channel of a sensor node's series window (command 0x0D), as many as the encoding counts
+_SERIES_WINDOW_MAX = 255
+
+_TIME_WINDOW_CAPACITY = TIME_WINDOW_S * 1000 // SAMPLE_PERIOD_MS + 1
+temperature_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+pressure_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+humidity_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+temperature_values = temperature_stats.window
+pressure_values = pressure_stats.window
+humidity_values = humidity_stats.window
+
+# rollup tiers per channel, indexed by the channel id of the history command (0x07):
+# 0x00 humidity, 0x01 temperature, 0x02 pressure, packed in the wire format of channel_schema.CHANNELS
+humidity_rollups = ChannelRollups(ROLLUP_TIERS, HUMIDITY)
+temperature_rollups = ChannelRollups(ROLLUP_TIERS, TEMPERATURE)
+pressure_rollups = ChannelRollups(ROLLUP_TIERS, PRESSURE)
+_HISTORY_CHANNELS = (humidity_rollups, temperature_rollups, pressure_rollups)
+
+# stamped samples kept per device for the incremental time series command (0x08), same channel
+# order as the history command, and the most samples one response carries
+SAMPLE_LOG_LENGTH = 100
+_SINCE_MAX_SAMPLES = 100
+sample_log = SampleLog(SAMPLE_LOG_LENGTH, len(CHANNELS))
+# sequence number of the next local sample, and the (humidity, temperature, pressure) pushed with it
+sample_seq = 0
+sample_values = [0.0, 0.0, 0.0]
+# latest local gas resistance (ohm), None until the heater is stable
+gas_resistance = None
+# sampling period and send-on-delta state of the local channels
+sampler = AdaptiveSampler(CHANNELS, SAMPLE_PERIOD_MS, SAMPLE_PERIOD_MAX_MS, SAMPLE_DEADBANDS, PUBLISH_HEARTBEAT_MS)
+
+#packed values(binary encoded values) to send over the custom protocol.
+#the aggregations hold avg/min/max for each scope in AGGREGATION_SCOPES order.
+#sensor_task packs them in place into preallocated buffers when the sampler publishes: a channel's aggregation
+#when it is due, the time series when any is. the *_packed names stay empty until the first sample (the time
+#series until TIME_SERIES_LENGTH samples) and then refer to views of those buffers
+_AGGREGATES_SIZE = 6 * len(AGGREGATION_SCOPES)
+_pres_aggr_buffer = bytearray(_AGGREGATES_SIZE)
+_temp_aggr_buffer = bytearray(_AGGREGATES_SIZE)
+_hum_aggr_buffer = bytearray(_AGGREGATES_SIZE)
+# humidity, temperature and pressure blocks of TIME_SERIES_LENGTH values
+_time_series_buffer = bytearray(VALUES_SIZE * TIME_SERIES_LENGTH)
 pres_aggr_packed = b''
 temp_aggr_packed = b''
 hum_aggr_packed = b''
 time_series_packed = b''
+
+# heap bytes allocated per sample by sensor_task (measurement excluded) and per answered request,
+# readable with command 0x09
+sample_meter = AllocMeter()
+response_meter = AllocMeter()
+_ALLOC_METERS = (sample_meter, response_meter)
+# stage latency histograms and counters of the central, readable with command 0x0A
+telemetry = Telemetry()
 ######################### VARIABLES FOR STORING PROCESSING RESULTS END ###################
 
 ################################## ENCODING UTILS ##################################
-def _encode_temperature(temp_deg_c):
-    return struct.pack("<H", int(temp_deg_c * 100))  # Encode temperature with two decimal places
-
-
-# Helper to encode the pressure and humidity values
-def _encode_pressure(pressure):
-    return struct.pack("<H", int(pressure * 100))  # Encode pressure with two decimal places
+# every channel value is packed in the wire format of its channel_schema entry
 
 
-def _encode_humidity(humidity):
-    return struct.pack("<H", int(humidity * 100))  # Encode humidity with two decimal places
+# copies data[start:start + length] (all of it by default) into buffer at offset without slicing data,
+# returns the offset after it
+def _copy_into(buffer, offset, data, start=0, length=None):
+    if length is None:
+        length = len(data) - start
+    if start == 0 and length == len(data):
+        buffer[offset:offset + length] = data
+    elif length > 0:
+        for i in range(length):
+            buffer[offset + i] = data[start + i]
+    return offset + max(length, 0)
 ################################## ENCODING UTILS END ##################################
 
 ############################# SENSOR TASK FOR COLLECTING THE SENSOR STATS #################
 async def sensor_task():
-    # global temperature_values  # Declare the variable as global
-    global temperature_values, pressure_values, humidity_values  # Declare the variable as global
-    global avg_temperature, min_temperature, max_temperature
-    global avg_pressure, min_pressure, max_pressure
-    global avg_humidity, min_humidity, max_humidity
-    global hum_aggr_packed, pres_aggr_packed, temp_aggr_packed, time_series_packed
+    global hum_aggr_packed, pres_aggr_packed, temp_aggr_packed, time_series_packed, sample_seq, gas_resistance
+    pres_aggr_view = memoryview(_pres_aggr_buffer)
+    temp_aggr_view = memoryview(_temp_aggr_buffer)
+    hum_aggr_view = memoryview(_hum_aggr_buffer)
+    time_series_view = memoryview(_time_series_buffer)
     while True:
         try:
-            # Simulate pressure and humidity for testing
-            p = bme_sensor.pressure
-            h = bme_sensor.humidity
-
-            t = bme_sensor.temperature
-
-            # Print sensor values for debugging
-            print("Temperature:", t)
-            print("Pressure:", p)
-            print("Humidity:", h)
-
-            # Update statistics
-            temperature_values.append(t)
-            print("reached Values.appent")
-            if len(temperature_values) > 10:
-                temperature_values = temperature_values[-10:]
-
-            avg_temperature = sum(temperature_values) / len(temperature_values)
-            min_temperature = min(min_temperature, t)
-            print("reached avg min max")
-            max_temperature = max(max_temperature, t)
-
-
-            pressure_values.append(p)
-            if len(pressure_values) > 10:
-                pressure_values = pressure_values[-10:]
-
-            avg_pressure = sum(pressure_values) / len(pressure_values)
-            min_pressure = min(min_pressure, p)
-            max_pressure = max(max_pressure, p)
-
-
-            humidity_values.append(h)
-            if len(humidity_values) > 10:
-                humidity_values = humidity_values[-10:]
-
-            avg_humidity = sum(humidity_values) / len(humidity_values)
-            min_humidity = min(min_humidity, h)
-            max_humidity = max(max_humidity, h)
-
-            print("Average Temperature:", avg_temperature)
-            print("Min Temperature:", min_temperature)
-            print("Max Temperature:", max_temperature)
-            print("Average Pressure:", avg_pressure)
-            print("Min Pressure:", min_pressure)
-            print("Max Pressure:", max_pressure)
-            print("Average Humidity:", avg_humidity)
-            print("Min Humidity:", min_humidity)
-            print("Max Humidity:", max_humidity)
-
-            hum_aggr_packed = _encode_humidity(avg_humidity) + _encode_humidity(min_humidity) + _encode_humidity(
-                max_humidity)
-            pres_aggr_packed = _encode_pressure(avg_pressure) + _encode_pressure(min_pressure) + _encode_pressure(
-                max_pressure)
-            temp_aggr_packed = _encode_temperature(avg_temperature) + _encode_temperature(
-                min_temperature) + _encode_temperature(max_temperature)
-            time_series_packed = struct.pack("<10H", *map(lambda x: int(x * 100), humidity_values)) + struct.pack(
-                "<10H", *map(lambda x: int(x * 100), temperature_values)) + struct.pack("<10H",
-                                                                                        *map(lambda x: int(x * 10),
-                                                                                             pressure_values))
-            await asyncio.sleep(0.1)
+            # one forced-mode measurement, all channels from a single burst read
+            start_us = ticks_us()
+            t, p, h, gas_resistance = await bme_sensor.measure()
+            telemetry.record(STAGE_SENSOR_READ, start_us)
+            now = ticks_ms()
+            start_us = ticks_us()
+            sample_meter.start()
+
+            if DEBUG:
+                print("Temperature:", t)
+                print("Pressure:", p)
+                print("Humidity:", h)
+                print("Gas resistance:", gas_resistance)
+
+            # Update statistics of every scope
+            temperature_stats.push(t, now)
+            pressure_stats.push(p, now)
+            humidity_stats.push(h, now)
+            humidity_rollups.push(h, now)
+            temperature_rollups.push(t, now)
+            pressure_rollups.push(p, now)
+            sample_values[0] = h
+            sample_values[1] = t
+            sample_values[2] = p
+            sample_log.push(sample_seq, now, sample_values)
+            sample_seq += 1
+
+            if DEBUG:
+                print("Temperature avg/min/max:", temperature_stats.aggregate(SCOPE_LAST_N))
+                print("Pressure avg/min/max:", pressure_stats.aggregate(SCOPE_LAST_N))
+                print("Humidity avg/min/max:", humidity_stats.aggregate(SCOPE_LAST_N))
+
+            # the statistics take every sample, the payloads only change once a value moved past its deadband
+            if sampler.update(now, sample_values):
+                if sampler.due(HUMIDITY.channel_id):
+                    humidity_stats.pack_into(_hum_aggr_buffer, 0, HUMIDITY)
+                    hum_aggr_packed = hum_aggr_view
+                if sampler.due(PRESSURE.channel_id):
+                    pressure_stats.pack_into(_pres_aggr_buffer, 0, PRESSURE)
+                    pres_aggr_packed = pres_aggr_view
+                if sampler.due(TEMPERATURE.channel_id):
+                    temperature_stats.pack_into(_temp_aggr_buffer, 0, TEMPERATURE)
+                    temp_aggr_packed = temp_aggr_view
+                if len(humidity_values) >= TIME_SERIES_LENGTH:
+                    offset = humidity_values.pack_last_into(TIME_SERIES_LENGTH, _time_series_buffer, 0, HUMIDITY)
+                    offset = temperature_values.pack_last_into(TIME_SERIES_LENGTH, _time_series_buffer, offset,
+                                                               TEMPERATURE)
+                    pressure_values.pack_last_into(TIME_SERIES_LENGTH, _time_series_buffer, offset, PRESSURE)
+                    time_series_packed = time_series_view
+                telemetry.count(COUNTER_PUBLISHES)
+            sample_meter.stop()
+            telemetry.record(STAGE_ENCODE, start_us)
+            telemetry.count(COUNTER_SAMPLES)
+            telemetry.check_heap()
+            # jitter: how much later than asked the loop wakes up
+            period_ms = sampler.period_ms
+            start_us = ticks_us()
+            await asyncio.sleep_ms(period_ms)
+            telemetry.histograms[STAGE_LOOP_JITTER].record(ticks_diff(ticks_us(), start_us) - period_ms * 1000)
         except Exception as e:
             print("Exception in sensor_task:", e)
 
@@ -141,118 +218,919 @@ async def sensor_task():
 
 ##################################### BLE  FUNCTIONS ###################################
 
-#find BLE device
-async def find_temp_sensor():
-    async with aioble.scan(5000, interval_us=30000, window_us=30000, active=True) as scanner:
+# sensor nodes advertise a name starting with _SENSOR_NAME ("ble-sensor", "ble-sensor-2", ...). the pico W's
+# controller keeps a few connections at once, scans run for _REGISTRY_SCAN_MS every _REGISTRY_IDLE_MS
+_SENSOR_NAME = "ble-sensor"
+_MAX_SENSOR_NODES = 4
+_REGISTRY_SCAN_MS = 5000
+_REGISTRY_IDLE_MS = 10000
+# device ids: 0x01 is the central's own i2c sensor, sensor nodes are numbered from 0x02 on
+_I2C_DEVICE_ID = 0x01
+_FIRST_NODE_DEVICE_ID = 0x02
+_DEVICE_TYPE_I2C = 0x01
+_DEVICE_TYPE_BLE = 0x02
+# scanning and connecting share the radio, only one of them runs at a time
+_radio_lock = asyncio.Lock()
+
+
+#find the advertising sensor nodes whose address is not in known, returns {address: device}
+async def find_sensor_nodes(known):
+    found = {}
+    async with aioble.scan(_REGISTRY_SCAN_MS, interval_us=30000, window_us=30000, active=True) as scanner:
         async for result in scanner:
-            if result.name() == "ble-sensor" and _ENV_SENSE_UUID in result.services():
-                return result.device
-    return None
+            name = result.name()
+            if name and name.startswith(_SENSOR_NAME) and _ENV_SENSE_UUID in result.services():
+                address = bytes(result.device.addr)
+                if address not in known:
+                    found[address] = result.device
+    return found
+
 
-#connect to the characterestic and fetch the result based on command id of service
-async def connect_ble(characteristic_command):
-    device = await find_temp_sensor()
-    connection = await device.connect()
-    result = []
-    async with connection:
+# characteristic backing each command id
+_BLE_COMMAND_CHARACTERISTICS = {
+    0x02: _ENV_SENSE_HUM_AGGR_UUID,
+    0x03: _ENV_SENSE_PRES_AGGR_UUID,
+    0x04: _ENV_SENSE_TEMP_AGGR_UUID,
+    0x05: _ENV_SENSE_SERIES_UUID,
+}
+# reconnect backoff bounds and timeout of the initial cache reads for the BLE link (ms)
+_BLE_RECONNECT_MIN_MS = 500
+_BLE_RECONNECT_MAX_MS = 30000
+_BLE_READ_TIMEOUT_MS = 1000
+# what a GATT operation on the link raises when the node does not answer, refuses it (ATT error) or drops out
+_BLE_ERRORS = (asyncio.TimeoutError, OSError, aioble.DeviceDisconnectedError, aioble.GattError)
+
+
+class BleSensorLink:
+    """
+    Long lived connection to one sensor node, registered as device_id by the SensorRegistry.
+    run() keeps the connection open and reconnects to the node's address with exponential
+    backoff when it drops.
+    After discovery every characteristic is subscribed for notifications and the latest payload
+    of each one is kept in self.cache, so requests are answered from memory without any radio
+    round-trip, the same way the I2C path answers from time_series_packed.
+    Stamped samples notified by the peripheral go to self.samples with their ticks_ms moved to
+    the central's clock, so the log outlives reconnects like the local sample_log.
+    The series window of command 0x0D is paged over the series page characteristic. So is the
+    cached time series when a notification holds fewer than TIME_SERIES_LENGTH samples per
+    channel, as one does at the default MTU when the MTU exchange failed.
+    """
+
+    def __init__(self, device_id, device):
+        self.device_id = device_id
+        self.device = device
+        self.connection = None
+        self.characteristics = {}
+        # latest payload per characteristic uuid, filled by the notification listeners
+        self.cache = {}
+        # history query/result characteristics, None when the peripheral firmware has no rollups
+        self.history_query = None
+        self.history_result = None
+        # stamped sample characteristic (None on older peripheral firmware), the samples it delivered,
+        # and the offset from the peripheral's ticks_ms to ours (None until the first sample)
+        self.sample_characteristic = None
+        self.samples = SampleLog(SAMPLE_LOG_LENGTH, len(CHANNELS))
+        self.tick_offset = None
+        # telemetry, sampling schedule and series page characteristics, None on older peripheral firmware
+        self.telemetry_characteristic = None
+        self.sampling_characteristic = None
+        self.series_page = None
+        # the encoded series window paged from the peripheral
+        self.series_window = bytearray(series_size(len(CHANNELS), _SERIES_WINDOW_MAX))
+        self.series_window_view = memoryview(self.series_window)
+        self.connected = asyncio.Event()
+        # aioble allows one outstanding GATT operation per connection, history paging holds it
+        self.lock = asyncio.Lock()
+
+    async def _discover(self, connection):
+        service = await connection.service(_ENV_SENSE_UUID)
+        if service is None:
+            raise OSError("environmental sensing service not found")
+        characteristics = {}
+        for uuid in _BLE_COMMAND_CHARACTERISTICS.values():
+            characteristic = await service.characteristic(uuid)
+            if characteristic is None:
+                raise OSError("characteristic not found: " + str(uuid))
+            characteristics[uuid] = characteristic
+        self.history_query = await service.characteristic(_ENV_SENSE_HISTORY_QUERY_UUID)
+        self.history_result = await service.characteristic(_ENV_SENSE_HISTORY_RESULT_UUID)
+        self.sample_characteristic = await service.characteristic(_ENV_SENSE_SAMPLE_UUID)
+        self.telemetry_characteristic = await service.characteristic(_ENV_SENSE_TELEMETRY_UUID)
+        self.sampling_characteristic = await service.characteristic(_ENV_SENSE_SAMPLING_UUID)
+        self.series_page = await service.characteristic(_ENV_SENSE_SERIES_PAGE_UUID)
+        print("Service and characteristics found")
+        return characteristics
+
+    # subscribe to every characteristic and seed the cache with one read each
+    async def _subscribe(self):
+        for uuid, characteristic in self.characteristics.items():
+            await characteristic.subscribe(notify=True)
+            self.cache[uuid] = await characteristic.read(timeout_ms=_BLE_READ_TIMEOUT_MS)
+        if self.history_result is not None:
+            await self.history_result.subscribe(notify=True)
+        if self.sample_characteristic is not None:
+            await self.sample_characteristic.subscribe(notify=True)
+        if self.telemetry_characteristic is not None:
+            await self.telemetry_characteristic.subscribe(notify=True)
+        if self.series_page is not None:
+            await self.series_page.subscribe(notify=True)
+            self.cache[_ENV_SENSE_SERIES_UUID] = await self._full_series(self.cache[_ENV_SENSE_SERIES_UUID])
+
+    # the series as read or notified, or paged when it was cut to fewer samples per channel than command 0x05
+    # answers with (one ATT payload at the default MTU holds only a few)
+    async def _full_series(self, data):
+        if len(data) >= 2 and data[1] < TIME_SERIES_LENGTH:
+            series = await self.read_series(TIME_SERIES_LENGTH)
+            if series is not None:
+                return bytes(series)
+        return data
+
+    async def _listen(self, uuid, characteristic):
         try:
-            temp_service = await connection.service(_ENV_SENSE_UUID)
-            if characteristic_command == 0x05:
-
-                temp_characteristic = await temp_service.characteristic(_ENV_SENSE_TEMP_UUID)
-                pres_chracterestic = await temp_service.characteristic(_ENV_SENSE_PRES_UUID)
-                hum_characterestic = await temp_service.characteristic(_ENV_SENSE_HUM_UUID)
-                print("Service and characteristic found")
-                result_temp = await temp_characteristic.read()
-                result_pres = await pres_chracterestic.read()
-                result_hum = await hum_characterestic.read()
-
-                # length_result_temp = len(result_temp)
-                result = result_hum + result_temp + result_pres
-
-                print("packed:", result)
-                print("unpacked :", list(struct.unpack("<30H", result)))
-            elif characteristic_command == 0x02:  # aggr_hum
-                aggr_characterestic = await temp_service.characteristic(_ENV_SENSE_HUM_AGGR_UUID)
-                result = await aggr_characterestic.read()
-
-            elif characteristic_command == 0x03:  # press_aggr
-                aggr_characterestic = await temp_service.characteristic(_ENV_SENSE_PRES_AGGR_UUID)
-                result = await aggr_characterestic.read()
-
-            elif characteristic_command == 0x04:  # temp_aggr
-                aggr_characterestic = await temp_service.characteristic(_ENV_SENSE_TEMP_AGGR_UUID)
-                result = await aggr_characterestic.read()
-
-        except asyncio.TimeoutError:
-            print("Timeout discovering services/characteristics")
+            while True:
+                data = await characteristic.notified()
+                if uuid == _ENV_SENSE_SERIES_UUID:
+                    data = await self._full_series(data)
+                self.cache[uuid] = data
+        except aioble.DeviceDisconnectedError:
             return
 
-        return result
+    # stamped samples in SAMPLE_STRUCT (seq, peripheral ticks_ms, humidity, temperature, pressure)
+    async def _listen_samples(self):
+        try:
+            while True:
+                data = await self.sample_characteristic.notified()
+                if len(data) != SAMPLE_STRUCT.size:
+                    continue
+                now = ticks_ms()
+                seq, sample_ms, humidity, temperature, pressure = SAMPLE_STRUCT.unpack(data)
+                # the smallest offset seen is the one with the least notification latency. it creeps up
+                # by 1 ms per sample so it follows the peripheral's clock if that one runs slow
+                offset = ticks_diff(now, sample_ms)
+                if self.tick_offset is None or offset < self.tick_offset:
+                    self.tick_offset = offset
+                else:
+                    self.tick_offset += 1
+                self.samples.push(seq, ticks_add(sample_ms, self.tick_offset), (
+                    HUMIDITY.decode(humidity), TEMPERATURE.decode(temperature), PRESSURE.decode(pressure)))
+        except aioble.DeviceDisconnectedError:
+            return
+
+    async def run(self):
+        backoff_ms = _BLE_RECONNECT_MIN_MS
+        while True:
+            listeners = []
+            try:
+                async with _radio_lock:
+                    connection = await self.device.connect(timeout_ms=2000)
+                self.connection = connection
+                try:
+                    await connection.exchange_mtu(_BLE_MTU)
+                except (asyncio.TimeoutError, OSError, aioble.GattError) as e:
+                    # payloads stay at the default 20 bytes
+                    print("MTU exchange failed:", e)
+                self.characteristics = await self._discover(connection)
+                await self._subscribe()
+                for uuid, characteristic in self.characteristics.items():
+                    listeners.append(asyncio.create_task(self._listen(uuid, characteristic)))
+                if self.sample_characteristic is not None:
+                    listeners.append(asyncio.create_task(self._listen_samples()))
+                self.connected.set()
+                backoff_ms = _BLE_RECONNECT_MIN_MS
+                print("BLE sensor", self.device_id, "connected")
+                await connection.disconnected(timeout_ms=None)
+                print("BLE sensor", self.device_id, "disconnected")
+            except _BLE_ERRORS as e:
+                print("Exception in BleSensorLink", self.device_id, ":", e)
+            except Exception as e:
+                # anything else (a malformed payload) is handled like a dropped link, the link never gives up
+                print("Unexpected exception in BleSensorLink", self.device_id, ":", e)
+                telemetry.count(COUNTER_ERRORS)
+            for listener in listeners:
+                listener.cancel()
+            if self.connection is not None and self.connection.is_connected():
+                # a node only advertises again once it is disconnected
+                try:
+                    await self.connection.disconnect()
+                except _BLE_ERRORS as e:
+                    print("Exception in BleSensorLink", self.device_id, ":", e)
+            if self.connected.is_set():
+                telemetry.count(COUNTER_RECONNECTS)
+            self.connected.clear()
+            self.connection = None
+            self.characteristics = {}
+            self.history_query = None
+            self.history_result = None
+            self.sample_characteristic = None
+            self.telemetry_characteristic = None
+            self.sampling_characteristic = None
+            self.series_page = None
+            # a new connection may mean a rebooted peripheral with a different clock
+            self.tick_offset = None
+            # never answer from a cache that stopped receiving updates
+            self.cache = {}
+            await asyncio.sleep_ms(backoff_ms)
+            backoff_ms = min(backoff_ms * 2, _BLE_RECONNECT_MAX_MS)
+
+    # one history page: (age of the filling bucket in ms, buckets holding data, packed buckets newest first)
+    async def _history_page(self, channel, tier, offset, count):
+        await self.history_query.write(struct.pack("<BBHB", channel, tier, offset, min(count, 0xFF)), True)
+        while True:
+            page = await self.history_result.notified(timeout_ms=_BLE_READ_TIMEOUT_MS)
+            if len(page) < 10:
+                raise OSError("short history page")
+            age_ms, page_offset, page_channel, page_tier, filled, page_count = struct.unpack("<IHBBBB", page[:10])
+            # skip pages answering an earlier query that timed out
+            if (page_offset, page_channel, page_tier) == (offset, channel, tier):
+                return age_ms, filled, page[10:10 + page_count * BUCKET_SIZE]
+
+    # buckets of a peripheral rollup tier overlapping the ages [end_ago_ms, start_ago_ms], paged over the
+    # history characteristics into buffer at buffer_offset (as many as fit), newest first.
+    # returns (age of the newest returned bucket in ms, buckets), or None when unavailable
+    async def history(self, channel, tier, start_ago_ms, end_ago_ms, buffer, buffer_offset):
+        if not self.connected.is_set() or self.history_result is None:
+            return None
+        bucket_ms = ROLLUP_TIERS[tier][0]
+        start_us = ticks_us()
+        try:
+            async with self.lock:
+                age_ms, filled, page = await self._history_page(channel, tier, 0, 1)
+                first, last = bucket_offsets(age_ms, bucket_ms, filled, start_ago_ms, end_ago_ms)
+                # the last byte of the buffer is kept for the error id
+                last = min(last, first + (len(buffer) - 1 - buffer_offset) // BUCKET_SIZE)
+                offset = first
+                while offset < last:
+                    _, _, page = await self._history_page(channel, tier, offset, last - offset)
+                    if not page:
+                        break
+                    buffer_offset = _copy_into(buffer, buffer_offset, page)
+                    offset += len(page) // BUCKET_SIZE
+        except _BLE_ERRORS as e:
+            print("Exception in BleSensorLink.history:", e)
+            return None
+        telemetry.record(STAGE_BLE_READ, start_us)
+        return age_ms + first * bucket_ms, offset - first
+
+    # one telemetry page: (payload length, bytes of the payload from payload_offset)
+    async def _telemetry_page(self, payload_offset):
+        await self.telemetry_characteristic.write(struct.pack("<H", payload_offset), True)
+        while True:
+            page = await self.telemetry_characteristic.notified(timeout_ms=_BLE_READ_TIMEOUT_MS)
+            if len(page) < 4:
+                raise OSError("short telemetry page")
+            page_offset, length = struct.unpack("<HH", page[:4])
+            # skip pages answering an earlier query that timed out
+            if page_offset == payload_offset:
+                return length, page[4:]
+
+    # pages the peripheral's telemetry payload over the telemetry characteristic into buffer at offset, returns
+    # the offset after it or None when unavailable or when the pages do not add up to the payload
+    async def read_telemetry(self, buffer, offset):
+        if not self.connected.is_set() or self.telemetry_characteristic is None:
+            return None
+        start_us = ticks_us()
+        received = 0
+        try:
+            async with self.lock:
+                length, page = await self._telemetry_page(0)
+                # the last byte of the buffer is kept for the error id
+                if length > len(buffer) - 1 - offset:
+                    return None
+                while page and received + len(page) <= length:
+                    _copy_into(buffer, offset + received, page)
+                    received += len(page)
+                    if received == length:
+                        break
+                    _, page = await self._telemetry_page(received)
+        except _BLE_ERRORS as e:
+            print("Exception in BleSensorLink.read_telemetry:", e)
+            return None
+        telemetry.record(STAGE_BLE_READ, start_us)
+        if received != length:
+            print("Telemetry of BLE sensor", self.device_id, "incomplete:", received, "of", length, "bytes")
+            return None
+        return offset + length
+
+    # one series page: (encoded series length, bytes of the encoded series from series_offset)
+    async def _series_page(self, series_offset, samples):
+        await self.series_page.write(struct.pack("<HH", series_offset, samples), True)
+        while True:
+            page = await self.series_page.notified(timeout_ms=_BLE_READ_TIMEOUT_MS)
+            if len(page) < 4:
+                raise OSError("short series page")
+            page_offset, length = struct.unpack("<HH", page[:4])
+            # skip pages answering an earlier query that timed out
+            if page_offset == series_offset:
+                return length, page[4:]
+
+    # pages the newest `samples` samples per channel of the peripheral's encoded series (0 for all it holds) over
+    # the series page characteristic into self.series_window. returns a view of the encoded series, None when
+    # unavailable or when the pages do not add up to it
+    async def read_series(self, samples):
+        if self.series_page is None:
+            return None
+        start_us = ticks_us()
+        received = 0
+        try:
+            async with self.lock:
+                length, page = await self._series_page(0, samples)
+                if length > len(self.series_window):
+                    return None
+                while page and received + len(page) <= length:
+                    _copy_into(self.series_window, received, page)
+                    received += len(page)
+                    if received == length:
+                        break
+                    _, page = await self._series_page(received, samples)
+        except _BLE_ERRORS as e:
+            print("Exception in BleSensorLink.read_series:", e)
+            return None
+        telemetry.record(STAGE_BLE_READ, start_us)
+        if received != length:
+            print("Series of BLE sensor", self.device_id, "incomplete:", received, "of", length, "bytes")
+            return None
+        return self.series_window_view[:length]
+
+    # up to `samples` samples per channel of the peripheral's whole series, the newest skip left out, into buffer
+    # at offset (see series_window()). returns (samples per channel, samples held per channel) or None when
+    # unavailable
+    async def window(self, samples, skip, buffer, offset):
+        if not self.connected.is_set():
+            return None
+        series = await self.read_series(0)
+        if series is None:
+            return None
+        return unpack_window_into(series, samples, skip, buffer, offset, CHANNELS)[1], series[1]
+
+    # sets one channel's sampling schedule on the peripheral from params [channel, min_period_ms, max_period_ms,
+    # deadband] when given, then reads every channel's schedule into buffer at offset. returns the offset after
+    # it, None when unavailable or False when the peripheral did not take the params
+    async def sampling(self, params, buffer, offset):
+        if not self.connected.is_set() or self.sampling_characteristic is None:
+            return None
+        start_us = ticks_us()
+        try:
+            async with self.lock:
+                if params is not None:
+                    await self.sampling_characteristic.write(struct.pack(WRITE_FORMAT, *params[:4]), True)
+                data = await self.sampling_characteristic.read(timeout_ms=_BLE_READ_TIMEOUT_MS)
+        except _BLE_ERRORS as e:
+            print("Exception in BleSensorLink.sampling:", e)
+            return None
+        telemetry.record(STAGE_BLE_READ, start_us)
+        if len(data) > len(buffer) - 1 - offset:
+            return None
+        if params is not None and not _schedule_applied(data, 0, params):
+            return False
+        return _copy_into(buffer, offset, data)
+
+    # copies the cached payload for the command id into buffer at offset. start and length pick part of it
+    # (one scope of an aggregation). returns the offset after it, None when unavailable
+    def copy_payload(self, characteristic_command, buffer, offset, start=0, length=None):
+        uuid = _BLE_COMMAND_CHARACTERISTICS.get(characteristic_command)
+        if uuid is None or not self.connected.is_set() or self.cache.get(uuid) is None:
+            return None
+        if characteristic_command == 0x05:
+            # the newest TIME_SERIES_LENGTH values of each channel of the delta encoded series, as the same
+            # blocks the i2c sensor answers with. nothing until the peripheral holds that many samples
+            return unpack_series_into(self.cache[uuid], TIME_SERIES_LENGTH, buffer, offset, CHANNELS)
+        return _copy_into(buffer, offset, self.cache[uuid], start, length)
+
+
+class SensorRegistry:
+    """
+    Discovers, numbers and keeps connected every advertising sensor node.
+    run() scans for nodes named _SENSOR_NAME* that advertise the environmental sensing service,
+    gives every new one the next device id from _FIRST_NODE_DEVICE_ID on and starts its
+    BleSensorLink on a task of its own, so the nodes are connected, subscribed and read
+    concurrently. Device ids stay with the node's address until the central reboots, a node that
+    drops out keeps its id and its link reconnects to it. Scans stop once _MAX_SENSOR_NODES are
+    registered; nodes only advertise while they have no central, so connected ones never show up.
+    """
+
+    def __init__(self):
+        # device id -> BleSensorLink, and node address -> device id
+        self.links = {}
+        self.addresses = {}
+        self.next_device_id = _FIRST_NODE_DEVICE_ID
+
+    # the link of a sensor node, None for unknown device ids
+    def link(self, device_id):
+        return self.links.get(device_id)
+
+    # every device id the central answers for, its own sensor first
+    def device_ids(self):
+        return [_I2C_DEVICE_ID] + sorted(self.links)
+
+    def register(self, address, device):
+        device_id = self.next_device_id
+        self.next_device_id += 1
+        link = BleSensorLink(device_id, device)
+        self.links[device_id] = link
+        self.addresses[address] = device_id
+        asyncio.create_task(link.run())
+        print("Registered sensor node", device_id, device)
+
+    async def run(self):
+        while True:
+            if len(self.links) < _MAX_SENSOR_NODES:
+                try:
+                    async with _radio_lock:
+                        found = await find_sensor_nodes(self.addresses)
+                    for address, device in found.items():
+                        if len(self.links) >= _MAX_SENSOR_NODES:
+                            break
+                        self.register(address, device)
+                except (asyncio.TimeoutError, OSError) as e:
+                    print("Exception in SensorRegistry:", e)
+            await asyncio.sleep_ms(_REGISTRY_IDLE_MS)
+
+    # packs one <BBBB6s entry per device (device id, device type id, 0x01 when connected, address type,
+    # address) into buffer at offset, as many as fit. returns (entries, offset after them)
+    def pack_into(self, buffer, offset):
+        # the last byte of the buffer is kept for the error id
+        if offset + 10 > len(buffer) - 1:
+            return 0, offset
+        struct.pack_into("<BBBB6s", buffer, offset, _I2C_DEVICE_ID, _DEVICE_TYPE_I2C, 0x01, 0x00, b'')
+        offset += 10
+        count = 1
+        for device_id in sorted(self.links):
+            if offset + 10 > len(buffer) - 1:
+                break
+            link = self.links[device_id]
+            struct.pack_into("<BBBB6s", buffer, offset, device_id, _DEVICE_TYPE_BLE,
+                             0x01 if link.connected.is_set() else 0x00, link.device.addr_type, bytes(link.device.addr))
+            offset += 10
+            count += 1
+        return count, offset
+
+
+registry = SensorRegistry()
 ################################### BLE  FUNCTIONS END ###################################
 
 
 
 ############################### ADAPTER FUNCTION ############################################
 
-# Takes in the custom protocol ids and returns the result. this abstarcts the caller from
-#the communication interface of the sensor
-async def sensor_operation(device_id, device_type_id, operation_id, command_id, param_arr, temp_characteristic):
-    global hum_aggr_packed, pres_aggr_packed, temp_aggr_packed
-    response_payload = b''
-    result = b''
+# commands covered by the snapshot command (0x06), for every registered device when no device ids are passed
+_SNAPSHOT_COMMANDS = (0x02, 0x03, 0x04, 0x05)
+# most bytes of one device's snapshot: a 4 byte header per section, three 6 byte aggregates and the time series
+_SNAPSHOT_DEVICE_SIZE = 4 * len(_SNAPSHOT_COMMANDS) + 3 * 6 + VALUES_SIZE * TIME_SERIES_LENGTH
+
+
+# copies the latest packed result of an aggregation (the 3 values of the scope) or time series command
+# into buffer at offset. returns the offset after it, None when the sensor is not reachable
+def copy_command_payload(buffer, offset, device_id, command_id, scope=SCOPE_LAST_N):
+    start, length = 0, None
+    if command_id in (0x02, 0x03, 0x04):
+        start, length = 6 * AGGREGATION_SCOPES.index(scope), 6
+    if device_id == _I2C_DEVICE_ID:
+        if command_id == 0x02:
+            result = hum_aggr_packed
+        elif command_id == 0x03:
+            result = pres_aggr_packed
+        elif command_id == 0x04:
+            result = temp_aggr_packed
+        elif command_id == 0x05:
+            result = time_series_packed
+        else:
+            return None
+        if not result:
+            return offset
+        return _copy_into(buffer, offset, result, start, length)
+    link = registry.link(device_id)
+    if link is None:
+        return None
+    return link.copy_payload(command_id, buffer, offset, start, length)
+
+
+# buckets of a rollup tier overlapping the ages [end_ago_ms, start_ago_ms], packed into buffer at offset
+# (as many as fit), newest first: (age of the newest returned bucket in ms, buckets), None when the sensor
+# is not reachable
+async def history_buckets(buffer, offset, device_id, channel, tier, start_ago_ms, end_ago_ms):
+    if device_id == _I2C_DEVICE_ID:
+        rollup_tier = _HISTORY_CHANNELS[channel].tiers[tier]
+        now = ticks_ms()
+        first, last = rollup_tier.offsets(start_ago_ms, end_ago_ms, now)
+        if first == last:
+            return 0, 0
+        # the last byte of the buffer is kept for the error id
+        last = min(last, first + (len(buffer) - 1 - offset) // BUCKET_SIZE)
+        for bucket_offset in range(first, last):
+            rollup_tier.pack_bucket_into(buffer, offset, bucket_offset)
+            offset += BUCKET_SIZE
+        return rollup_tier.age_ms(first, now), last - first
+    link = registry.link(device_id)
+    if link is None:
+        return None
+    return await link.history(channel, tier, start_ago_ms, end_ago_ms, buffer, offset)
+
+
+# up to `samples` samples per channel (0 for as many as the buffer fits), the newest skip left out, packed into
+# buffer at offset as humidity, temperature and pressure blocks, oldest first: (samples per channel, samples held
+# per channel), None when the sensor is not reachable. the central's own sensor holds its last-N windows
+async def series_window(buffer, offset, device_id, samples, skip):
+    # the last byte of the buffer is kept for the error id
+    fit = (len(buffer) - 1 - offset) // VALUES_SIZE
+    samples = min(samples, fit) if samples else fit
+    if device_id == _I2C_DEVICE_ID:
+        held = len(humidity_values)
+        offset = humidity_values.pack_last_into(samples, buffer, offset, HUMIDITY, skip)
+        offset = temperature_values.pack_last_into(samples, buffer, offset, TEMPERATURE, skip)
+        pressure_values.pack_last_into(samples, buffer, offset, PRESSURE, skip)
+        return max(min(samples, held - skip), 0), held
+    link = registry.link(device_id)
+    if link is None:
+        return None
+    return await link.window(samples, skip, buffer, offset)
+
+
+# stamped samples with sequence numbers >= since_seq packed into buffer at offset (as many as fit):
+# (samples, sequence number to ask for next time, sequence number after the newest sample held),
+# None when the sensor is not reachable
+def samples_since(buffer, offset, device_id, since_seq):
+    if device_id == _I2C_DEVICE_ID:
+        log = sample_log
+    else:
+        link = registry.link(device_id)
+        if link is None or not link.connected.is_set() or link.sample_characteristic is None:
+            return None
+        log = link.samples
+    # the last byte of the buffer is kept for the error id
+    limit = min(_SINCE_MAX_SAMPLES, (len(buffer) - 1 - offset) // (4 + VALUES_SIZE))
+    count, next_seq = log.pack_since_into(buffer, offset, since_seq, limit, ticks_ms(), CHANNELS)
+    return count, next_seq, log.next_seq
+
+
+# sets one channel's sampling schedule from params [channel, min_period_ms, max_period_ms, deadband] when given,
+# then packs the schedule of every channel into buffer at offset. returns the offset after it, None when the
+# sensor is not reachable, False when the params were refused
+async def sampling_schedule(buffer, offset, device_id, params):
+    # what AdaptiveSampler.configure() refuses whatever the device, each device checks its fastest period itself
+    if params is not None and (len(params) < 4 or params[0] >= len(CHANNELS) or params[2] < params[1]):
+        return False
+    if device_id == _I2C_DEVICE_ID:
+        if params is not None and not sampler.configure(*params[:4]):
+            return False
+        return sampler.pack_into(buffer, offset)
+    link = registry.link(device_id)
+    if link is None:
+        return None
+    return await link.sampling(params, buffer, offset)
+
 
-    if command_id == 0x05:
-        nresults = 0x1e
+# whether the sampling schedule entries at offset hold the write params [channel, min_period_ms, max_period_ms,
+# deadband]
+def _schedule_applied(data, offset, params):
+    for _ in range(len(CHANNELS)):
+        if offset + ENTRY_SIZE > len(data):
+            break
+        entry = struct.unpack_from(ENTRY_FORMAT, data, offset)
+        if entry[0] == params[0]:
+            return entry[1] == params[1] and entry[2] == params[2] and entry[3] == params[3]
+        offset += ENTRY_SIZE
+    return False
+
+
+# aggregation scope selected by params [scope, length], None when it is not kept on the device.
+# length 0 means the configured length, no params selects the last-N scope
+def aggregation_scope(param_arr):
+    if not param_arr:
+        return SCOPE_LAST_N
+    scope = param_arr[0]
+    length = param_arr[1] if len(param_arr) > 1 else 0
+    if scope == SCOPE_LIFETIME:
+        return scope
+    elif scope == SCOPE_LAST_N and length in (0, SAMPLE_WINDOW):
+        return scope
+    elif scope == SCOPE_LAST_T and length in (0, TIME_WINDOW_S):
+        return scope
+    return None
+
+
+# Takes in the custom protocol ids and packs the result into the response buffer after its 7 header bytes:
+# nresults, unit id, the results and the error id. returns the length of the response. this abstarcts
+# the caller from the communication interface of the sensor
+async def sensor_operation(device_id, device_type_id, operation_id, command_id, param_arr, response):
+    # results start after the header, nresults and unit id
+    offset = 9
+
+    if operation_id == _OPERATION_WRITE and command_id != 0x0C:
+        # error id 0x02: the command can only be read, no results follow
+        nresults = 0x00
+        unit_id = 0x00
+        error_id = 0x02
+
+    elif command_id == 0x05:
         unit_id = 0x02
         error_id = 0x00
-        if device_id == 0x02:
-            result = await connect_ble(command_id)
-        elif device_id == 0x01:
-            result = time_series_packed
+        series_end = copy_command_payload(response, offset, device_id, command_id)
+        # up to TIME_SERIES_LENGTH 2 byte values per channel, none until that many samples were taken
+        nresults = 0x00 if series_end is None else (series_end - offset) // 2
+        offset = series_end
 
     elif command_id in (0x02, 0x03, 0x04):
         nresults = 0x03
         unit_id = 0x02  # for array
         error_id = 0x00
-        print("entered aggregation")
-        if device_id == 0x02:
-            result += await connect_ble(command_id)
-        elif device_id == 0x01:
-            if command_id == 0x02:
-                print("hum :", hum_aggr_packed)
-                result += hum_aggr_packed
-            elif command_id == 0x03:
-                print("pres :", pres_aggr_packed)
-                result += pres_aggr_packed
-            elif command_id == 0x04:
-                print("temp :", temp_aggr_packed)
-                result += temp_aggr_packed
-                print("unpacked:", struct.unpack("<3H", result))
-    print("result", result)
-    response_payload = bytes([nresults, unit_id]) + bytes(result) + bytes([error_id])
-
-    return response_payload
+        if DEBUG:
+            print("entered aggregation")
+        scope = aggregation_scope(param_arr)
+        if scope is None:
+            # error id 0x03: requested params not supported by the device (scope not kept), no results follow
+            nresults = 0x00
+            error_id = 0x03
+        else:
+            offset = copy_command_payload(response, offset, device_id, command_id, scope)
+
+    elif command_id == 0x06:
+        # snapshot: every aggregate and the time series of the requested devices in one response.
+        # each section is [device_id, command_id, nvalues, error_id] followed by nvalues 2 byte values
+        nresults = 0x00
+        unit_id = 0x03  # for sections
+        error_id = 0x00
+        snapshot_devices = param_arr or registry.device_ids()
+        # the last byte of the response is kept for the error id
+        if len(snapshot_devices) > (len(response) - 1 - offset) // _SNAPSHOT_DEVICE_SIZE:
+            # error id 0x03: more device ids than the sections of the response buffer fit, no results follow
+            snapshot_devices = ()
+            error_id = 0x03
+        for i in range(len(snapshot_devices)):
+            snapshot_device = snapshot_devices[i]
+            if snapshot_devices.index(snapshot_device) != i:
+                # a device id repeated in the params gets its sections once
+                continue
+            for snapshot_command in _SNAPSHOT_COMMANDS:
+                response[offset] = snapshot_device
+                response[offset + 1] = snapshot_command
+                section_end = copy_command_payload(response, offset + 4, snapshot_device, snapshot_command)
+                if section_end is None:
+                    response[offset + 2] = 0x00
+                    response[offset + 3] = 0x01
+                    offset += 4
+                else:
+                    response[offset + 2] = (section_end - offset - 4) // 2
+                    response[offset + 3] = 0x00
+                    offset = section_end
+                nresults += 1
+
+    elif command_id == 0x07:
+        # history: buckets of one channel's rollup tier over an age range, newest first.
+        # params [channel, tier, start_ago_s, end_ago_s (optional, default 0)], result <IIB (bucket ms,
+        # age of the newest returned bucket in ms, channel) followed by nresults buckets (min, avg and max in
+        # the channel's wire format, <H count)
+        nresults = 0x00
+        unit_id = 0x04  # for rollup buckets
+        error_id = 0x00
+        if (not param_arr or len(param_arr) < 3 or param_arr[0] >= len(_HISTORY_CHANNELS)
+                or param_arr[1] >= len(ROLLUP_TIERS)):
+            # error id 0x03: requested params not supported by the device, no results follow
+            error_id = 0x03
+        else:
+            channel, tier, start_ago_s = param_arr[0], param_arr[1], param_arr[2]
+            end_ago_s = param_arr[3] if len(param_arr) > 3 else 0
+            history = await history_buckets(response, offset + 9, device_id, channel, tier,
+                                            start_ago_s * 1000, end_ago_s * 1000)
+            if history is None:
+                offset = None
+            else:
+                newest_age_ms, nresults = history
+                struct.pack_into("<IIB", response, offset, ROLLUP_TIERS[tier][0], newest_age_ms, channel)
+                offset += 9 + nresults * BUCKET_SIZE
+
+    elif command_id == 0x08:
+        # incremental time series: the stamped samples with sequence numbers >= params [since_seq]
+        # (0 or no params for every sample held), oldest first. result <II (since_seq for the next request,
+        # sequence number after the newest sample held: more samples are pending while the first is smaller)
+        # followed by nresults samples: <I age ms, then humidity, temperature and pressure
+        nresults = 0x00
+        unit_id = 0x05  # for stamped samples
+        error_id = 0x00
+        since_seq = param_arr[0] if param_arr else 0
+        samples = samples_since(response, offset + 8, device_id, since_seq)
+        if samples is None:
+            offset = None
+        else:
+            nresults, next_seq, latest_seq = samples
+            struct.pack_into("<II", response, offset, next_seq, latest_seq)
+            offset += 8 + nresults * (4 + VALUES_SIZE)
+
+    elif command_id == 0x09 and device_id == _I2C_DEVICE_ID:
+        # allocation meters of the central: result <II (gc.mem_alloc(), gc.mem_free()) followed by nresults
+        # <IIII meters (bytes allocated by the last measured run, most by any run, runs measured, runs a
+        # collection interrupted), the sample meter of sensor_task first and then the request meter
+        nresults = len(_ALLOC_METERS)
+        unit_id = 0x06  # for allocation meters
+        error_id = 0x00
+        struct.pack_into("<II", response, offset, gc.mem_alloc(), gc.mem_free())
+        offset += 8
+        for meter in _ALLOC_METERS:
+            offset = meter.pack_into(response, offset)
+
+    elif command_id == 0x0A:
+        # telemetry: stage latency histograms, counters and heap figures of the device, laid out as described
+        # in telemetry.py, nresults is the number of stages. the peripheral's is read over the BLE link
+        nresults = STAGES
+        unit_id = 0x07  # for telemetry
+        error_id = 0x00
+        link = registry.link(device_id)
+        if device_id == _I2C_DEVICE_ID:
+            offset = telemetry.pack_into(response, offset)
+        elif link is not None:
+            offset = await link.read_telemetry(response, offset)
+        else:
+            offset = None
+
+    elif command_id == 0x0B:
+        # channel schema (channel_schema.py) the values of every other command are packed with: result <B version
+        # followed by nresults <BBIi entries (channel id, width code, scale, offset). the same for every device
+        nresults = len(CHANNELS)
+        unit_id = 0x09  # for the schema
+        error_id = 0x00
+        offset = pack_schema_into(response, offset)
+
+    elif command_id == 0x0D:
+        # series window: the time series over all a device holds, longer than command 0x05's on the sensor nodes.
+        # params [samples (0 or none for as many as fit), skip (the newest samples left out, to page back through a
+        # window longer than one response)], result <H (samples held per channel) followed by humidity, temperature
+        # and pressure blocks of nresults values each, oldest first
+        nresults = 0x00
+        unit_id = 0x0B  # for series windows
+        error_id = 0x00
+        samples = param_arr[0] if param_arr else 0
+        skip = param_arr[1] if param_arr and len(param_arr) > 1 else 0
+        window = await series_window(response, offset + 2, device_id, samples, skip)
+        if window is None:
+            offset = None
+        else:
+            nresults, held = window
+            struct.pack_into("<H", response, offset, held)
+            offset += 2 + nresults * VALUES_SIZE
+
+    elif command_id == 0x0C:
+        # sampling schedule (sampling.py): a write with params [channel, min_period_ms, max_period_ms, deadband]
+        # sets one channel's, the deadband in the channel's wire integers. read and write answer with nresults
+        # <BIIII entries (channel id, min period ms, max period ms, deadband, current period ms)
+        nresults = len(CHANNELS)
+        unit_id = 0x0A  # for the sampling schedule
+        error_id = 0x00
+        params = param_arr if operation_id == _OPERATION_WRITE else None
+        if operation_id == _OPERATION_WRITE and (not params or len(params) < 4):
+            offset = False
+        else:
+            offset = await sampling_schedule(response, offset, device_id, params)
+        if offset is False:
+            # error id 0x03: params missing, or a channel, period or deadband the device refused
+            nresults = 0x00
+            error_id = 0x03
+            offset = 9
+
+    else:
+        # error id 0x02: command id not supported, no results follow
+        nresults = 0x00
+        unit_id = 0x00
+        error_id = 0x02
+    # error id 0x01: the sensor is not reachable right now (BLE link down), no results follow
+    if offset is None:
+        nresults = 0x00
+        error_id = 0x01
+        offset = 9
+    response[7] = nresults
+    response[8] = unit_id
+    response[offset] = error_id
+    if DEBUG:
+        print("result", bytes(response[9:offset]))
+    return offset + 1
+
+
+# answers a registry request (operation 0x03) into the response buffer after its 7 header bytes, returns the
+# length of the response. command 0x01 lists the devices: nresults <BBBB6s entries (device id, device type id,
+# 0x01 when connected, address type, address), the central's own sensor first, then the sensor nodes by id
+def registry_operation(command_id, response):
+    offset = 9
+    if command_id == 0x01:
+        unit_id = 0x08  # for registry entries
+        error_id = 0x00
+        nresults, offset = registry.pack_into(response, offset)
+    else:
+        # error id 0x02: command id not supported, no results follow
+        nresults = 0x00
+        unit_id = 0x00
+        error_id = 0x02
+    response[7] = nresults
+    response[8] = unit_id
+    response[offset] = error_id
+    return offset + 1
 ##################################### ADAPTER FUNCTION ###################################
 
 
 ############################ CUSTOM PROTOCOL COMMUNICATION #####################################
-def read_until(uart, delimiter=b'\n', max_bytes=256):
-    buffer = bytearray(max_bytes)
-    index = 0
+# size of the preallocated frame buffer and of each bulk read from the uart (bytes)
+_UART_FRAME_MAX = 256
+# size of each preallocated response buffer (bytes): a full history tier or _SINCE_MAX_SAMPLES samples fit
+_RESPONSE_MAX = 1024
+_UART_CHUNK = 64
+# framed requests handled concurrently before the reader waits for one to finish
+_MAX_INFLIGHT_REQUESTS = 8
+_NEWLINE_DELIMITER = 0x0A
+_COBS_DELIMITER = 0x00
+# operation ids (read, write, registry and the framed push subscriptions), subscriptions kept at once and the
+# fastest push period (ms)
+_OPERATION_READ = 0x01
+_OPERATION_WRITE = 0x02
+_OPERATION_REGISTRY = 0x03
+_OPERATION_SUBSCRIBE = 0x04
+_OPERATION_UNSUBSCRIBE = 0x05
+# the GUI's dashboard takes one snapshot subscription and one samples subscription per device: the central's
+# own sensor and every sensor node
+_MAX_SUBSCRIPTIONS = 2 + _MAX_SENSOR_NODES
+_SUBSCRIBE_MIN_PERIOD_MS = SAMPLE_PERIOD_MS
+# subscribe flags (second param): only push when the response differs from the last one pushed
+_SUBSCRIBE_ON_CHANGE = 0x01
 
-    while True:
-        byte = uart.read(1)
-        if byte == delimiter:
-            break
-        if byte:
-            buffer[index] = byte[0]
-            index += 1
 
-    return bytes(buffer[:index])
+class UartFrameReader:
+    """
+    Reads request frames from an asyncio.StreamReader over the uart.
+    0x00 always marks a frame boundary. The first byte after it selects the framing of that frame:
+    protocol id 0x01 starts a newline terminated frame, anything else is read up to the next 0x00
+    as a COBS frame (protocol id 0x02, whose COBS code byte is never 0x01 for a frame that fits
+    max_bytes). Garbage between frames therefore ends at the next 0x00 and fails decoding instead
+    of swallowing the frames behind it.
+    Bytes are pulled in bulk into a preallocated chunk buffer and copied into a preallocated
+    frame buffer, awaiting the stream between reads so other coroutines keep running while a
+    frame is on the wire. Frames longer than max_bytes are dropped, an overlong newline frame
+    at the next 0x00, and reading resynchronises on the next frame.
+    """
 
+    def __init__(self, stream, max_bytes=_UART_FRAME_MAX):
+        self.stream = stream
+        # delimiter of the frame being read, None between frames
+        self.delimiter = None
+        self.frame = bytearray(max_bytes)
+        self.frame_mv = memoryview(self.frame)
+        self.length = 0
+        self.overflow = False
+        self.chunk = bytearray(_UART_CHUNK)
+        self.chunk_mv = memoryview(self.chunk)
+        # unconsumed bytes of the last bulk read are chunk[start:end]
+        self.start = 0
+        self.end = 0
 
-async def process_request(request_command, temp_characteristic):
+    # returns (framed, frame): framed is True for a COBS frame, which still has to be decoded
+    async def read_frame(self):
+        while True:
+            while self.start < self.end:
+                if self.delimiter is None:
+                    first = self.chunk[self.start]
+                    if first == _COBS_DELIMITER:
+                        # frame boundary, consecutive 0x00s are empty frames
+                        while self.start < self.end and self.chunk[self.start] == _COBS_DELIMITER:
+                            self.start += 1
+                        continue
+                    self.delimiter = _NEWLINE_DELIMITER if first == PROTOCOL_NEWLINE else _COBS_DELIMITER
+                index = self.start
+                while index < self.end and self.chunk[index] != self.delimiter:
+                    index += 1
+                count = index - self.start
+                if self.length + count > len(self.frame):
+                    self.overflow = True
+                    if self.delimiter == _NEWLINE_DELIMITER:
+                        # no newline frame is this long: it was a stray 0x01, drop it at the next boundary
+                        self.delimiter = _COBS_DELIMITER
+                        continue
+                elif not self.overflow:
+                    self.frame_mv[self.length:self.length + count] = self.chunk_mv[self.start:index]
+                    self.length += count
+                if index == self.end:
+                    self.start = self.end
+                    break
+                # delimiter found, hand out the frame unless it overran the buffer
+                self.start = index + 1
+                framed = self.delimiter == _COBS_DELIMITER
+                length = self.length
+                overflow = self.overflow
+                self.delimiter = None
+                self.length = 0
+                self.overflow = False
+                if overflow:
+                    print("Dropped oversized uart frame")
+                    telemetry.count(COUNTER_DROPPED_FRAMES)
+                    continue
+                if framed and length == 0:
+                    continue
+                return framed, bytes(self.frame_mv[:length])
+            count = await self.stream.readinto(self.chunk)
+            self.start = 0
+            self.end = count or 0
+
+
+# answers a read, write or registry request into the response buffer, returns the length of the response or None
+async def process_request(request_command, response):
+    if len(request_command) < 8:
+        print("Dropped short uart frame")
+        telemetry.count(COUNTER_DROPPED_FRAMES)
+        return None
     protocol_id = request_command[0]
     channel_id = request_command[1]
     device_id = request_command[2]
@@ -260,40 +1138,261 @@ async def process_request(request_command, temp_characteristic):
     operation_id = request_command[4]
     command_id = struct.unpack("<h", request_command[5:7])[0]
     nparams = request_command[7]
+    # params follow the header as nparams <I values
+    if len(request_command) < 8 + 4 * nparams:
+        print("Dropped truncated uart frame")
+        telemetry.count(COUNTER_DROPPED_FRAMES)
+        return None
+    param_arr = struct.unpack("<%dI" % nparams, request_command[8:8 + 4 * nparams]) if nparams else None
 
-    if protocol_id == 0x01 and channel_id == 0x01 and operation_id == 0x01:
-        result_payload = await sensor_operation(device_id, device_type_id, operation_id, command_id, None,
-                                                temp_characteristic)
+    if (protocol_id in (PROTOCOL_NEWLINE, PROTOCOL_FRAMED) and channel_id == 0x01
+            and operation_id in (_OPERATION_READ, _OPERATION_WRITE)):
+        # the response repeats the request header
+        for i in range(7):
+            response[i] = request_command[i]
+        length = await sensor_operation(device_id, device_type_id, operation_id, command_id, param_arr, response)
 
-        headers = bytes([protocol_id, channel_id, device_id, device_type_id, operation_id]) + request_command[5:7]
+        if DEBUG:
+            print("Response Payload:", bytes(response[:length]))
+
+        return length
+
+    if protocol_id in (PROTOCOL_NEWLINE, PROTOCOL_FRAMED) and channel_id == 0x01 and operation_id == _OPERATION_REGISTRY:
+        for i in range(7):
+            response[i] = request_command[i]
+        return registry_operation(command_id, response)
+
+
+# the read request a subscription repeats: the subscribe request's header with the read operation and params
+def _read_request(request_command, params):
+    request = bytearray(8 + 4 * len(params))
+    request[:8] = request_command[:8]
+    request[4] = _OPERATION_READ
+    request[7] = len(params)
+    for i, param in enumerate(params):
+        struct.pack_into("<I", request, 8 + 4 * i, param)
+    return request
 
-        nresults = 0x1e
-        unit_id = 0x02
-        error_id = 0x00
 
-        response_payload = headers + result_payload
+# response to a (un)subscribe request that carries no results, written into the response buffer.
+# returns its length
+def _operation_response(request_command, error_id, response):
+    for i in range(7):
+        response[i] = request_command[i]
+    response[7] = 0x00
+    response[8] = 0x00
+    response[9] = error_id
+    return 10
 
-        # For debugging purposes, print the response_payload
-        print("Response Payload:", response_payload)
 
-        return response_payload
+# response to a request whose handling raised, written into the response buffer: error id 0x04, no results
+# follow. returns its length, None when the request is too short to repeat its header
+def _failure_response(request_command, response):
+    if len(request_command) < 8:
+        return None
+    return _operation_response(request_command, 0x04, response)
+
+
+# counts an answered request, and an error when its error id is set, and records its uart turnaround
+def record_response(response, length, start_us):
+    telemetry.record(STAGE_UART_TURNAROUND, start_us)
+    telemetry.count(COUNTER_REQUESTS)
+    if response[length - 1] != 0x00:
+        telemetry.count(COUNTER_ERRORS)
+
+
+# whether the results (from index 7) of two responses of the given lengths are equal
+def _same_results(response, length, other, other_length):
+    if length != other_length:
+        return False
+    for i in range(7, length):
+        if response[i] != other[i]:
+            return False
+    return True
 ############################ CUSTOM PROTOCOL COMMUNICATION END #####################################
 
+class UartResponder:
+    """
+    Services framed requests as separate asyncio tasks so a slow command never holds up the
+    ones behind it. Responses carry the request id of their request and are written as soon as
+    they are ready, in whatever order that is. The lock keeps concurrent responses from
+    interleaving on the wire. Newline requests carry no request id and are answered in order by
+    handle_newline(). A request whose handling raises is answered with error id 0x04.
+
+    A subscribe request (operation 0x04, params [period_ms, flags] followed by the params of the
+    command) starts a task that repeats the command as a read every period_ms and pushes each
+    response, with operation id 0x04 and the subscribe request's id, until an unsubscribe request
+    (operation 0x05, params [request id of the subscription]) cancels it. With _SUBSCRIBE_ON_CHANGE
+    a response is only pushed when it differs from the last one. An incremental time series
+    subscription (command 0x08) moves its since_seq forward after every push, so it streams every
+    sample exactly once.
+    A subscribe request without its params, or beyond _MAX_SUBSCRIPTIONS, is refused with error
+    id 0x05 and never pushed for. A push with error id 0x02 or 0x03 (command unsupported, params
+    refused) is the subscription's last, as repeating the read would only get the same answer,
+    so its slot is freed right away.
+
+    Responses are packed in place into preallocated FrameEncoder buffers: a pool with one per
+    request that can be in flight at once, and two per subscription (the response being built
+    and the last one pushed, for the on-change comparison).
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.inflight = 0
+        # push task per subscription request id
+        self.subscriptions = {}
+        # submit_framed() answers the request over the limit inline, so at most one more is in flight
+        self.encoders = [FrameEncoder(_RESPONSE_MAX) for _ in range(_MAX_INFLIGHT_REQUESTS + 1)]
+        # newline responses are built in place too, with room for the b'\n'
+        self.newline_buffer = bytearray(_RESPONSE_MAX + 1)
+        self.newline_view = memoryview(self.newline_buffer)
+        self.newline_response = self.newline_view[:_RESPONSE_MAX]
+
+    async def write(self, frame):
+        async with self.lock:
+            self.writer.write(frame)
+            await self.writer.drain()
+
+    async def push(self, request_id, request_command, period_ms, on_change, params):
+        command_id = struct.unpack("<h", request_command[5:7])[0]
+        if command_id == 0x08:
+            # only since_seq is kept, it is moved forward in place after every push
+            params = params[:1] or [0]
+        read_request = _read_request(request_command, params)
+        encoder = FrameEncoder(_RESPONSE_MAX)
+        # the response last pushed, swapped with encoder after each push
+        last = FrameEncoder(_RESPONSE_MAX)
+        last_length = None
+        try:
+            while True:
+                response = encoder.payload
+                response_meter.start()
+                length = await process_request(read_request, response)
+                if length is None:
+                    break
+                if command_id == 0x08 and response[length - 1] == 0x00:
+                    # the next read asks from this response's next_seq
+                    for i in range(4):
+                        read_request[8 + i] = response[9 + i]
+                # an empty incremental time series response means nothing new arrived
+                unchanged = (_same_results(response, length, last.payload, last_length)
+                             or (command_id == 0x08 and not response[7]))
+                if not on_change or last_length is None or not unchanged:
+                    response[4] = _OPERATION_SUBSCRIBE
+                    frame = encoder.frame(length, request_id)
+                    response_meter.stop()
+                    await self.write(frame)
+                    encoder, last, last_length = last, encoder, length
+                else:
+                    response_meter.stop()
+                if response[length - 1] in (0x02, 0x03):
+                    # pushed once, the command or its params will not be taken on the next read either
+                    break
+                await asyncio.sleep_ms(period_ms)
+        except Exception as e:
+            print("Exception in push:", e)
+        # cancellation (unsubscribe) is not an Exception, only a subscription that ended on its own gets here
+        self.subscriptions.pop(request_id, None)
+
+    # writes the response to a subscribe or unsubscribe request into the response buffer, returns its length
+    # or None when there is nothing to send right away
+    def subscribe(self, request_id, request_command, response):
+        nparams = request_command[7]
+        if len(request_command) < 8 + 4 * nparams:
+            return None
+        params = list(struct.unpack("<%dI" % nparams, request_command[8:8 + 4 * nparams]))
+        if request_command[4] == _OPERATION_UNSUBSCRIBE:
+            task = self.subscriptions.pop(params[0], None) if params else None
+            if task is None:
+                # error id 0x03: no subscription with that request id
+                return _operation_response(request_command, 0x03, response)
+            task.cancel()
+            return _operation_response(request_command, 0x00, response)
+        if len(params) < 2 or (request_id not in self.subscriptions and len(self.subscriptions) >= _MAX_SUBSCRIPTIONS):
+            # error id 0x05: subscription refused, params missing or too many subscriptions
+            return _operation_response(request_command, 0x05, response)
+        if request_id in self.subscriptions:
+            self.subscriptions.pop(request_id).cancel()
+        period_ms = max(params[0], _SUBSCRIBE_MIN_PERIOD_MS)
+        on_change = bool(params[1] & _SUBSCRIBE_ON_CHANGE)
+        # the first push doubles as the acknowledgement
+        self.subscriptions[request_id] = asyncio.create_task(
+            self.push(request_id, request_command, period_ms, on_change, params[2:]))
+        return None
+
+    async def handle_framed(self, request_id, request_command):
+        start_us = ticks_us()
+        encoder = self.encoders.pop() if self.encoders else FrameEncoder(_RESPONSE_MAX)
+        try:
+            # the meter includes parsing the request, and whatever other tasks allocate while a BLE request waits
+            response_meter.start()
+            try:
+                if len(request_command) >= 8 and request_command[4] in (_OPERATION_SUBSCRIBE, _OPERATION_UNSUBSCRIBE):
+                    length = self.subscribe(request_id, request_command, encoder.payload)
+                else:
+                    length = await process_request(request_command, encoder.payload)
+            except Exception as e:
+                print("Exception in handle_framed:", e)
+                length = _failure_response(request_command, encoder.payload)
+            if length is not None:
+                frame = encoder.frame(length, request_id)
+                response_meter.stop()
+                await self.write(frame)
+                record_response(encoder.payload, length, start_us)
+        except Exception as e:
+            print("Exception in handle_framed:", e)
+            telemetry.count(COUNTER_ERRORS)
+        finally:
+            self.encoders.append(encoder)
+            self.inflight -= 1
+
+    # newline frames carry no request id, so they are answered in order, in place in the newline buffer
+    async def handle_newline(self, request_command):
+        start_us = ticks_us()
+        try:
+            try:
+                length = await process_request(request_command, self.newline_response)
+            except Exception as e:
+                print("Exception in handle_newline:", e)
+                length = _failure_response(request_command, self.newline_response)
+            if length is not None:
+                self.newline_buffer[length] = _NEWLINE_DELIMITER
+                await self.write(self.newline_view[:length + 1])
+                record_response(self.newline_response, length, start_us)
+        except Exception as e:
+            print("Exception in handle_newline:", e)
+            telemetry.count(COUNTER_ERRORS)
+
+    async def submit_framed(self, request_id, request_command):
+        self.inflight += 1
+        if self.inflight > _MAX_INFLIGHT_REQUESTS:
+            # back-pressure: stop reading the uart until this request is answered
+            await self.handle_framed(request_id, request_command)
+        else:
+            asyncio.create_task(self.handle_framed(request_id, request_command))
+
+
 async def main():
     # Start the background task
     asyncio.create_task(sensor_task())
-    temp_characteristic = None
-
-    while temp_characteristic is None:
-        temp_characteristic = await connect_ble(temp_characteristic)
-        await asyncio.sleep(1)
+    # discover the sensor nodes and keep every one connected in the background, requests read from the open links
+    asyncio.create_task(registry.run())
     #listen for requests over the serial uart interface
+    reader = UartFrameReader(asyncio.StreamReader(uart))
+    responder = UartResponder(asyncio.StreamWriter(uart, {}))
     while True:
-        if uart.any():
-            request_command = read_until(uart)
-            response_command = await process_request(request_command, temp_characteristic)
-            uart.write(response_command + b'\n')
-            await asyncio.sleep(0.3)
+        framed, request_command = await reader.read_frame()
+        if framed:
+            decoded = decode_frame(request_command)
+            if decoded is None:
+                # corrupt frame, the reader is already waiting on the next delimiter
+                print("Dropped corrupt uart frame")
+                telemetry.count(COUNTER_DROPPED_FRAMES)
+                continue
+            await responder.submit_framed(*decoded)
+            continue
+        await responder.handle_newline(request_command)
 
 
 asyncio.run(main())
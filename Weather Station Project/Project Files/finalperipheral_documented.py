@@ -1,18 +1,31 @@
 import sys
 from micropython import const
 import uasyncio as asyncio
+from utime import ticks_ms, ticks_us, ticks_diff
 import aioble
 import bluetooth
 import struct
-from bme680 import *
+from bme680_burst import BME680Burst
 from machine import Pin, I2C
+from ring_buffer import RingBuffer, ChannelStats, AGGREGATION_SCOPES, SCOPE_LAST_N
+from rollups import ChannelRollups, ROLLUP_TIERS, BUCKET_SIZE
+from delta_codec import pack_series_into, series_size
+from channel_schema import CHANNELS, HUMIDITY, TEMPERATURE, PRESSURE, SAMPLE_STRUCT
+from sampling import AdaptiveSampler, ENTRY_SIZE
+from telemetry import (Telemetry, STAGE_SENSOR_READ, STAGE_ENCODE, STAGE_BLE_READ, STAGE_LOOP_JITTER,
+                       COUNTER_REQUESTS, COUNTER_ERRORS, COUNTER_RECONNECTS, COUNTER_SAMPLES, COUNTER_PUBLISHES)
 
 ############################# CONFIGS FOR ALL INTERFACES #######################################
 # I2C Configuration for BME680
 i2c = I2C(0, scl=Pin(1), sda=Pin(0))
-bme_sensor = BME680_I2C(i2c=i2c)
+# oversampling x8/x4/x2 (temperature/pressure/humidity), IIR filter coefficient 3, gas heater on
+bme_sensor = BME680Burst(i2c, temperature_oversample=8, pressure_oversample=4, humidity_oversample=2,
+                         filter_size=3, gas=True)
 result_temp = 0
 
+# print every sample for debugging. printing allocates on every loop, keep it off otherwise
+DEBUG = False
+
 
 ########### BLE CONFIGS FOR PERIPHERAL ########
 _ENV_SENSE_UUID = bluetooth.UUID(0x181A)
@@ -22,6 +35,11 @@ _ENV_SENSE_HUMIDITY_UUID = bluetooth.UUID(0x2A6F)
 _ADV_APPEARANCE_GENERIC_THERMOMETER = const(768)
 # How frequently to send advertising beacons.
 _ADV_INTERVAL_MS = 250_000
+# ATT MTU offered to the central, which asks for the exchange right after connecting. a notification or a
+# single read carries MTU - 3 bytes, 20 until the exchange went through
+_BLE_MTU = 247
+_DEFAULT_ATT_MTU = 23
+aioble.config(mtu=_BLE_MTU)
 # Register service as GATT server.
 temp_service = aioble.Service(_ENV_SENSE_UUID)
 
@@ -29,7 +47,9 @@ temp_service = aioble.Service(_ENV_SENSE_UUID)
 """
 BLE has in built "OBSERVABLE DESIGN" properties.initialising the characterestics with "notify=True"
 setsup this BLE PERIPHERAL to notify the PAIRED devices after each write to those 
-characterestics
+characterestics. The writes in sensor_task() pass send_update=True so every subscribed
+central receives the new value as a notification instead of polling for it. They only happen
+when the sampler (sampling.py) publishes, so a stable signal costs no radio traffic.
 
 """
 aggr_temp_characteristic = aioble.Characteristic(
@@ -46,16 +66,50 @@ aggr_humidity_characteristic = aioble.Characteristic(
     temp_service, bluetooth.UUID(0x2A24), read=True, notify=True
 )
 
-last_10_pres_timeseries_characteristic = aioble.Characteristic(
-    temp_service, bluetooth.UUID(0x2A25), read=True, notify=True
+# combined time series of humidity, temperature and pressure, delta encoded (see delta_codec.py) from the
+# channel_schema.py wire integers: as many of the newest SERIES_LENGTH samples per channel as fit in one ATT payload
+series_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB4), read=True, notify=True
 )
-last_10_hum_timeseries_characteristic = aioble.Characteristic(
-    temp_service, bluetooth.UUID(0x2A26), read=True, notify=True
+
+# the same series over a longer window, paged like the telemetry: the central writes a <HH (offset, samples) and
+# series_task() answers with a notification of <HH (offset, payload length) followed by as much of the encoded
+# series from offset as fits. the query for offset 0 encodes the newest `samples` samples per channel (0 for all
+# held), the later pages come from that one
+series_page_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB6), read=True, write=True, notify=True, capture=True
 )
 
-last_10_temp_timeseries_characteristic = aioble.Characteristic(
-    temp_service, bluetooth.UUID(0x2A27), read=True, notify=True
+# rollup history: the central writes a <BBHB query (channel, tier, offset, count) and history_task()
+# answers with a notification of the result characteristic: <IHBBBB (age of the filling bucket in ms,
+# offset, channel, tier, buckets holding data, buckets in this page) followed by the <4H buckets,
+# newest first. offset, channel and tier are echoed so the central can discard stale pages
+history_query_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB0), write=True, capture=True
+)
+history_result_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB1), read=True, notify=True
+)
 
+# every sample stamped at the source: SAMPLE_STRUCT of channel_schema.py (sequence number, ticks_ms, humidity,
+# temperature, pressure). the central keeps them to serve incremental time series requests
+sample_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB2), read=True, notify=True
+)
+
+# telemetry of this pico (see telemetry.py) for command 0x0A, paged since it is longer than one ATT payload: the
+# central writes a <H offset and telemetry_task() answers with a notification of <HH (offset, payload length)
+# followed by as much of the payload from offset as fits. the query for offset 0 packs a fresh payload, the later
+# pages come from that one. the stage STAGE_BLE_READ times the answers to history, telemetry and series queries, there
+# is no uart on this side
+telemetry_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB3), read=True, write=True, notify=True, capture=True
+)
+
+# sampling schedule (see sampling.py): the central writes a <BIII schedule (channel, min period ms, max period ms,
+# deadband) and reads back one <BIIII entry per channel, sampling_task() applies the writes
+sampling_characteristic = aioble.Characteristic(
+    temp_service, bluetooth.UUID(0x2AB5), read=True, write=True, capture=True
 )
 
 #register the service
@@ -63,114 +117,250 @@ aioble.register_services(temp_service)
 ############################# CONFIGS FOR ALL INTERFACES END#######################################
 
 ######################## VARIABLES FOR STORING PROCESSING RESULTS ###################
-temperature_values = []
-pressure_values = []
-humidity_values = []
-
-avg_temperature = 0
-min_temperature = float('inf')  # Initialize to positive infinity
-max_temperature = float('-inf')  # Initialize to negative infinity
-
-avg_pressure = 0
-min_pressure = float('inf')
-max_pressure = float('-inf')
-
-avg_humidity = 0
-min_humidity = float('inf')
-max_humidity = float('-inf')
+# samples kept per channel for the last-N aggregation scope, can go up to a few thousand.
+# keep SAMPLE_WINDOW and TIME_WINDOW_S equal to the central's, it validates scope requests against its own
+SAMPLE_WINDOW = 10
+# seconds covered by the last-T aggregation scope
+TIME_WINDOW_S = 60
+# fastest sensor_task sampling period (ms), the buffers below are sized for it. the period stretches up to
+# SAMPLE_PERIOD_MAX_MS while the values stay within their deadbands (humidity %, temperature C, pressure hPa),
+# the characteristics are only written when one moves past its deadband or every PUBLISH_HEARTBEAT_MS
+SAMPLE_PERIOD_MS = 500
+SAMPLE_PERIOD_MAX_MS = 10000
+SAMPLE_DEADBANDS = (0.5, 0.05, 0.05)
+PUBLISH_HEARTBEAT_MS = 30000
+# samples per channel kept for the combined time series characteristic, at most 255
+SERIES_LENGTH = 240
+
+_TIME_WINDOW_CAPACITY = TIME_WINDOW_S * 1000 // SAMPLE_PERIOD_MS + 1
+temperature_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+pressure_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+humidity_stats = ChannelStats(SAMPLE_WINDOW, TIME_WINDOW_S, _TIME_WINDOW_CAPACITY)
+# the time series, longer than the aggregation window, in the channel order of the history queries
+humidity_series = RingBuffer(SERIES_LENGTH)
+temperature_series = RingBuffer(SERIES_LENGTH)
+pressure_series = RingBuffer(SERIES_LENGTH)
+_SERIES_CHANNELS = (humidity_series, temperature_series, pressure_series)
+
+# rollup tiers per channel, indexed by the channel id of the history query
+# (0x00 humidity, 0x01 temperature, 0x02 pressure), packed in the wire format of channel_schema.CHANNELS
+humidity_rollups = ChannelRollups(ROLLUP_TIERS, HUMIDITY)
+temperature_rollups = ChannelRollups(ROLLUP_TIERS, TEMPERATURE)
+pressure_rollups = ChannelRollups(ROLLUP_TIERS, PRESSURE)
+_HISTORY_CHANNELS = (humidity_rollups, temperature_rollups, pressure_rollups)
+# bytes one notification carries on the current connection, set by peripheral_task from the exchanged MTU
+att_payload_max = _DEFAULT_ATT_MTU - 3
+# buckets per history page with the largest MTU, pages hold as many as fit in att_payload_max
+_HISTORY_PAGE_BUCKETS = (_BLE_MTU - 3 - 10) // BUCKET_SIZE
+# sequence number of the next sample, counts every sample since boot
+sample_seq = 0
+# latest gas resistance (ohm), None until the heater is stable
+gas_resistance = None
+# stage latency histograms and counters of the peripheral
+telemetry = Telemetry()
+# sampling period and send-on-delta state, and the (humidity, temperature, pressure) of the latest sample
+sampler = AdaptiveSampler(CHANNELS, SAMPLE_PERIOD_MS, SAMPLE_PERIOD_MAX_MS, SAMPLE_DEADBANDS, PUBLISH_HEARTBEAT_MS)
+sample_values = [0.0, 0.0, 0.0]
+
+# characteristic payloads, preallocated and packed in place on every sample: avg/min/max of every scope per
+# channel, the encoded time series, the paged series window and one of its pages, the stamped sample, one history
+# page, the telemetry payload and one of its pages
+_aggr_temp_buffer = bytearray(6 * len(AGGREGATION_SCOPES))
+_aggr_pressure_buffer = bytearray(6 * len(AGGREGATION_SCOPES))
+_aggr_humidity_buffer = bytearray(6 * len(AGGREGATION_SCOPES))
+_series_buffer = bytearray(_BLE_MTU - 3)
+_series_window_buffer = bytearray(series_size(len(CHANNELS), SERIES_LENGTH))
+_series_page_buffer = bytearray(_BLE_MTU - 3)
+_sample_buffer = bytearray(SAMPLE_STRUCT.size)
+_history_page_buffer = bytearray(10 + _HISTORY_PAGE_BUCKETS * BUCKET_SIZE)
+_telemetry_buffer = bytearray(telemetry.size())
+_telemetry_page_buffer = bytearray(_BLE_MTU - 3)
+_sampling_buffer = bytearray(ENTRY_SIZE * len(CHANNELS))
 ######################## VARIABLES FOR STORING PROCESSING RESULTS END###################
 
 ################################## ENCODING UTILS ##################################
-def _encode_temperature(temp_deg_c):
-    return struct.pack("<h", int(temp_deg_c * 100))  # Encode temperature with two decimal places
+# every channel value is packed in the wire format of its channel_schema entry
 
-def _encode_pressure(pressure):
-    return struct.pack("<h", int(pressure * 10))  # Encode pressure with two decimal places
 
-def _encode_humidity(humidity):
-    return struct.pack("<H", int(humidity * 100))  # Encode humidity with two decimal places
+
+# packs as many of the newest samples per channel as fit in att_payload_max into _series_buffer, returns the
+# length of the payload
+def pack_series():
+    count = len(humidity_series)
+    while count:
+        end = pack_series_into(_SERIES_CHANNELS, CHANNELS, count, _series_buffer, 0, att_payload_max)
+        if end is not None:
+            return end
+        # deltas are a byte or two each, a few tries shrink the window to what fits
+        count = count * 3 // 4
+    return pack_series_into(_SERIES_CHANNELS, CHANNELS, 0, _series_buffer, 0, att_payload_max)
 
 ################################## ENCODING UTILS END##################################
 
 ############################# SENSOR TASK FOR COLLECTING THE SENSOR STATS #################
 async def sensor_task():
-    # global stats.Declare the variables as global
-    global temperature_values, pressure_values, humidity_values  # Declare the variable as global
-    global avg_temperature, min_temperature, max_temperature
-    global avg_pressure, min_pressure, max_pressure
-    global avg_humidity, min_humidity, max_humidity
+    global sample_seq, gas_resistance
+    series_view = memoryview(_series_buffer)
     while True:
         try:
-            p = bme_sensor.pressure
-            h = bme_sensor.humidity
-
-            t = bme_sensor.temperature
+            # one forced-mode measurement, all channels from a single burst read
+            start_us = ticks_us()
+            t, p, h, gas_resistance = await bme_sensor.measure()
+            telemetry.record(STAGE_SENSOR_READ, start_us)
+            now = ticks_ms()
+            start_us = ticks_us()
 
             # Print sensor values for debugging
-            print("Temperature:", t)
-            print("Pressure:", p)
-            print("Humidity:", h)
-
-            # Update statistics
-            temperature_values.append(t)
-            if len(temperature_values) > 10:
-                temperature_values = temperature_values[-10:]
-
-            avg_temperature = sum(temperature_values) / len(temperature_values)
-            min_temperature = min(min_temperature, t)
-            max_temperature = max(max_temperature, t)
-
-            pressure_values.append(p)
-            if len(pressure_values) > 10:
-                pressure_values = pressure_values[-10:]
-
-            avg_pressure = sum(pressure_values) / len(pressure_values)
-            min_pressure = min(min_pressure, p)
-            max_pressure = max(max_pressure, p)
-
-            humidity_values.append(h)
-            if len(humidity_values) > 10:
-                humidity_values = humidity_values[-10:]
-
-            avg_humidity = sum(humidity_values) / len(humidity_values)
-            min_humidity = min(min_humidity, h)
-            max_humidity = max(max_humidity, h)
+            if DEBUG:
+                print("Temperature:", t)
+                print("Pressure:", p)
+                print("Humidity:", h)
+                print("Gas resistance:", gas_resistance)
+
+            # Update statistics of every scope
+            temperature_stats.push(t, now)
+            pressure_stats.push(p, now)
+            humidity_stats.push(h, now)
+            humidity_rollups.push(h, now)
+            temperature_rollups.push(t, now)
+            pressure_rollups.push(p, now)
+            humidity_series.push(h)
+            temperature_series.push(t)
+            pressure_series.push(p)
 
             # Print calculated values for debugging
-            print("Average Temperature:", avg_temperature)
-            print("Min Temperature:", min_temperature)
-            print("Max Temperature:", max_temperature)
-            print("Average Pressure:", avg_pressure)
-            print("Min Pressure:", min_pressure)
-            print("Max Pressure:", max_pressure)
-            print("Average Humidity:", avg_humidity)
-            print("Min Humidity:", min_humidity)
-            print("Max Humidity:", max_humidity)
-
-            # Write all the stats to respective characteristics
-            aggr_temp_characteristic.write(
-                _encode_temperature(avg_temperature) + _encode_temperature(min_temperature) + _encode_temperature(
-                    max_temperature))
-
-            aggr_pressure_characteristic.write(
-                _encode_pressure(avg_pressure) + _encode_pressure(min_pressure) + _encode_pressure(max_pressure))
-
-            aggr_humidity_characteristic.write(
-                _encode_humidity(avg_humidity) + _encode_humidity(min_humidity) + _encode_humidity(max_humidity))
-
-            last_10_temp_timeseries_characteristic.write(struct.pack("<10H", *map(lambda x: int(x * 100), temperature_values)))
-            last_10_hum_timeseries_characteristic.write(struct.pack("<10H", *map(lambda x: int(x * 100), humidity_values)))
-            last_10_pres_timeseries_characteristic.write(struct.pack("<10H", *map(lambda x: int(x * 10), pressure_values)))
+            if DEBUG:
+                print("Temperature avg/min/max:", temperature_stats.aggregate(SCOPE_LAST_N))
+                print("Pressure avg/min/max:", pressure_stats.aggregate(SCOPE_LAST_N))
+                print("Humidity avg/min/max:", humidity_stats.aggregate(SCOPE_LAST_N))
+
+            # Write the stats of every channel past its deadband to its characteristic, and the series and sample
+            # when any is, and notify the subscribed central. the payloads are packed in place, gatts_write
+            # copies them into the GATT database. samples in between only reach the statistics
+            sample_values[0] = h
+            sample_values[1] = t
+            sample_values[2] = p
+            if sampler.update(now, sample_values):
+                if sampler.due(TEMPERATURE.channel_id):
+                    temperature_stats.pack_into(_aggr_temp_buffer, 0, TEMPERATURE)
+                    aggr_temp_characteristic.write(_aggr_temp_buffer, send_update=True)
+                if sampler.due(PRESSURE.channel_id):
+                    pressure_stats.pack_into(_aggr_pressure_buffer, 0, PRESSURE)
+                    aggr_pressure_characteristic.write(_aggr_pressure_buffer, send_update=True)
+                if sampler.due(HUMIDITY.channel_id):
+                    humidity_stats.pack_into(_aggr_humidity_buffer, 0, HUMIDITY)
+                    aggr_humidity_characteristic.write(_aggr_humidity_buffer, send_update=True)
+
+                series_characteristic.write(series_view[:pack_series()], send_update=True)
+                SAMPLE_STRUCT.pack_into(_sample_buffer, 0, sample_seq, now, HUMIDITY.encode(h), TEMPERATURE.encode(t),
+                                        PRESSURE.encode(p))
+                sample_characteristic.write(_sample_buffer, send_update=True)
+                telemetry.count(COUNTER_PUBLISHES)
+            # sequence numbers count every sample, gaps in the notified ones are the samples not published
+            sample_seq += 1
+            telemetry.record(STAGE_ENCODE, start_us)
+            telemetry.count(COUNTER_SAMPLES)
+            telemetry.check_heap()
             #Write to characterestics end
 
-            await asyncio.sleep_ms(1000)
+            # jitter: how much later than asked the loop wakes up
+            period_ms = sampler.period_ms
+            start_us = ticks_us()
+            await asyncio.sleep_ms(period_ms)
+            telemetry.histograms[STAGE_LOOP_JITTER].record(ticks_diff(ticks_us(), start_us) - period_ms * 1000)
 
         except Exception as e:
             print("Exception in sensor_task:", e)
 
 ############################# SENSOR TASK FOR COLLECTING THE SENSOR STATS END#################
+
+# answers the central's history queries one page at a time
+async def history_task():
+    page_view = memoryview(_history_page_buffer)
+    while True:
+        try:
+            connection, query = await history_query_characteristic.written()
+            start_us = ticks_us()
+            telemetry.count(COUNTER_REQUESTS)
+            channel, tier, offset, count = struct.unpack("<BBHB", query)
+            rollup_tier = _HISTORY_CHANNELS[channel].tiers[tier]
+            age_ms = rollup_tier.age_ms(0, ticks_ms()) if rollup_tier.start_ms is not None else 0
+            count = max(0, min(count, (att_payload_max - 10) // BUCKET_SIZE, rollup_tier.filled - offset))
+            struct.pack_into("<IHBBBB", _history_page_buffer, 0, age_ms, offset, channel, tier, rollup_tier.filled, count)
+            for i in range(count):
+                rollup_tier.pack_bucket_into(_history_page_buffer, 10 + i * BUCKET_SIZE, offset + i)
+            history_result_characteristic.write(page_view[:10 + count * BUCKET_SIZE], send_update=True)
+            telemetry.record(STAGE_BLE_READ, start_us)
+        except Exception as e:
+            print("Exception in history_task:", e)
+            telemetry.count(COUNTER_ERRORS)
+
+# answers the central's telemetry queries one page at a time
+async def telemetry_task():
+    telemetry_view = memoryview(_telemetry_buffer)
+    page_view = memoryview(_telemetry_page_buffer)
+    length = 0
+    while True:
+        try:
+            connection, query = await telemetry_characteristic.written()
+            start_us = ticks_us()
+            telemetry.count(COUNTER_REQUESTS)
+            offset = struct.unpack("<H", query)[0]
+            if offset == 0:
+                length = telemetry.pack_into(_telemetry_buffer, 0)
+            count = max(0, min(length - offset, att_payload_max - 4))
+            struct.pack_into("<HH", _telemetry_page_buffer, 0, offset, length)
+            page_view[4:4 + count] = telemetry_view[offset:offset + count]
+            telemetry_characteristic.write(page_view[:4 + count], send_update=True)
+            telemetry.record(STAGE_BLE_READ, start_us)
+        except Exception as e:
+            print("Exception in telemetry_task:", e)
+            telemetry.count(COUNTER_ERRORS)
+
+# answers the central's series window queries one page at a time
+async def series_task():
+    window_view = memoryview(_series_window_buffer)
+    page_view = memoryview(_series_page_buffer)
+    length = 0
+    while True:
+        try:
+            connection, query = await series_page_characteristic.written()
+            start_us = ticks_us()
+            telemetry.count(COUNTER_REQUESTS)
+            offset, samples = struct.unpack("<HH", query)
+            if offset == 0:
+                held = len(humidity_series)
+                length = pack_series_into(_SERIES_CHANNELS, CHANNELS, min(samples, held) if samples else held,
+                                          _series_window_buffer, 0, len(_series_window_buffer))
+            count = max(0, min(length - offset, att_payload_max - 4))
+            struct.pack_into("<HH", _series_page_buffer, 0, offset, length)
+            page_view[4:4 + count] = window_view[offset:offset + count]
+            series_page_characteristic.write(page_view[:4 + count], send_update=True)
+            telemetry.record(STAGE_BLE_READ, start_us)
+        except Exception as e:
+            print("Exception in series_task:", e)
+            telemetry.count(COUNTER_ERRORS)
+
+# applies the central's sampling schedule writes, the characteristic always reads back the schedule in use
+async def sampling_task():
+    sampler.pack_into(_sampling_buffer, 0)
+    sampling_characteristic.write(_sampling_buffer)
+    while True:
+        try:
+            connection, data = await sampling_characteristic.written()
+            telemetry.count(COUNTER_REQUESTS)
+            if not sampler.configure_from(data):
+                # the central sees its write was not taken when it reads the schedule back
+                telemetry.count(COUNTER_ERRORS)
+            sampler.pack_into(_sampling_buffer, 0)
+            sampling_characteristic.write(_sampling_buffer)
+        except Exception as e:
+            print("Exception in sampling_task:", e)
+            telemetry.count(COUNTER_ERRORS)
+
 # Serially wait for connections. no advertising while central pico is connected.
 async def peripheral_task():
+    global att_payload_max
     while True:
         try:
             async with await aioble.advertise(
@@ -181,18 +371,26 @@ async def peripheral_task():
             ) as connection:
                 print("Connection from", connection.device)
                 while connection.is_connected():
+                    # the central exchanges the MTU once connected, payloads grow from then on
+                    att_payload_max = (connection.mtu or _DEFAULT_ATT_MTU) - 3
                     await asyncio.sleep_ms(500)
                 print("Disconnected")
+                att_payload_max = _DEFAULT_ATT_MTU - 3
+                telemetry.count(COUNTER_RECONNECTS)
 
         except Exception as e:
             print("Exception in peripheral_task:", e)
 
 
-# Run both sensor and peripheral tasks.
+# Run the sensor, peripheral, history, telemetry, series and sampling tasks.
 async def main():
     t1 = asyncio.create_task(sensor_task())
     t2 = asyncio.create_task(peripheral_task())
-    await asyncio.gather(t1, t2)
+    t3 = asyncio.create_task(history_task())
+    t4 = asyncio.create_task(sampling_task())
+    t5 = asyncio.create_task(telemetry_task())
+    t6 = asyncio.create_task(series_task())
+    await asyncio.gather(t1, t2, t3, t4, t5, t6)
 
 
 asyncio.run(main())
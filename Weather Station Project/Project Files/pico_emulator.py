@@ -0,0 +1,894 @@
+"""
+Host emulation of the weather station: runs the unmodified central (final_i2c.py) and sensor
+node (finalperipheral_documented.py) firmware under CPython on one asyncio loop, so the picos
+can be profiled and load tested without the bench.
+
+The MicroPython modules the firmware imports are replaced by stand-ins:
+  - utime, uasyncio, bluetooth and micropython by thin layers over time and asyncio, and
+    gc gets mem_alloc()/mem_free(). With --alloc they count the bytes tracemalloc sees
+    allocated since every firmware finished loading, by all nodes together and at CPython's
+    object sizes, so they show trends and collections rather than the pico's heap.
+  - machine.UART is the master side of a pty, the slave path is printed (and linked at
+    --link) so host tools open it like the central's serial port. Writes are paced at the
+    uart's baud rate.
+  - machine.I2C reaches an emulated BME680 that replays a trace: synthetic (drifts that
+    alternate with stable stretches, plus noise) or a csv exported by the GUI. Each forced
+    measurement finds the raw ADC readings the firmware's own compensation turns into the
+    trace values, so bme680_burst.py runs unchanged. The gas heater never reports stable.
+  - aioble connects every node in process: the central's scans see the advertising nodes,
+    reads, writes and notifications arrive after --latency-ms (+- --jitter-ms) in order,
+    notifications (MTU - 3 bytes) and reads (MTU - 1 bytes, one ATT read) are cut to the
+    negotiated ATT MTU, and --drop-every-s drops the links to exercise reconnects. Reads of a
+    characteristic without read, and writes with response to one without write, fail with
+    aioble.GattError as the peripheral's ATT error response makes them.
+Every node's firmware module is executed in a namespace of its own, with its own machine and
+aioble, and its asyncio.run(main()) starts main() as a task on the emulator's loop.
+
+    python pico_emulator.py [--nodes 1] [--trace synthetic | --trace samples.csv] [--link /tmp/pico]
+    python serial_mux.py --port /tmp/pico --tcp 7000
+    python final_gui_app.py socket://localhost:7000
+"""
+import argparse
+import asyncio
+import builtins
+import csv
+import gc
+import math
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import tty
+import types
+from collections import deque
+
+_FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+_CENTRAL_FIRMWARE = os.path.join(_FIRMWARE_DIR, 'final_i2c.py')
+_NODE_FIRMWARE = os.path.join(_FIRMWARE_DIR, 'finalperipheral_documented.py')
+
+# MicroPython's ticks wrap at 2**30
+_TICKS_PERIOD = 1 << 30
+_TICKS_HALF = _TICKS_PERIOD // 2
+# heap size reported by gc.mem_free(), about what the rp2 port leaves to python
+_HEAP_SIZE = 192 * 1024
+# ATT MTU of a connection until an exchange, the MTU a node offers in one unless aioble.config() set
+# another (the stack's preferred MTU) and the longest attribute value
+_DEFAULT_ATT_MTU = 23
+_PREFERRED_ATT_MTU = 256
+_ATT_VALUE_MAX = 512
+# ATT errors of an operation the characteristic does not permit
+_ATT_READ_NOT_PERMITTED = 0x02
+_ATT_WRITE_NOT_PERMITTED = 0x03
+# bits per uart byte: start, 8 data, stop
+_UART_BITS_PER_BYTE = 10
+
+
+############################# MICROPYTHON STAND-INS #######################################
+def _ticks(scale):
+    return int(time.monotonic() * scale) & (_TICKS_PERIOD - 1)
+
+
+def _ticks_diff(end, start):
+    return ((end - start + _TICKS_HALF) & (_TICKS_PERIOD - 1)) - _TICKS_HALF
+
+
+def _make_utime():
+    utime = types.ModuleType('utime')
+    utime.ticks_ms = lambda: _ticks(1000)
+    utime.ticks_us = lambda: _ticks(1000000)
+    utime.ticks_diff = _ticks_diff
+    utime.ticks_add = lambda ticks, delta: (ticks + delta) & (_TICKS_PERIOD - 1)
+    utime.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    utime.sleep_us = lambda us: time.sleep(us / 1000000)
+    utime.sleep = time.sleep
+    utime.time = lambda: int(time.time())
+    return utime
+
+
+# tasks started by asyncio.run() while the emulator's loop runs, collected by load_firmware()
+_started_tasks = []
+# bytes traced once the firmware was loaded, left out of gc.mem_alloc()
+_alloc_baseline = 0
+
+
+class _StreamReader:
+    """uasyncio.StreamReader over a stream with a non-blocking readinto() and a fileno()."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def readinto(self, buffer):
+        while True:
+            count = self.stream.readinto(buffer)
+            if count:
+                return count
+            loop = asyncio.get_running_loop()
+            readable = loop.create_future()
+            loop.add_reader(self.stream.fileno(), lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.stream.fileno())
+
+
+class _StreamWriter:
+    """uasyncio.StreamWriter: write() copies the data, drain() hands it to the stream."""
+
+    def __init__(self, stream, extra=None):
+        self.stream = stream
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+
+    async def drain(self):
+        data = bytes(self.pending)
+        self.pending = bytearray()
+        await self.stream.write_paced(data)
+
+
+def _make_uasyncio():
+    uasyncio = types.ModuleType('uasyncio')
+    for name in ('Event', 'Lock', 'TimeoutError', 'CancelledError', 'create_task', 'gather', 'sleep', 'wait_for',
+                 'get_event_loop', 'current_task'):
+        setattr(uasyncio, name, getattr(asyncio, name))
+    uasyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    uasyncio.wait_for_ms = lambda awaitable, ms: asyncio.wait_for(awaitable, ms / 1000)
+    uasyncio.StreamReader = _StreamReader
+    uasyncio.StreamWriter = _StreamWriter
+
+    # the firmware ends with asyncio.run(main()): under the emulator its main() becomes a task
+    def run(coroutine):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        task = loop.create_task(coroutine)
+        _started_tasks.append(task)
+        return task
+
+    uasyncio.run = run
+    return uasyncio
+
+
+class UUID:
+    """bluetooth.UUID of a 16 bit or 128 bit (string) uuid."""
+
+    def __init__(self, value):
+        self.value = value.lower() if isinstance(value, str) else value
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return f"UUID({self.value:#06x})" if isinstance(self.value, int) else f"UUID('{self.value}')"
+
+
+def _install_stand_ins():
+    modules = {'utime': _make_utime(), 'uasyncio': _make_uasyncio()}
+    modules['bluetooth'] = types.ModuleType('bluetooth')
+    modules['bluetooth'].UUID = UUID
+    modules['micropython'] = types.ModuleType('micropython')
+    modules['micropython'].const = lambda value: value
+    for name, module in modules.items():
+        sys.modules.setdefault(name, module)
+    if not hasattr(gc, 'mem_alloc'):
+        gc.mem_alloc = lambda: max(0, tracemalloc.get_traced_memory()[0] - _alloc_baseline)
+        gc.mem_free = lambda: max(0, _HEAP_SIZE - gc.mem_alloc())
+############################# MICROPYTHON STAND-INS END #######################################
+
+
+################################## SENSOR TRACES ##################################
+class SyntheticTrace:
+    """
+    (temperature C, pressure hPa, humidity %) drifting along a sine of period_s, which only
+    advances during changing_s out of every stable_s + changing_s seconds, plus gaussian noise.
+    Each node gets its own seed, so nodes read different but repeatable values.
+    """
+
+    def __init__(self, seed=0, period_s=600, stable_s=60, changing_s=60):
+        self.random = random.Random(seed)
+        self.phase = self.random.random() * 2 * math.pi
+        self.period_s = period_s
+        self.stable_s = stable_s
+        self.changing_s = changing_s
+
+    def sample(self, elapsed_s):
+        cycles, within = divmod(elapsed_s, self.stable_s + self.changing_s)
+        effective_s = cycles * self.changing_s + max(0, within - self.stable_s)
+        drift = math.sin(self.phase + 2 * math.pi * effective_s / self.period_s)
+        gauss = self.random.gauss
+        return (21.0 + 3.0 * drift + gauss(0, 0.01), 1013.25 - 2.0 * drift + gauss(0, 0.02),
+                45.0 - 10.0 * drift + gauss(0, 0.05))
+
+
+class CsvTrace:
+    """
+    Replays a csv with a time column (epoch_ms, as sample_store.py exports, or time_s) and
+    temperature, pressure and humidity columns, interpolating between rows. The trace starts
+    over once it ran out.
+    """
+
+    def __init__(self, path):
+        times = []
+        rows = []
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                times.append(float(row['epoch_ms']) / 1000 if 'epoch_ms' in row else float(row['time_s']))
+                rows.append((float(row['temperature']), float(row['pressure']), float(row['humidity'])))
+        if not rows:
+            raise ValueError(f"{path} holds no samples")
+        self.times = [t - times[0] for t in times]
+        self.rows = rows
+        self.duration_s = self.times[-1] or 1.0
+
+    def sample(self, elapsed_s):
+        elapsed_s %= self.duration_s
+        low, high = 0, len(self.times) - 1
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.times[middle] <= elapsed_s:
+                low = middle
+            else:
+                high = middle
+        span = self.times[high] - self.times[low]
+        weight = (elapsed_s - self.times[low]) / span if span > 0 else 0.0
+        return tuple(a + (b - a) * weight for a, b in zip(self.rows[low], self.rows[high]))
+################################## SENSOR TRACES END ##################################
+
+
+################################## EMULATED BME680 ##################################
+_BME680_ADDRESS = 0x77
+_REG_CHIP_ID = 0xD0
+_REG_CTRL_MEAS = 0x74
+_REG_FIELD_0 = 0x1D
+_REG_COEFF_1 = 0x89
+_REG_COEFF_2 = 0xE1
+_COEFF_FORMAT = "<hbBHhbBhhbbHhhBBBHbbbBbHhbb"
+# calibration of a typical part, in the order of _COEFF_FORMAT: T2, T3, -, P1, P2, P3, -, P4, P5, P7, P6, -, P8,
+# P9, P10, -, H2 >> 4, H1 << 4 | H2 & 0xF, H3, H4, H5, H6, H7, T1, G2, G1, G3
+_COEFFS = (26275, 3, 0, 36605, -10442, 88, 0, 6864, -130, 42, 30, 0, -2700, -1728, 30, 0, 63, 12373, 0, 45, 20,
+           120, -100, 26028, -10320, -52, 18)
+_NEW_DATA = 0x80
+_FORCED_MODE = 0x01
+
+
+class EmulatedBME680:
+    """
+    Register file of a BME680 whose forced measurements read trace values. A measurement fills
+    the data registers with the ADC readings that decoder (a BME680Burst over a chip of its own
+    with the same calibration) compensates to the trace values, found by bisection.
+    """
+
+    def __init__(self, trace=None):
+        self.registers = bytearray(256)
+        self.registers[_REG_CHIP_ID] = 0x61
+        coeffs = b'\x00' + struct.pack(_COEFF_FORMAT, *_COEFFS) + b'\x00\x00'
+        self.registers[_REG_COEFF_1:_REG_COEFF_1 + 25] = coeffs[:25]
+        self.registers[_REG_COEFF_2:_REG_COEFF_2 + 16] = coeffs[25:]
+        # heater range, heater resistance correction and switching error
+        self.registers[0x02] = 0x10
+        self.registers[0x00] = 0x2A
+        self.registers[0x04] = 0x10
+        self.trace = trace
+        self.started = time.monotonic()
+        self.decoder = None
+        self.measurements = 0
+        if trace is not None:
+            from bme680_burst import BME680Burst
+            self.decoder = BME680Burst(EmulatedI2C({_BME680_ADDRESS: EmulatedBME680()}), gas=False)
+
+    def read(self, register, length):
+        return bytes(self.registers[register:register + length])
+
+    def write(self, register, data):
+        self.registers[register:register + len(data)] = data
+        if register <= _REG_CTRL_MEAS < register + len(data) and data[_REG_CTRL_MEAS - register] & 0x03 == _FORCED_MODE:
+            self.measure()
+
+    def measure(self):
+        temperature, pressure, humidity = self.trace.sample(time.monotonic() - self.started)
+        field = bytearray(15)
+        self._solve(field, 5, 3, 20, 'temperature', temperature)
+        self._solve(field, 2, 3, 20, 'pressure', pressure)
+        self._solve(field, 8, 2, 16, 'humidity', humidity)
+        field[0] = _NEW_DATA
+        # gas range 0 without the valid and heater stable flags: no gas reading
+        field[14] = 0x00
+        self.registers[_REG_FIELD_0:_REG_FIELD_0 + 15] = field
+        self.measurements += 1
+
+    # the ADC reading of bits bits, stored left aligned in length bytes of field from start, for which the
+    # decoder's attribute comes out closest to target (temperature first, the others depend on it)
+    def _solve(self, field, start, length, bits, attribute, target):
+        shift = 8 * length - bits
+
+        def value(adc):
+            raw = adc << shift
+            for i in range(length):
+                field[start + i] = (raw >> (8 * (length - 1 - i))) & 0xFF
+            self.decoder._compensate(field)
+            return getattr(self.decoder, attribute)
+
+        low, high = 0, (1 << bits) - 1
+        increasing = value(high) > value(low)
+        while low < high:
+            middle = (low + high) // 2
+            if (value(middle) < target) == increasing:
+                low = middle + 1
+            else:
+                high = middle
+        value(low)
+
+
+class EmulatedI2C:
+    """machine.I2C with devices {address: chip}, a missing device fails like a NACK."""
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise OSError(5, "EIO")
+        return device
+
+    def readfrom_mem(self, address, register, length):
+        return self._device(address).read(register, length)
+
+    def readfrom_mem_into(self, address, register, buffer):
+        buffer[:] = self._device(address).read(register, len(buffer))
+
+    def writeto_mem(self, address, register, data):
+        self._device(address).write(register, bytes(data))
+
+    def scan(self):
+        return sorted(self.devices)
+################################## EMULATED BME680 END ##################################
+
+
+################################## EMULATED UART ##################################
+class PtyUart:
+    """
+    machine.UART on the master side of a pty: host tools open slave_path like a serial port.
+    The slave stays open (raw, so no byte is translated) for the pty to survive clients coming
+    and going. Writes take as long as the bytes need on the wire at baudrate, unless pace is off.
+    """
+
+    def __init__(self, baudrate=115200, pace=True, link=None):
+        self.baudrate = baudrate
+        self.pace = pace
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.slave_path = os.ttyname(self.slave)
+        self.link = link
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.slave_path, link)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def fileno(self):
+        return self.master
+
+    def readinto(self, buffer):
+        try:
+            data = os.read(self.master, len(buffer))
+        except BlockingIOError:
+            return None
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+    async def write_paced(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.master, view)
+            except BlockingIOError:
+                # nobody reads the slave side, wait for room
+                await asyncio.sleep(0.01)
+                continue
+            view = view[written:]
+            self.bytes_written += written
+        if self.pace:
+            await asyncio.sleep(len(data) * _UART_BITS_PER_BYTE / self.baudrate)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+################################## EMULATED UART END ##################################
+
+
+################################## EMULATED BLE ##################################
+class DeviceDisconnectedError(Exception):
+    pass
+
+
+class GattError(Exception):
+    """aioble.GattError: the peer answered a GATT operation with an ATT error (status)."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class Air:
+    """
+    The radio shared by every node: who advertises, the open links and their latency.
+    One-way delays are latency_ms +- jitter_ms, deliveries on one link keep their order.
+    """
+
+    def __init__(self, latency_ms=10, jitter_ms=5, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.random = random.Random(seed)
+        # node -> (advertisement, future resolved with the node's side of the connection)
+        self.advertisers = {}
+        self.links = []
+
+    def delay_s(self):
+        return max(0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    async def connect(self, central, peripheral_node, timeout_ms):
+        deadline = time.monotonic() + timeout_ms / 1000
+        while peripheral_node not in self.advertisers:
+            if time.monotonic() >= deadline:
+                raise asyncio.TimeoutError
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(self.delay_s())
+        _, accepted = self.advertisers.pop(peripheral_node)
+        link = _Link(self, central, peripheral_node)
+        self.links.append(link)
+        accepted.set_result(link.peripheral_side)
+        return link.central_side
+
+    def drop_links(self):
+        for link in list(self.links):
+            link.close()
+
+
+class Device:
+    """aioble.Device of a peer node: its address, and connect() for a central."""
+
+    def __init__(self, air, node, peer):
+        self.air = air
+        # the node holding this handle and the node it refers to
+        self.node = node
+        self.peer = peer
+        self.addr = peer.address
+        self.addr_type = 0
+
+    def addr_hex(self):
+        return ':'.join('%02x' % b for b in self.addr)
+
+    def __repr__(self):
+        return f"Device(ADDR_PUBLIC, {self.addr_hex()})"
+
+    async def connect(self, timeout_ms=10000):
+        return await self.air.connect(self.node, self.peer, timeout_ms)
+
+
+class _Link:
+    """An open connection between a central node and a peripheral node, with both ends' views."""
+
+    def __init__(self, air, central, peripheral):
+        self.air = air
+        self.peripheral = peripheral
+        self.mtu = None
+        self.open = True
+        self.closed = asyncio.Event()
+        self.central_side = DeviceConnection(self, Device(air, central, peripheral))
+        self.peripheral_side = DeviceConnection(self, Device(air, peripheral, central))
+        # client characteristics subscribed per server characteristic
+        self.subscriptions = {}
+        # time the last delivery on this link is due, later ones never overtake it
+        self.last_due = 0.0
+
+    # bytes of a notification, and of a value one ATT read returns
+    def payload_max(self):
+        return (self.mtu or _DEFAULT_ATT_MTU) - 3
+
+    def read_max(self):
+        return (self.mtu or _DEFAULT_ATT_MTU) - 1
+
+    def check(self):
+        if not self.open:
+            raise DeviceDisconnectedError
+
+    # runs callback after a one-way delay, in order with earlier deliveries
+    def deliver(self, callback, *args):
+        loop = asyncio.get_running_loop()
+        due = max(loop.time() + self.air.delay_s(), self.last_due)
+        self.last_due = due
+        loop.call_at(due, lambda: self.open and callback(*args))
+
+    async def one_way(self):
+        await asyncio.sleep(self.air.delay_s())
+        self.check()
+
+    def close(self):
+        if not self.open:
+            return
+        self.open = False
+        self.closed.set()
+        if self in self.air.links:
+            self.air.links.remove(self)
+        for clients in self.subscriptions.values():
+            for client in clients:
+                client.wake()
+        self.subscriptions = {}
+
+
+class DeviceConnection:
+    """aioble.DeviceConnection, one per end of a _Link."""
+
+    def __init__(self, link, device):
+        self._link = link
+        self.device = device
+
+    @property
+    def mtu(self):
+        return self._link.mtu
+
+    def is_connected(self):
+        return self._link.open
+
+    async def exchange_mtu(self, mtu=None, timeout_ms=1000):
+        await self._link.one_way()
+        self._link.mtu = min(mtu or self.device.node.mtu, self.device.node.mtu, self.device.peer.mtu)
+        await self._link.one_way()
+        return self._link.mtu
+
+    async def service(self, uuid, timeout_ms=2000):
+        await self._link.one_way()
+        for service in self.device.peer.services:
+            if service.uuid == uuid:
+                return ClientService(self._link, service)
+        return None
+
+    async def disconnected(self, timeout_ms=None):
+        await asyncio.wait_for(self._link.closed.wait(), None if timeout_ms is None else timeout_ms / 1000)
+
+    async def disconnect(self, timeout_ms=2000):
+        self._link.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._link.close()
+
+
+class Service:
+    """aioble.Service on a peripheral node."""
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class Characteristic:
+    """aioble.Characteristic on a peripheral node: the stored value, writes queued for written()."""
+
+    def __init__(self, service, uuid, read=False, write=False, write_no_response=False, notify=False,
+                 indicate=False, initial=None, capture=False):
+        self.service = service
+        self.uuid = uuid
+        self.readable = read
+        self.writable = write or write_no_response
+        self.notify = notify
+        self.capture = capture
+        self.value = bytes(initial or b'')
+        self.writes = deque()
+        self.written_event = asyncio.Event()
+        service.characteristics.append(self)
+
+    def read(self):
+        return self.value
+
+    def write(self, data, send_update=False):
+        self.value = bytes(data[:_ATT_VALUE_MAX])
+        if send_update and self.notify:
+            for link in self.service.node.air.links:
+                for client in link.subscriptions.get(self, ()):
+                    # a notification carries what fits in one ATT payload
+                    link.deliver(client.notify, self.value[:link.payload_max()])
+
+    def on_write(self, connection, data):
+        self.value = data
+        self.writes.append((connection, data))
+        self.written_event.set()
+
+    async def written(self, timeout_ms=None):
+        while not self.writes:
+            self.written_event.clear()
+            await asyncio.wait_for(self.written_event.wait(), None if timeout_ms is None else timeout_ms / 1000)
+        connection, data = self.writes.popleft()
+        return (connection, data) if self.capture else connection
+
+
+class ClientService:
+    """A peripheral's service as a central discovered it."""
+
+    def __init__(self, link, service):
+        self._link = link
+        self._service = service
+
+    async def characteristic(self, uuid, timeout_ms=2000):
+        await self._link.one_way()
+        for characteristic in self._service.characteristics:
+            if characteristic.uuid == uuid:
+                return ClientCharacteristic(self._link, characteristic)
+        return None
+
+
+class ClientCharacteristic:
+    """
+    A peripheral's characteristic as a central discovered it. Only the newest notification is
+    kept until notified() takes it, as aioble does.
+    """
+
+    def __init__(self, link, characteristic):
+        self._link = link
+        self._characteristic = characteristic
+        self._notifications = deque((), 1)
+        self._notified = asyncio.Event()
+
+    async def read(self, timeout_ms=1000):
+        await self._link.one_way()
+        value = self._characteristic.value[:self._link.read_max()]
+        await self._link.one_way()
+        if not self._characteristic.readable:
+            raise GattError(_ATT_READ_NOT_PERMITTED)
+        return value
+
+    async def write(self, data, response=False, timeout_ms=1000):
+        await self._link.one_way()
+        if self._characteristic.writable:
+            self._characteristic.on_write(self._link.peripheral_side, bytes(data[:_ATT_VALUE_MAX]))
+        if response:
+            await self._link.one_way()
+            if not self._characteristic.writable:
+                raise GattError(_ATT_WRITE_NOT_PERMITTED)
+
+    async def subscribe(self, notify=True, indicate=False):
+        await self._link.one_way()
+        clients = self._link.subscriptions.setdefault(self._characteristic, [])
+        if notify and self not in clients:
+            clients.append(self)
+        elif not notify and self in clients:
+            clients.remove(self)
+
+    def notify(self, data):
+        self._notifications.append(data)
+        self._notified.set()
+
+    def wake(self):
+        self._notified.set()
+
+    async def notified(self, timeout_ms=None):
+        while not self._notifications:
+            self._link.check()
+            self._notified.clear()
+            await asyncio.wait_for(self._notified.wait(), None if timeout_ms is None else timeout_ms / 1000)
+        return self._notifications.popleft()
+
+
+class ScanResult:
+    def __init__(self, device, advertisement):
+        self.device = device
+        self._advertisement = advertisement
+        self.rssi = -50
+        self.connectable = True
+
+    def name(self):
+        return self._advertisement['name']
+
+    def services(self):
+        for uuid in self._advertisement['services']:
+            yield uuid
+
+
+class _Scanner:
+    """aioble.scan(): yields every node advertising while it runs, once each, until duration_ms passed."""
+
+    def __init__(self, node, duration_ms):
+        self.node = node
+        self.deadline = time.monotonic() + duration_ms / 1000
+        self.seen = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        air = self.node.air
+        while time.monotonic() < self.deadline:
+            for peer, (advertisement, _) in list(air.advertisers.items()):
+                if peer not in self.seen:
+                    self.seen.add(peer)
+                    await asyncio.sleep(air.delay_s())
+                    return ScanResult(Device(air, self.node, peer), advertisement)
+            await asyncio.sleep(min(0.1, max(0, self.deadline - time.monotonic())))
+        raise StopAsyncIteration
+
+
+def _make_aioble(node):
+    aioble = types.ModuleType('aioble')
+    aioble.DeviceDisconnectedError = DeviceDisconnectedError
+    aioble.GattError = GattError
+    aioble.Characteristic = Characteristic
+    aioble.Device = Device
+
+    def config(mtu=None, **kwargs):
+        if mtu is not None:
+            node.mtu = mtu
+
+    def make_service(uuid):
+        service = Service(uuid)
+        service.node = node
+        return service
+
+    def register_services(*services):
+        node.services = list(services)
+        node.characteristics = [characteristic for service in services for characteristic in service.characteristics]
+
+    async def advertise(interval_us, name=None, services=None, appearance=0, timeout_ms=None, **kwargs):
+        accepted = asyncio.get_running_loop().create_future()
+        node.air.advertisers[node] = ({'name': name, 'services': list(services or [])}, accepted)
+        try:
+            return await asyncio.wait_for(accepted, None if timeout_ms is None else timeout_ms / 1000)
+        finally:
+            if node.air.advertisers.get(node, (None, None))[1] is accepted:
+                del node.air.advertisers[node]
+
+    aioble.config = config
+    aioble.Service = make_service
+    aioble.register_services = register_services
+    aioble.advertise = advertise
+    aioble.scan = lambda duration_ms, interval_us=None, window_us=None, active=False: _Scanner(node, duration_ms)
+    return aioble
+################################## EMULATED BLE END ##################################
+
+
+################################## NODES ##################################
+class Node:
+    """One emulated pico: its BME680, its radio and, for the central, its pty uart."""
+
+    def __init__(self, name, index, air, trace, uart=None):
+        self.name = name
+        self.air = air
+        self.address = bytes([0xE6, 0x60, 0x00, 0x00, 0x00, index])
+        self.mtu = _PREFERRED_ATT_MTU
+        self.services = []
+        self.characteristics = []
+        self.chip = EmulatedBME680(trace)
+        self.uart = uart
+        self.namespace = None
+        self.tasks = []
+        machine = types.ModuleType('machine')
+        machine.Pin = lambda pin, *args, **kwargs: pin
+        machine.I2C = lambda *args, **kwargs: EmulatedI2C({_BME680_ADDRESS: self.chip})
+        machine.UART = self.open_uart
+        # the modules resolved per node, everything else is imported as usual
+        self.modules = {'machine': machine, 'aioble': _make_aioble(self)}
+
+    def open_uart(self, *args, baudrate=115200, **kwargs):
+        if self.uart is None:
+            raise OSError(19, "ENODEV")
+        self.uart.baudrate = baudrate
+        return self.uart
+
+    def __repr__(self):
+        return f"Node({self.name})"
+
+    # executes the unmodified firmware file in a namespace of this node, its main() becomes a task
+    def load_firmware(self, path):
+        modules = self.modules
+
+        def node_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level == 0 and name in modules:
+                return modules[name]
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        def node_print(*args, **kwargs):
+            builtins.print(f"[{self.name}]", *args, **kwargs)
+
+        node_builtins = dict(vars(builtins))
+        node_builtins['__import__'] = node_import
+        node_builtins['print'] = node_print
+        self.namespace = {'__name__': '__main__', '__file__': path, '__builtins__': node_builtins}
+        first = len(_started_tasks)
+        with open(path) as file:
+            exec(compile(file.read(), path, 'exec'), self.namespace)
+        self.tasks = _started_tasks[first:]
+        for task in self.tasks:
+            task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[{self.name}] firmware stopped:", repr(task.exception()))
+
+
+class Emulation:
+    """
+    The central and nodes sensor nodes on one loop. start() loads the firmware (call it from a
+    coroutine), the central's uart is then at uart.slave_path.
+    """
+
+    def __init__(self, nodes=1, trace_path=None, latency_ms=10, jitter_ms=5, pace=True, link=None, seed=0):
+        self.air = Air(latency_ms, jitter_ms, seed)
+
+        def trace(index):
+            return CsvTrace(trace_path) if trace_path else SyntheticTrace(seed + index)
+
+        self.uart = PtyUart(pace=pace, link=link)
+        self.central = Node('central', 0, self.air, trace(0), self.uart)
+        self.nodes = [Node(f'node{index}', index, self.air, trace(index)) for index in range(1, nodes + 1)]
+
+    async def start(self):
+        global _alloc_baseline
+        for node in self.nodes:
+            node.load_firmware(_NODE_FIRMWARE)
+        self.central.load_firmware(_CENTRAL_FIRMWARE)
+        _alloc_baseline = tracemalloc.get_traced_memory()[0]
+
+    async def run(self, drop_every_s=0):
+        await self.start()
+        print("central uart on", self.uart.link or self.uart.slave_path)
+        while True:
+            await asyncio.sleep(drop_every_s or 3600)
+            if drop_every_s:
+                print("dropping", len(self.air.links), "BLE links")
+                self.air.drop_links()
+
+    def close(self):
+        for node in [self.central] + self.nodes:
+            for task in node.tasks:
+                task.cancel()
+        self.uart.close()
+################################## NODES END ##################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the central and sensor node firmware on this host")
+    parser.add_argument('--nodes', type=int, default=1, help="sensor nodes advertising to the central")
+    parser.add_argument('--trace', default='synthetic', help="'synthetic' or a csv exported by the GUI")
+    parser.add_argument('--latency-ms', type=float, default=10, help="one-way BLE latency")
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--link', default=None, help="path of a symlink to the central's uart pty")
+    parser.add_argument('--no-pace', action='store_true', help="write uart bytes without the baud rate delay")
+    parser.add_argument('--drop-every-s', type=float, default=0, help="drop every BLE link this often, 0 never")
+    parser.add_argument('--alloc', action='store_true', help="report tracemalloc figures from gc.mem_alloc()")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.alloc:
+        tracemalloc.start()
+    _install_stand_ins()
+    emulation = Emulation(args.nodes, None if args.trace == 'synthetic' else args.trace, args.latency_ms,
+                          args.jitter_ms, not args.no_pace, args.link, args.seed)
+    try:
+        asyncio.run(emulation.run(args.drop_every_s))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulation.close()
+
+
+if __name__ == '__main__':
+    main()
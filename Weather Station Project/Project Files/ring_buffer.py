@@ -0,0 +1,262 @@
+"""
+Fixed size sample window used by the sensor tasks of both picos (final_i2c.py and
+finalperipheral_documented.py). Copy this file to each pico next to the firmware.
+
+All storage is preallocated arrays, so pushing a sample does not grow anything on the heap,
+and every statistic is kept up to date incrementally: the cost of a push does not depend on
+the window length.
+"""
+import struct
+from array import array
+from utime import ticks_diff
+
+
+class RingBuffer:
+    """
+    The last `capacity` samples of one channel.
+    average() comes from a running sum. minimum() and maximum() come from two monotonic deques
+    of buffer slots: the front of the min deque is the slot of the smallest value in the window
+    and every later entry is newer and larger, so a push only drops entries from the back and an
+    eviction only drops the front. Both deques are circular over preallocated arrays.
+    """
+
+    def __init__(self, capacity, typecode='f'):
+        self.capacity = capacity
+        self.values = array(typecode, [0] * capacity)
+        # next slot to write, and number of samples held
+        self.index = 0
+        self.count = 0
+        self.sum = 0
+        slot_typecode = 'H' if capacity <= 0xFFFF else 'L'
+        self._min_slots = array(slot_typecode, [0] * capacity)
+        self._min_head = 0
+        self._min_len = 0
+        self._max_slots = array(slot_typecode, [0] * capacity)
+        self._max_head = 0
+        self._max_len = 0
+
+    def __len__(self):
+        return self.count
+
+    # i-th sample counted from the oldest one in the window
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("ring buffer index out of range")
+        return self.values[(self.index - self.count + i) % self.capacity]
+
+    # the newest n samples, oldest first
+    def last(self, n):
+        n = min(n, self.count)
+        start = self.index - n
+        for i in range(n):
+            yield self.values[(start + i) % self.capacity]
+
+    # packs the newest n samples, oldest first and the newest skip samples left out, in the wire format of channel
+    # (channel_schema.Channel) into buffer at offset. returns the offset after them
+    def pack_last_into(self, n, buffer, offset, channel, skip=0):
+        n = max(min(n, self.count - skip), 0)
+        start = self.index - skip - n
+        for i in range(n):
+            offset = channel.pack_into(buffer, offset, self.values[(start + i) % self.capacity])
+        return offset
+
+    # drops the oldest sample from the window
+    def evict(self):
+        if not self.count:
+            return
+        capacity = self.capacity
+        slot = (self.index - self.count) % capacity
+        self.sum -= self.values[slot]
+        if self._min_len and self._min_slots[self._min_head] == slot:
+            self._min_head = (self._min_head + 1) % capacity
+            self._min_len -= 1
+        if self._max_len and self._max_slots[self._max_head] == slot:
+            self._max_head = (self._max_head + 1) % capacity
+            self._max_len -= 1
+        self.count -= 1
+        if not self.count:
+            self.sum = 0
+
+    def push(self, value):
+        if self.count == self.capacity:
+            self.evict()
+        slot = self.index
+        capacity = self.capacity
+        values = self.values
+        values[slot] = value
+        # read back the stored value so the running sum matches the array (float32 for 'f')
+        value = values[slot]
+        self.sum += value
+        self.count += 1
+
+        while self._min_len and values[self._min_slots[(self._min_head + self._min_len - 1) % capacity]] >= value:
+            self._min_len -= 1
+        self._min_slots[(self._min_head + self._min_len) % capacity] = slot
+        self._min_len += 1
+        while self._max_len and values[self._max_slots[(self._max_head + self._max_len - 1) % capacity]] <= value:
+            self._max_len -= 1
+        self._max_slots[(self._max_head + self._max_len) % capacity] = slot
+        self._max_len += 1
+
+        self.index = (slot + 1) % capacity
+        if self.index == 0:
+            # once per lap, recompute the sum to drop accumulated rounding error (amortised O(1)). the window
+            # is the last count slots, summed by index since a generator would allocate on the pico
+            total = 0
+            for i in range(capacity - self.count, capacity):
+                total += values[i]
+            self.sum = total
+
+    def average(self):
+        return self.sum / self.count if self.count else 0
+
+    def minimum(self):
+        return self.values[self._min_slots[self._min_head]] if self.count else float('inf')
+
+    def maximum(self):
+        return self.values[self._max_slots[self._max_head]] if self.count else float('-inf')
+
+
+class TimeWindow(RingBuffer):
+    """
+    The samples of the last `span_ms` milliseconds, at most `capacity` of them.
+    Each sample is stored with its ticks_ms timestamp and samples older than the span are
+    evicted from the front when a new one arrives or when expire() is called.
+    """
+
+    def __init__(self, span_ms, capacity, typecode='f'):
+        super().__init__(capacity, typecode)
+        self.span_ms = span_ms
+        self.ticks = array('l', [0] * capacity)
+
+    def expire(self, now_ms):
+        while self.count and ticks_diff(now_ms, self.ticks[(self.index - self.count) % self.capacity]) > self.span_ms:
+            self.evict()
+
+    def push(self, value, now_ms):
+        self.expire(now_ms)
+        self.ticks[self.index] = now_ms
+        super().push(value)
+
+
+# aggregation scopes, sent as the first param of the aggregation commands (0x02 - 0x04)
+SCOPE_LIFETIME = 0x00
+SCOPE_LAST_N = 0x01
+SCOPE_LAST_T = 0x02
+# order of the scopes in the packed aggregation payloads
+AGGREGATION_SCOPES = (SCOPE_LIFETIME, SCOPE_LAST_N, SCOPE_LAST_T)
+
+
+class ChannelStats:
+    """
+    Avg/min/max of one channel over each aggregation scope, all updated incrementally per sample:
+    SCOPE_LIFETIME since boot, SCOPE_LAST_N over the last `window` samples and SCOPE_LAST_T over the
+    last `span_s` seconds (`span_capacity` bounds the samples that period can hold).
+    """
+
+    def __init__(self, window, span_s, span_capacity):
+        self.window = RingBuffer(window)
+        self.span = TimeWindow(span_s * 1000, span_capacity)
+        self.lifetime_count = 0
+        self.lifetime_avg = 0
+        self.lifetime_min = float('inf')
+        self.lifetime_max = float('-inf')
+
+    def push(self, value, now_ms):
+        self.window.push(value)
+        self.span.push(value, now_ms)
+        self.lifetime_count += 1
+        # incremental mean, a running lifetime sum would lose precision in float32 on the pico
+        self.lifetime_avg += (value - self.lifetime_avg) / self.lifetime_count
+        self.lifetime_min = min(self.lifetime_min, value)
+        self.lifetime_max = max(self.lifetime_max, value)
+
+    # (avg, min, max) over scope
+    def aggregate(self, scope):
+        if scope == SCOPE_LIFETIME:
+            return self.lifetime_avg, self.lifetime_min, self.lifetime_max
+        values = self.window if scope == SCOPE_LAST_N else self.span
+        return values.average(), values.minimum(), values.maximum()
+
+    # packs avg/min/max of every scope in AGGREGATION_SCOPES order in the wire format of channel
+    # (channel_schema.Channel) into buffer at offset, without building the aggregate tuples.
+    # returns the offset after them
+    def pack_into(self, buffer, offset, channel):
+        for scope in AGGREGATION_SCOPES:
+            if scope == SCOPE_LIFETIME:
+                offset = channel.pack_into(buffer, offset, self.lifetime_avg)
+                offset = channel.pack_into(buffer, offset, self.lifetime_min)
+                offset = channel.pack_into(buffer, offset, self.lifetime_max)
+            else:
+                values = self.window if scope == SCOPE_LAST_N else self.span
+                offset = channel.pack_into(buffer, offset, values.average())
+                offset = channel.pack_into(buffer, offset, values.minimum())
+                offset = channel.pack_into(buffer, offset, values.maximum())
+        return offset
+
+
+class SampleLog:
+    """
+    The last `capacity` samples of `channels` channels, each stamped at the source with a sequence
+    number and its ticks_ms. Sequence numbers only grow, so a client that remembers where it stopped
+    can fetch just the newer samples. A sequence number that goes backwards (the source rebooted)
+    clears the log.
+    """
+
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.seqs = array('L', [0] * capacity)
+        self.ticks = array('l', [0] * capacity)
+        self.values = [array('f', [0] * capacity) for _ in range(channels)]
+        # next slot to write, and number of samples held
+        self.index = 0
+        self.count = 0
+        # sequence number following the newest sample
+        self.next_seq = 0
+
+    def push(self, seq, now_ms, values):
+        if seq < self.next_seq:
+            self.count = 0
+        slot = self.index
+        self.seqs[slot] = seq
+        self.ticks[slot] = now_ms
+        for channel in range(len(values)):
+            self.values[channel][slot] = values[channel]
+        self.index = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.next_seq = seq + 1
+
+    def _slot(self, i):
+        return (self.index - self.count + i) % self.capacity
+
+    # position (counted from the oldest sample) of the first sample with a sequence number >= seq
+    def position(self, seq):
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.seqs[self._slot(middle)] < seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # packs at most `limit` samples with sequence numbers >= since_seq into buffer at offset, oldest first,
+    # each as <I age_ms followed by one value per channel in the wire format of channels[channel]
+    # (channel_schema.Channel). A since_seq newer than the log (the client saw a source that rebooted since)
+    # starts over from the oldest sample. returns (samples packed, sequence number to ask for next time)
+    def pack_since_into(self, buffer, offset, since_seq, limit, now_ms, channels):
+        if since_seq > self.next_seq:
+            since_seq = 0
+        start = self.position(since_seq)
+        count = min(self.count - start, limit)
+        for i in range(start, start + count):
+            slot = self._slot(i)
+            struct.pack_into("<I", buffer, offset, ticks_diff(now_ms, self.ticks[slot]))
+            offset += 4
+            for channel in range(len(channels)):
+                offset = channels[channel].pack_into(buffer, offset, self.values[channel][slot])
+        next_seq = self.seqs[self._slot(start + count - 1)] + 1 if count else max(since_seq, self.next_seq)
+        return count, next_seq
@@ -0,0 +1,130 @@
+"""
+Multi-resolution history kept on both picos (final_i2c.py and finalperipheral_documented.py).
+Copy this file to each pico next to the firmware.
+
+Every sample is folded into a few tiers of fixed length buckets (for example 1 s, 1 min and
+1 h) holding min/sum/max/count, so hours or days of history fit in a fixed amount of RAM and
+a range query never touches raw samples. Buckets hold the channel's fixed-point wire integers
+(channel_schema.Channel), so an hour of pressure around 1013 hPa sums exactly instead of
+losing the last digits to float32.
+"""
+import struct
+from array import array
+from utime import ticks_diff, ticks_add
+
+# (bucket ms, buckets) per tier, tier id = index: 2 min of 1 s, 2 h of 1 min and 2 days of 1 h buckets.
+# shared by both picos so the central can page through the peripheral's tiers
+ROLLUP_TIERS = ((1000, 120), (60000, 120), (3600000, 48))
+# bytes of one packed bucket
+BUCKET_SIZE = 8
+
+
+# (first, last): offsets first to last - 1 (buckets before the filling one, newest first) overlap the ages
+# [end_ago_ms, start_ago_ms]. age_ms is the age of the filling bucket's start and filled the number of buckets
+# holding data
+def bucket_offsets(age_ms, bucket_ms, filled, start_ago_ms, end_ago_ms):
+    first = 0
+    while first < filled and age_ms + first * bucket_ms < end_ago_ms:
+        first += 1
+    last = first
+    while last < filled and age_ms + (last - 1) * bucket_ms < start_ago_ms:
+        last += 1
+    return first, last
+
+
+class RollupTier:
+    """
+    The last `buckets` buckets of `bucket_ms` milliseconds each, newest one still filling.
+    Buckets live in preallocated arrays used as a ring. A bucket without samples has count 0.
+    Values are kept as wire integers of `channel` (channel_schema.Channel), sums in 64 bits.
+    """
+
+    def __init__(self, bucket_ms, buckets, channel):
+        self.bucket_ms = bucket_ms
+        self.buckets = buckets
+        self.channel = channel
+        self.mins = array('l', [0] * buckets)
+        self.maxs = array('l', [0] * buckets)
+        self.sums = array('q', [0] * buckets)
+        self.counts = array('L', [0] * buckets)
+        # slot of the filling bucket, ticks_ms at which it started, and buckets holding data so far
+        self.index = 0
+        self.start_ms = None
+        self.filled = 0
+
+    def _advance(self, now_ms):
+        if self.start_ms is None:
+            self.start_ms = now_ms
+            self.filled = 1
+            return
+        steps = ticks_diff(now_ms, self.start_ms) // self.bucket_ms
+        if steps <= 0:
+            return
+        # close the filling bucket and open one per elapsed bucket period, empty ones included
+        for _ in range(min(steps, self.buckets)):
+            self.index = (self.index + 1) % self.buckets
+            self.counts[self.index] = 0
+            self.sums[self.index] = 0
+        self.filled = min(self.filled + steps, self.buckets)
+        self.start_ms = ticks_add(self.start_ms, steps * self.bucket_ms)
+
+    def push(self, value, now_ms):
+        self._advance(now_ms)
+        value = self.channel.encode(value)
+        slot = self.index
+        if self.counts[slot]:
+            self.mins[slot] = min(self.mins[slot], value)
+            self.maxs[slot] = max(self.maxs[slot], value)
+        else:
+            self.mins[slot] = value
+            self.maxs[slot] = value
+        self.sums[slot] += value
+        self.counts[slot] += 1
+
+    # age in ms of the start of the bucket `offset` buckets before the filling one
+    def age_ms(self, offset, now_ms):
+        return ticks_diff(now_ms, self.start_ms) + offset * self.bucket_ms
+
+    # wire integer of the bucket's average, rounded half up
+    def _average(self, slot, count):
+        return (2 * self.sums[slot] + count) // (2 * count)
+
+    # (min, avg, max, count) of the bucket `offset` buckets before the filling one
+    def bucket(self, offset):
+        slot = (self.index - offset) % self.buckets
+        count = self.counts[slot]
+        if not count:
+            return 0, 0, 0, 0
+        decode = self.channel.decode
+        return decode(self.mins[slot]), decode(self._average(slot, count)), decode(self.maxs[slot]), count
+
+    # (first, last) offsets of the buckets overlapping the ages [end_ago_ms, start_ago_ms], see bucket_offsets()
+    def offsets(self, start_ago_ms, end_ago_ms, now_ms):
+        if self.start_ms is None:
+            return 0, 0
+        return bucket_offsets(self.age_ms(0, now_ms), self.bucket_ms, self.filled, start_ago_ms, end_ago_ms)
+
+    # packs min, avg and max of the bucket at offset in the tier's channel wire format (2 bytes each)
+    # followed by its <H count into buffer at buffer_offset. an empty bucket is all zeros
+    def pack_bucket_into(self, buffer, buffer_offset, offset):
+        slot = (self.index - offset) % self.buckets
+        count = self.counts[slot]
+        if not count:
+            struct.pack_into("<4H", buffer, buffer_offset, 0, 0, 0, 0)
+            return
+        channel = self.channel
+        buffer_offset = channel.pack_raw_into(buffer, buffer_offset, self.mins[slot])
+        buffer_offset = channel.pack_raw_into(buffer, buffer_offset, self._average(slot, count))
+        buffer_offset = channel.pack_raw_into(buffer, buffer_offset, self.maxs[slot])
+        struct.pack_into("<H", buffer, buffer_offset, min(count, 0xFFFF))
+
+
+class ChannelRollups:
+    """One RollupTier per (bucket_ms, buckets) entry of `tiers` for a single channel_schema.Channel."""
+
+    def __init__(self, tiers, channel):
+        self.tiers = [RollupTier(bucket_ms, buckets, channel) for bucket_ms, buckets in tiers]
+
+    def push(self, value, now_ms):
+        for tier in self.tiers:
+            tier.push(value, now_ms)
@@ -0,0 +1,110 @@
+"""
+Host-side store of every stamped sample the GUI (final_gui_app.py) receives, kept in SQLite.
+Each sample is also folded into downsampled tiers (1 min and 1 h buckets holding
+count/min/sum/max per channel) when it is inserted, so a range query over days of data reads a
+few hundred bucket rows instead of every sample. Queries pick the finest tier that fits the
+number of points a chart can show, and export_csv() writes the raw samples of a range.
+"""
+import csv
+import sqlite3
+from datetime import datetime
+
+# channels of a sample, in the order of the sample tuples (epoch ms, humidity, temperature, pressure)
+CHANNELS = ('humidity', 'temperature', 'pressure')
+# bucket length of each downsampled tier (ms), finest first
+TIERS_MS = (60000, 3600000)
+
+
+class SampleStore:
+    """
+    Samples per device in the samples table, keyed by (device, epoch ms), and one row per
+    (device, tier, bucket start) in the rollups table. A sample already stored (same device and
+    time stamp) is skipped, so feeding overlapping responses never counts a sample twice.
+    """
+
+    def __init__(self, path, tiers_ms=TIERS_MS):
+        self.tiers_ms = tiers_ms
+        self.connection = sqlite3.connect(path)
+        # WAL keeps a commit per batch of samples cheap
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        channel_columns = ', '.join(f'{channel} REAL' for channel in CHANNELS)
+        rollup_columns = ', '.join(f'{channel}_min REAL, {channel}_sum REAL, {channel}_max REAL' for channel in CHANNELS)
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS samples (device TEXT NOT NULL, ts_ms INTEGER NOT NULL, {channel_columns}, "
+            f"PRIMARY KEY (device, ts_ms)) WITHOUT ROWID")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS rollups (device TEXT NOT NULL, bucket_ms INTEGER NOT NULL, "
+            f"start_ms INTEGER NOT NULL, count INTEGER NOT NULL, {rollup_columns}, "
+            f"PRIMARY KEY (device, bucket_ms, start_ms)) WITHOUT ROWID")
+        self.connection.commit()
+
+        placeholders = ', '.join('?' * (2 + len(CHANNELS)))
+        self.insert_sample = f"INSERT OR IGNORE INTO samples VALUES ({placeholders})"
+        new_bucket = ', '.join('?, ?, ?' for _ in CHANNELS)
+        merge = ', '.join(f'{channel}_min = min({channel}_min, excluded.{channel}_min), '
+                          f'{channel}_sum = {channel}_sum + excluded.{channel}_sum, '
+                          f'{channel}_max = max({channel}_max, excluded.{channel}_max)' for channel in CHANNELS)
+        self.upsert_bucket = (f"INSERT INTO rollups VALUES (?, ?, ?, 1, {new_bucket}) "
+                              f"ON CONFLICT (device, bucket_ms, start_ms) DO UPDATE SET count = count + 1, {merge}")
+
+    def close(self):
+        self.connection.close()
+
+    # samples: (epoch ms, humidity, temperature, pressure) tuples, stored in one transaction
+    def add_samples(self, device, samples):
+        with self.connection:
+            for sample in samples:
+                ts_ms = int(sample[0])
+                if self.connection.execute(self.insert_sample, (device, ts_ms) + tuple(sample[1:])).rowcount != 1:
+                    continue
+                bucket_values = []
+                for value in sample[1:]:
+                    bucket_values += [value, value, value]
+                for bucket_ms in self.tiers_ms:
+                    self.connection.execute(self.upsert_bucket,
+                                            [device, bucket_ms, ts_ms - ts_ms % bucket_ms] + bucket_values)
+
+    # (epoch ms, humidity, temperature, pressure) of every sample in [start_ms, end_ms], oldest first
+    def samples(self, device, start_ms, end_ms):
+        return self.connection.execute(
+            f"SELECT ts_ms, {', '.join(CHANNELS)} FROM samples WHERE device = ? AND ts_ms BETWEEN ? AND ? "
+            f"ORDER BY ts_ms", (device, start_ms, end_ms)).fetchall()
+
+    # (bucket start ms, count, then min, avg, max per channel) of the tier's buckets overlapping [start_ms, end_ms]
+    def buckets(self, device, bucket_ms, start_ms, end_ms):
+        columns = ', '.join(f'{channel}_min, {channel}_sum / count, {channel}_max' for channel in CHANNELS)
+        return self.connection.execute(
+            f"SELECT start_ms, count, {columns} FROM rollups WHERE device = ? AND bucket_ms = ? "
+            f"AND start_ms BETWEEN ? AND ? ORDER BY start_ms",
+            (device, bucket_ms, start_ms - start_ms % bucket_ms, end_ms)).fetchall()
+
+    # (tier bucket ms or 0 for raw samples, (epoch ms, humidity, temperature, pressure) rows) over
+    # [start_ms, end_ms] from the finest tier that yields at most max_points rows. Bucket rows carry
+    # the channel averages and are stamped at the middle of their bucket
+    def query(self, device, start_ms, end_ms, max_points):
+        # the finest tier's counts add up to the number of raw samples without scanning them
+        raw_count = self.connection.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM rollups WHERE device = ? AND bucket_ms = ? AND start_ms BETWEEN ? AND ?",
+            (device, self.tiers_ms[0], start_ms - start_ms % self.tiers_ms[0], end_ms)).fetchone()[0]
+        if raw_count <= max_points:
+            return 0, self.samples(device, start_ms, end_ms)
+        for bucket_ms in self.tiers_ms:
+            buckets = (end_ms - start_ms) // bucket_ms + 1
+            if buckets <= max_points or bucket_ms == self.tiers_ms[-1]:
+                rows = self.buckets(device, bucket_ms, start_ms, end_ms)
+                # min, avg, max per channel after the start and count columns, keep the averages
+                return bucket_ms, [(row[0] + bucket_ms // 2,) + row[3::3] for row in rows]
+
+    # writes the raw samples of [start_ms, end_ms] to a csv file object, returns the number of rows written
+    def export_csv(self, file, device, start_ms, end_ms):
+        writer = csv.writer(file)
+        writer.writerow(('device', 'time', 'epoch_ms') + CHANNELS)
+        count = 0
+        cursor = self.connection.execute(
+            f"SELECT ts_ms, {', '.join(CHANNELS)} FROM samples WHERE device = ? AND ts_ms BETWEEN ? AND ? "
+            f"ORDER BY ts_ms", (device, start_ms, end_ms))
+        for row in cursor:
+            writer.writerow((device, datetime.fromtimestamp(row[0] / 1000).isoformat(timespec='milliseconds')) + row)
+            count += 1
+        return count
@@ -0,0 +1,126 @@
+"""
+Send-on-delta sampling schedule of both picos (final_i2c.py and finalperipheral_documented.py).
+Copy this file to each pico next to the firmware.
+
+Every channel has a deadband and a range of sampling periods. After each sample the period of a
+channel moves halfway towards half the time its value would take to cross the deadband at the
+rate of change just seen, within [min_period_ms, max_period_ms], and the sensor sleeps for the
+shortest period of any channel: it samples fast while conditions change and backs off to the
+slowest period while they are stable. A channel is due for publishing once its value moved by
+its deadband or more since it was last published, or when heartbeat_ms passed without any
+publish, so payloads and notifications are only rewritten when there is news. Deadbands are
+wire integers of the channel (channel_schema.py), 0 publishes every sample. All arithmetic is
+on small ints, nothing is allocated per sample.
+
+The schedule is read and set over the protocol with command 0x0C (read, or write with params
+[channel, min_period_ms, max_period_ms, deadband]), answered with one <BIIII entry per channel:
+
+    channel id, min period ms, max period ms, deadband, current period ms
+"""
+import struct
+from utime import ticks_diff
+
+# one channel's entry of the sampling command (0x0C) and of the peripheral's config characteristic
+ENTRY_FORMAT = "<BIIII"
+ENTRY_SIZE = 17
+# a write of one channel's schedule: channel id, min period ms, max period ms, deadband
+WRITE_FORMAT = "<BIII"
+WRITE_SIZE = 13
+
+
+class ChannelSchedule:
+    """Sampling period and send-on-delta state of one channel, values as wire integers."""
+
+    def __init__(self, min_period_ms, max_period_ms, deadband):
+        self.min_period_ms = min_period_ms
+        self.max_period_ms = max_period_ms
+        self.deadband = deadband
+        self.period_ms = min_period_ms
+        # previous sample and when it was taken, the value last published, and whether the latest sample is due
+        self.last = None
+        self.last_ms = 0
+        self.published = None
+        self.due = True
+
+    def update(self, raw, now_ms):
+        if self.last is not None:
+            change = abs(raw - self.last)
+            elapsed_ms = ticks_diff(now_ms, self.last_ms)
+            # half the time the value takes to move by the deadband at this rate, so the crossing is caught
+            target_ms = self.deadband * elapsed_ms // (2 * change) if change else self.max_period_ms
+            period_ms = (self.period_ms + target_ms + 1) // 2
+            self.period_ms = max(self.min_period_ms, min(period_ms, self.max_period_ms))
+        self.last = raw
+        self.last_ms = now_ms
+        self.due = self.published is None or abs(raw - self.published) >= self.deadband
+        if self.due:
+            self.published = raw
+        return self.due
+
+
+class AdaptiveSampler:
+    """
+    One ChannelSchedule per channel_schema.Channel in channels, all sampled together.
+    floor_ms is the fastest period the firmware's buffers are sized for, configure() refuses
+    anything faster. deadbands are in the channels' units.
+    """
+
+    def __init__(self, channels, floor_ms, max_period_ms, deadbands, heartbeat_ms):
+        self.channels = channels
+        self.floor_ms = floor_ms
+        self.heartbeat_ms = heartbeat_ms
+        self.schedules = [ChannelSchedule(floor_ms, max_period_ms, int(round(deadbands[i] * channels[i].scale)))
+                          for i in range(len(channels))]
+        self.period_ms = floor_ms
+        self.published_ms = None
+
+    # takes the sample values (one per channel, in their units), returns True when any channel is due.
+    # due(channel) tells which ones, period_ms is the time to sleep until the next sample
+    def update(self, now_ms, values):
+        heartbeat = self.published_ms is None or ticks_diff(now_ms, self.published_ms) >= self.heartbeat_ms
+        any_due = heartbeat
+        period_ms = None
+        for i in range(len(self.schedules)):
+            schedule = self.schedules[i]
+            if schedule.update(self.channels[i].encode(values[i]), now_ms):
+                any_due = True
+            elif heartbeat:
+                schedule.due = True
+                schedule.published = schedule.last
+            if period_ms is None or schedule.period_ms < period_ms:
+                period_ms = schedule.period_ms
+        self.period_ms = period_ms
+        if any_due:
+            self.published_ms = now_ms
+        return any_due
+
+    def due(self, channel):
+        return self.schedules[channel].due
+
+    # sets a channel's schedule, returns False (nothing changed) when the channel or periods are invalid
+    def configure(self, channel, min_period_ms, max_period_ms, deadband):
+        if channel >= len(self.schedules) or min_period_ms < self.floor_ms or max_period_ms < min_period_ms:
+            return False
+        schedule = self.schedules[channel]
+        schedule.min_period_ms = min_period_ms
+        schedule.max_period_ms = max_period_ms
+        schedule.deadband = deadband
+        schedule.period_ms = min_period_ms
+        # the next sample is published whatever it is
+        schedule.published = None
+        return True
+
+    # sets a channel's schedule from a WRITE_FORMAT payload, returns False when it is invalid
+    def configure_from(self, data):
+        if len(data) < WRITE_SIZE:
+            return False
+        return self.configure(*struct.unpack_from(WRITE_FORMAT, data))
+
+    # packs one ENTRY_FORMAT entry per channel into buffer at offset, returns the offset after them
+    def pack_into(self, buffer, offset):
+        for i in range(len(self.schedules)):
+            schedule = self.schedules[i]
+            struct.pack_into(ENTRY_FORMAT, buffer, offset, self.channels[i].channel_id, schedule.min_period_ms,
+                             schedule.max_period_ms, schedule.deadband, schedule.period_ms)
+            offset += ENTRY_SIZE
+        return offset
@@ -0,0 +1,299 @@
+"""
+Host daemon that owns the serial link to the central pico and shares it with several local
+clients (the GUI, loggers, a second viewer) over TCP and/or a Unix socket. Clients speak the
+framed protocol (PROTOCOL_FRAMED) exactly as on the uart, so the GUI only needs the port name
+socket://localhost:7000 instead of the serial device (python final_gui_app.py socket://localhost:7000).
+
+Request ids are rewritten on the way to the central, so clients can use overlapping ids.
+A read request whose dataframe equals one already in flight is not sent again, its client gets
+a copy of the same response. Subscriptions with equal subscribe dataframes share one upstream
+subscription and every push is fanned out to all of their subscribers. The last push is kept and
+sent to a subscriber joining later, since an on-change subscription only pushes again once the
+value changes. Samples Since subscriptions (command 0x08) are never shared, each streams from its
+own since_seq onwards. The upstream subscription is only cancelled once its last subscriber
+unsubscribed or disconnected. Newline framed clients (PROTOCOL_NEWLINE) are not supported.
+
+    python serial_mux.py --port COM5 --tcp 7000 [--unix /tmp/pico.sock]
+"""
+import argparse
+import asyncio
+import struct
+import threading
+import time
+import serial
+from custom_protocol import FRAME_DELIMITER, encode_frame, decode_frame
+
+_OPERATION_READ = 0x01
+_OPERATION_SUBSCRIBE = 0x04
+_OPERATION_UNSUBSCRIBE = 0x05
+# incremental time series: its subscriptions move their since_seq forward upstream, a joiner would miss samples
+_COMMAND_SAMPLES_SINCE = 0x08
+# bytes queued for a client before pushes to it are dropped, so one slow client never stalls the rest
+_CLIENT_BUFFER_MAX = 1 << 20
+
+
+class MuxClient:
+    """One connected client: splits its byte stream into frames and writes frames back to it."""
+
+    def __init__(self, mux, reader, writer):
+        self.mux = mux
+        self.reader = reader
+        self.writer = writer
+        self.name = writer.get_extra_info('peername') or 'unix client'
+
+    async def run(self):
+        print("client connected", self.name)
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(4096)
+                if not data:
+                    break
+                buffer += data
+                while True:
+                    end = buffer.find(FRAME_DELIMITER)
+                    if end < 0:
+                        break
+                    encoded = bytes(buffer[:end])
+                    del buffer[:end + 1]
+                    if not encoded:
+                        continue
+                    decoded = decode_frame(encoded)
+                    if decoded is None:
+                        print("dropped corrupt frame from", self.name)
+                        continue
+                    self.mux.request(self, *decoded)
+        except ConnectionError as e:
+            print("client connection lost", self.name, e)
+        finally:
+            self.mux.disconnect(self)
+            self.writer.close()
+            print("client disconnected", self.name)
+
+    def send(self, request_id, dataframe):
+        if not self.writer.is_closing():
+            self.writer.write(encode_frame(dataframe, request_id))
+
+    # streamed data is dropped instead of queued when the client does not keep up
+    def push(self, request_id, dataframe):
+        if self.writer.transport.get_write_buffer_size() > _CLIENT_BUFFER_MAX:
+            return
+        self.send(request_id, dataframe)
+
+
+class SerialMux:
+    """
+    Routes client requests to the central and its responses back, on one asyncio loop.
+    The serial port is read on a separate thread, which reopens it with backoff when it fails
+    and resends the active subscriptions.
+    """
+
+    def __init__(self, port_name, baud_rate, response_timeout=5):
+        self.port_name = port_name
+        self.baud_rate = baud_rate
+        # seconds after which an unanswered read no longer takes merged requests
+        self.response_timeout = response_timeout
+        self.port = None
+        self.write_lock = threading.Lock()
+        self.loop = None
+        self.next_request_id = 1
+        # upstream id -> [dataframe, time sent, [(client, client request id), ...]] of the requests in flight
+        self.reads = {}
+        # dataframe -> upstream id of the read requests that later identical ones merge into
+        self.reads_by_frame = {}
+        # upstream id -> [subscribe dataframe, {(client, client request id), ...}]
+        self.subscriptions = {}
+        self.subscriptions_by_frame = {}
+
+    def allocate_request_id(self):
+        # 0 is never used, ids still in flight or subscribed are skipped
+        while True:
+            request_id = self.next_request_id
+            self.next_request_id = request_id % 0xFFFF + 1
+            if request_id not in self.reads and request_id not in self.subscriptions:
+                return request_id
+
+    def write(self, dataframe, request_id):
+        with self.write_lock:
+            if self.port is None:
+                # the link is down, the client's retry goes out once it is back
+                return
+            try:
+                self.port.write(encode_frame(dataframe, request_id))
+            except serial.SerialException as e:
+                print("serial write failed", e)
+
+    # forget reads the central never answered, their clients have retried or given up
+    def expire(self, now):
+        for request_id, (dataframe, sent, _) in list(self.reads.items()):
+            if now - sent > self.response_timeout:
+                del self.reads[request_id]
+                if self.reads_by_frame.get(dataframe) == request_id:
+                    del self.reads_by_frame[dataframe]
+
+    def request(self, client, client_id, dataframe):
+        if len(dataframe) < 8:
+            return
+        operation_id = dataframe[4]
+        if operation_id == _OPERATION_SUBSCRIBE:
+            self.subscribe(client, client_id, dataframe)
+        elif operation_id == _OPERATION_UNSUBSCRIBE:
+            self.unsubscribe(client, client_id, dataframe)
+        else:
+            now = time.monotonic()
+            self.expire(now)
+            # only reads are merged, anything else may change state on the central
+            upstream_id = self.reads_by_frame.get(dataframe) if operation_id == _OPERATION_READ else None
+            if upstream_id is None:
+                upstream_id = self.allocate_request_id()
+                self.reads[upstream_id] = [dataframe, now, []]
+                if operation_id == _OPERATION_READ:
+                    self.reads_by_frame[dataframe] = upstream_id
+                self.write(dataframe, upstream_id)
+            self.reads[upstream_id][2].append((client, client_id))
+
+    def subscribe(self, client, client_id, dataframe):
+        # like the central, a subscribe request reusing a subscription's id replaces that subscription
+        self.drop_subscriber(client, client_id)
+        shared = struct.unpack("<h", dataframe[5:7])[0] != _COMMAND_SAMPLES_SINCE
+        upstream_id = self.subscriptions_by_frame.get(dataframe) if shared else None
+        if upstream_id is None:
+            upstream_id = self.allocate_request_id()
+            # dataframe, subscribers and the last push
+            self.subscriptions[upstream_id] = [dataframe, set(), None]
+            if shared:
+                self.subscriptions_by_frame[dataframe] = upstream_id
+            self.write(dataframe, upstream_id)
+        elif self.subscriptions[upstream_id][2] is not None:
+            # the joiner gets the state the others already have (or the refusal they got)
+            client.push(client_id, self.subscriptions[upstream_id][2])
+        self.subscriptions[upstream_id][1].add((client, client_id))
+
+    def unsubscribe(self, client, client_id, dataframe):
+        found = False
+        if dataframe[7] >= 1 and len(dataframe) >= 12:
+            found = self.drop_subscriber(client, struct.unpack("<I", dataframe[8:12])[0])
+        # answered here, error id 0x03 when the client has no subscription with that id
+        client.send(client_id, bytes(dataframe[:7]) + bytes([0x00, 0x00, 0x00 if found else 0x03]))
+
+    # removes the client's subscription client_id, cancels it upstream once nobody else shares it
+    def drop_subscriber(self, client, client_id):
+        for upstream_id, subscription in self.subscriptions.items():
+            subscribers = subscription[1]
+            if (client, client_id) in subscribers:
+                subscribers.discard((client, client_id))
+                if not subscribers:
+                    self.cancel_upstream(upstream_id)
+                return True
+        return False
+
+    def cancel_upstream(self, upstream_id):
+        dataframe = self.subscriptions.pop(upstream_id)[0]
+        if self.subscriptions_by_frame.get(dataframe) == upstream_id:
+            del self.subscriptions_by_frame[dataframe]
+        unsubscribe = bytes(dataframe[:4]) + bytes([_OPERATION_UNSUBSCRIBE]) + bytes(dataframe[5:7]) + bytes([1])
+        # the acknowledgement comes back under an id nobody waits for and is dropped
+        self.write(unsubscribe + struct.pack("<I", upstream_id), self.allocate_request_id())
+
+    def disconnect(self, client):
+        for read in self.reads.values():
+            read[2] = [waiter for waiter in read[2] if waiter[0] is not client]
+        for upstream_id, subscription in list(self.subscriptions.items()):
+            subscribers = subscription[1]
+            for waiter in [waiter for waiter in subscribers if waiter[0] is client]:
+                subscribers.discard(waiter)
+            if not subscribers:
+                self.cancel_upstream(upstream_id)
+
+    # a frame from the central, called on the event loop
+    def response(self, upstream_id, dataframe):
+        read = self.reads.pop(upstream_id, None)
+        if read is not None:
+            if self.reads_by_frame.get(read[0]) == upstream_id:
+                del self.reads_by_frame[read[0]]
+            for client, client_id in read[2]:
+                client.send(client_id, dataframe)
+            return
+        subscription = self.subscriptions.get(upstream_id)
+        if subscription is None:
+            return
+        subscription[2] = dataframe
+        for client, client_id in subscription[1]:
+            client.push(client_id, dataframe)
+
+    def open_port(self):
+        port = serial.serial_for_url(self.port_name, baudrate=self.baud_rate, timeout=0.1)
+        with self.write_lock:
+            self.port = port
+        # the central may have rebooted while the link was down, resubscribing under the same id is harmless
+        for upstream_id, subscription in list(self.subscriptions.items()):
+            self.write(subscription[0], upstream_id)
+        print("serial port open", self.port_name)
+
+    # serial reader thread: hands every decoded frame to the event loop
+    def read_serial(self):
+        backoff_s = 0.5
+        buffer = bytearray()
+        while True:
+            if self.port is None:
+                try:
+                    self.open_port()
+                    buffer = bytearray()
+                    backoff_s = 0.5
+                except serial.SerialException as e:
+                    print("serial open failed", e)
+                    time.sleep(backoff_s)
+                    backoff_s = min(backoff_s * 2, 10)
+                    continue
+            try:
+                buffer += self.port.read(max(1, self.port.in_waiting))
+            except serial.SerialException as e:
+                print("serial port lost", e)
+                with self.write_lock:
+                    self.port.close()
+                    self.port = None
+                continue
+            while True:
+                end = buffer.find(FRAME_DELIMITER)
+                if end < 0:
+                    break
+                encoded = bytes(buffer[:end])
+                del buffer[:end + 1]
+                if not encoded:
+                    continue
+                decoded = decode_frame(encoded)
+                if decoded is None:
+                    print("dropped corrupt frame from the central")
+                    continue
+                self.loop.call_soon_threadsafe(self.response, *decoded)
+
+    async def serve(self, tcp_port=None, unix_path=None, host='127.0.0.1'):
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.read_serial, daemon=True).start()
+
+        async def client_connected(reader, writer):
+            await MuxClient(self, reader, writer).run()
+
+        servers = []
+        if tcp_port is not None:
+            servers.append(await asyncio.start_server(client_connected, host, tcp_port))
+            print("listening on", f"socket://{host}:{tcp_port}")
+        if unix_path is not None:
+            servers.append(await asyncio.start_unix_server(client_connected, unix_path))
+            print("listening on", unix_path)
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the central pico's serial link with several clients")
+    parser.add_argument('--port', default='COM5', help="serial port (or pyserial URL) of the central")
+    parser.add_argument('--baud', type=int, default=115000)
+    parser.add_argument('--tcp', type=int, default=7000, help="TCP port on localhost, 0 to disable")
+    parser.add_argument('--unix', default=None, help="path of a Unix socket to listen on as well")
+    args = parser.parse_args()
+    mux = SerialMux(args.port, args.baud)
+    asyncio.run(mux.serve(args.tcp or None, args.unix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+Long lived serial session between the GUI (final_gui_app.py) and the central pico.
+The port is opened once and owned by a QThread: request batches are queued from the GUI
+thread, written and read on the session thread, and the response dataframes come back through
+Qt signals, so the window never blocks on the uart or on a BLE round-trip behind it.
+When the port fails the session reopens it with exponential backoff and resends the active
+subscriptions. The port name is passed to serial.serial_for_url(), so URLs such as
+socket://host:port work as well as device names.
+"""
+import queue
+import threading
+import time
+import serial
+from PyQt5.QtCore import QThread, pyqtSignal
+from custom_protocol import PROTOCOL_NEWLINE, PROTOCOL_FRAMED, FRAME_DELIMITER, encode_frame, decode_frame
+
+
+class SerialSession(QThread):
+    # (callback, response dataframes in request order) once every request of a batch is answered
+    answered = pyqtSignal(object, object)
+    # (callback, error message) when a batch could not be answered
+    failed = pyqtSignal(object, str)
+    # (subscription request id, pushed dataframe)
+    pushed = pyqtSignal(int, bytes)
+    # True when the port was opened, False when it was lost
+    connection_changed = pyqtSignal(bool)
+
+    def __init__(self, port_name, baud_rate, protocol_id=PROTOCOL_FRAMED, response_timeout=5, max_retries=2,
+                 parent=None):
+        super().__init__(parent)
+        self.port_name = port_name
+        self.baud_rate = baud_rate
+        self.protocol_id = protocol_id
+        # seconds to wait for the next response frame, and how often a batch is resent when none arrives
+        self.response_timeout = response_timeout
+        self.max_retries = max_retries
+        # seconds between reads while idle, and the reconnect backoff bounds
+        self.poll_s = 0.05
+        self.reconnect_min_s = 0.5
+        self.reconnect_max_s = 10
+
+        self.jobs = queue.Queue()
+        # request ids are handed out to the GUI thread (subscribe) and used on the session thread
+        self.id_lock = threading.Lock()
+        self.next_request_id = 1
+        # request ids in use: None until released (subscriptions, requests awaiting their response) or the
+        # time.monotonic() until which a response nobody waits for any more may still arrive
+        self.reserved_ids = {}
+        # subscribe dataframe per subscription request id, only touched on the session thread
+        self.subscriptions = {}
+        self.port = None
+        self.buffer = bytearray()
+        self.running = True
+
+    # request ids matching framed responses to their requests, 0 is never used. ids still reserved are skipped, so
+    # after wrapping around a request never gets the id of a subscription and takes its pushes for the response.
+    # the id stays reserved until released, or for hold_s seconds when given
+    def allocate_request_id(self, hold_s=None):
+        now = time.monotonic()
+        with self.id_lock:
+            while True:
+                request_id = self.next_request_id
+                self.next_request_id = request_id % 0xFFFF + 1
+                until = self.reserved_ids.get(request_id, now)
+                if until is not None and until <= now:
+                    self.reserved_ids[request_id] = None if hold_s is None else now + hold_s
+                    return request_id
+
+    # frees a reserved request id, after hold_s seconds when a response or push for it may still arrive
+    def release_request_id(self, request_id, hold_s=0):
+        with self.id_lock:
+            if hold_s:
+                self.reserved_ids[request_id] = time.monotonic() + hold_s
+            else:
+                self.reserved_ids.pop(request_id, None)
+
+    # queues dataframes sent as one pipelined batch, callback is handed back with the answered/failed signal
+    def submit(self, dataframes, callback):
+        self.jobs.put(('request', dataframes, callback))
+
+    # queues a subscribe dataframe, pushes arrive through the pushed signal with the returned request id
+    def subscribe(self, dataframe):
+        request_id = self.allocate_request_id()
+        self.jobs.put(('subscribe', request_id, dataframe))
+        return request_id
+
+    # queues the unsubscribe dataframe of the subscription request_id, its acknowledgement is not awaited
+    def unsubscribe(self, request_id, dataframe):
+        self.jobs.put(('unsubscribe', request_id, dataframe))
+
+    # lets the queued jobs go out, then closes the port and ends the thread
+    def stop(self):
+        self.jobs.put(('stop',))
+        self.wait()
+
+    def run(self):
+        backoff_s = self.reconnect_min_s
+        while self.running:
+            if self.port is None:
+                try:
+                    self._open()
+                    backoff_s = self.reconnect_min_s
+                except serial.SerialException as e:
+                    print("serial session: open failed", e)
+                    self._close()
+                    self._fail_queued(f"Serial port {self.port_name} is not available: {e}")
+                    if self.running:
+                        time.sleep(backoff_s)
+                    backoff_s = min(backoff_s * 2, self.reconnect_max_s)
+                    continue
+            try:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    # waits up to poll_s for pushes
+                    self._drain_pushes()
+                    continue
+                self._run_job(job)
+            except serial.SerialException as e:
+                print("serial session: port lost", e)
+                self._close()
+        self._close()
+
+    def _open(self):
+        self.port = serial.serial_for_url(self.port_name, baudrate=self.baud_rate, timeout=self.poll_s)
+        self.buffer = bytearray()
+        # the central may have rebooted meanwhile, resubscribing under the same id replaces a live subscription
+        for request_id, dataframe in self.subscriptions.items():
+            self._write(dataframe, request_id)
+        self.connection_changed.emit(True)
+
+    def _close(self):
+        if self.port is None:
+            return
+        try:
+            self.port.close()
+        except serial.SerialException as e:
+            print("serial session: close failed", e)
+        self.port = None
+        self.connection_changed.emit(False)
+
+    # handles the queued jobs while the port is closed: requests fail right away instead of waiting
+    def _fail_queued(self, message):
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job[0] == 'request':
+                self.failed.emit(job[2], message)
+            else:
+                self._run_job(job)
+
+    def _run_job(self, job):
+        kind = job[0]
+        if kind == 'stop':
+            self.running = False
+        elif kind == 'subscribe':
+            _, request_id, dataframe = job
+            self.subscriptions[request_id] = dataframe
+            if self.port is not None:
+                self._write(dataframe, request_id)
+        elif kind == 'unsubscribe':
+            _, request_id, dataframe = job
+            self.subscriptions.pop(request_id, None)
+            # pushes sent before the central got the unsubscribe may still come in, and so may its acknowledgement
+            self.release_request_id(request_id, self.response_timeout)
+            if self.port is not None:
+                self._write(dataframe, hold_s=self.response_timeout)
+        else:
+            _, dataframes, callback = job
+            try:
+                self._request(dataframes, callback)
+            except serial.SerialException as e:
+                self.failed.emit(callback, str(e))
+                raise
+
+    def _write(self, dataframe, request_id=None, hold_s=None):
+        if request_id is None:
+            request_id = self.allocate_request_id(hold_s)
+        if self.protocol_id == PROTOCOL_FRAMED:
+            self.port.write(encode_frame(dataframe, request_id))
+        else:
+            self.port.write(dataframe + b'\n')
+        return request_id
+
+    def _request(self, dataframes, callback):
+        # pipelined: every request is written before any response is read, responses are matched
+        # by request id in whatever order the central answers them
+        results = [None] * len(dataframes)
+        pending = list(range(len(dataframes)))
+        # resend whatever is still unanswered when a response frame was lost or corrupted
+        for attempt in range(self.max_retries + 1):
+            inflight = {}
+            for index in pending:
+                inflight[self._write(dataframes[index])] = index
+            while inflight:
+                frame = self._read_frame(time.monotonic() + self.response_timeout)
+                if frame is None:
+                    break
+                request_id, dataframe = frame
+                if request_id is None:
+                    # newline frames carry no id, the central answers them in request order
+                    request_id = next(iter(inflight))
+                if request_id in self.subscriptions:
+                    # a push that arrived while this batch was waiting
+                    self.pushed.emit(request_id, dataframe)
+                    continue
+                index = inflight.pop(request_id, None)
+                if index is None:
+                    print("dropped stale response", request_id)
+                    continue
+                self.release_request_id(request_id)
+                results[index] = dataframe
+                pending.remove(index)
+            # a response may still come in late for what is resent or given up
+            for request_id in inflight:
+                self.release_request_id(request_id, self.response_timeout)
+            if not inflight:
+                self.answered.emit(callback, results)
+                return
+        self.failed.emit(callback, "No response from the central")
+
+    def _drain_pushes(self):
+        while True:
+            frame = self._read_frame(time.monotonic() + self.poll_s)
+            if frame is None:
+                return
+            request_id, dataframe = frame
+            if request_id in self.subscriptions:
+                self.pushed.emit(request_id, dataframe)
+            else:
+                print("dropped stale response", request_id)
+
+    # returns (request id, dataframe), the request id is None for newline frames.
+    # None when no complete frame arrived before deadline (time.monotonic() seconds)
+    def _read_frame(self, deadline):
+        delimiter = FRAME_DELIMITER if self.protocol_id == PROTOCOL_FRAMED else b'\n'
+        while True:
+            end = self.buffer.find(delimiter)
+            if end >= 0:
+                encoded = bytes(self.buffer[:end])
+                del self.buffer[:end + 1]
+                if self.protocol_id == PROTOCOL_NEWLINE:
+                    return None, encoded
+                # skip empty and corrupt frames, the next 0x00 delimiter resynchronises the stream
+                if not encoded:
+                    continue
+                decoded = decode_frame(encoded)
+                if decoded is None:
+                    print("dropped corrupt frame")
+                    continue
+                return decoded
+            if time.monotonic() > deadline:
+                return None
+            # blocks for at most poll_s when nothing is waiting
+            self.buffer += self.port.read(max(1, self.port.in_waiting))
@@ -0,0 +1,119 @@
+"""
+Instrumentation kept by both picos (final_i2c.py and finalperipheral_documented.py).
+Copy this file to each pico next to the firmware.
+
+Each timed stage has a latency histogram over fixed buckets (LATENCY_BUCKETS_US), so recording a
+duration is a short scan and an array increment, and the firmware can time its hot paths all the
+time without allocating. Counters, the heap figures and a count of the garbage collections seen
+are kept alongside. pack_into() writes everything as the payload of the telemetry command (0x0A):
+
+    <IIII uptime ms, gc.mem_alloc(), gc.mem_free(), collections seen
+    <BBB  buckets, stages, counters
+    buckets * <I upper bucket bounds in us, the last bucket takes everything above the last bound
+    per stage:   <BIII stage id, durations recorded, longest (us), mean (us), then buckets * <H counts
+    per counter: <BI counter id, value
+"""
+import gc
+import struct
+from array import array
+from utime import ticks_ms, ticks_us, ticks_diff
+
+# upper bounds (us) of the histogram buckets, a last bucket holds the longer durations
+LATENCY_BUCKETS_US = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000)
+
+# timed stages: reading the sensor, packing the payloads of a sample, a read over the BLE link,
+# a uart request from its arrival to its response written, and how late sensor_task wakes from its sleep
+STAGE_SENSOR_READ = 0x00
+STAGE_ENCODE = 0x01
+STAGE_BLE_READ = 0x02
+STAGE_UART_TURNAROUND = 0x03
+STAGE_LOOP_JITTER = 0x04
+STAGES = 5
+
+# counters: requests answered, requests answered with an error or failed, BLE connections lost,
+# uart frames dropped (short, truncated, oversized or corrupt), samples taken, samples published (sampling.py)
+COUNTER_REQUESTS = 0x00
+COUNTER_ERRORS = 0x01
+COUNTER_RECONNECTS = 0x02
+COUNTER_DROPPED_FRAMES = 0x03
+COUNTER_SAMPLES = 0x04
+COUNTER_PUBLISHES = 0x05
+COUNTERS = 6
+
+
+class LatencyHistogram:
+    """Counts of durations per LATENCY_BUCKETS_US bucket, with their number, maximum and running sum."""
+
+    def __init__(self):
+        self.buckets = array('L', [0] * (len(LATENCY_BUCKETS_US) + 1))
+        self.count = 0
+        self.max_us = 0
+        # kept in ms so the sum stays a small int on the pico for a long time
+        self.total_ms = 0
+        self.remainder_us = 0
+
+    def record(self, duration_us):
+        if duration_us < 0:
+            duration_us = 0
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_US) and duration_us > LATENCY_BUCKETS_US[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.max_us = max(self.max_us, duration_us)
+        self.remainder_us += duration_us
+        self.total_ms += self.remainder_us // 1000
+        self.remainder_us %= 1000
+
+    def mean_us(self):
+        return (self.total_ms * 1000 + self.remainder_us) // self.count if self.count else 0
+
+
+class Telemetry:
+    """One LatencyHistogram per stage and one counter per counter id."""
+
+    def __init__(self):
+        self.boot_ms = ticks_ms()
+        self.histograms = [LatencyHistogram() for _ in range(STAGES)]
+        self.counters = array('L', [0] * COUNTERS)
+        self.last_alloc = gc.mem_alloc()
+        self.collections = 0
+
+    # records the time since start_us (a ticks_us() value) for the stage
+    def record(self, stage, start_us):
+        self.histograms[stage].record(ticks_diff(ticks_us(), start_us))
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    # call regularly: a drop of the allocated heap since the last call means a collection ran
+    def check_heap(self):
+        allocated = gc.mem_alloc()
+        if allocated < self.last_alloc:
+            self.collections += 1
+        self.last_alloc = allocated
+
+    # bytes written by pack_into()
+    def size(self):
+        return 19 + 4 * len(LATENCY_BUCKETS_US) + STAGES * (13 + 2 * (len(LATENCY_BUCKETS_US) + 1)) + COUNTERS * 5
+
+    # packs the telemetry payload (see the module docstring) into buffer at offset, returns the offset after it
+    def pack_into(self, buffer, offset):
+        self.check_heap()
+        struct.pack_into("<IIIIBBB", buffer, offset, ticks_diff(ticks_ms(), self.boot_ms), gc.mem_alloc(),
+                         gc.mem_free(), self.collections, len(LATENCY_BUCKETS_US) + 1, STAGES, COUNTERS)
+        offset += 19
+        for bound in LATENCY_BUCKETS_US:
+            struct.pack_into("<I", buffer, offset, bound)
+            offset += 4
+        for stage in range(STAGES):
+            histogram = self.histograms[stage]
+            struct.pack_into("<BIII", buffer, offset, stage, histogram.count, histogram.max_us, histogram.mean_us())
+            offset += 13
+            for bucket in range(len(histogram.buckets)):
+                struct.pack_into("<H", buffer, offset, min(histogram.buckets[bucket], 0xFFFF))
+                offset += 2
+        for counter in range(COUNTERS):
+            struct.pack_into("<BI", buffer, offset, counter, self.counters[counter])
+            offset += 5
+        return offset
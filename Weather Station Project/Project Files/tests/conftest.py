@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under test sit flat in Project Files, as they are copied to the picos
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
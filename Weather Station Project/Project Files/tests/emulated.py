@@ -0,0 +1,84 @@
+"""
+Runs the firmware under pico_emulator.py on the test's own loop and talks to the central's uart
+through its pty, as the GUI does over the serial port.
+"""
+import asyncio
+import os
+import struct
+import time
+
+import pico_emulator
+from custom_protocol import PROTOCOL_FRAMED, decode_frame, encode_frame
+
+pico_emulator._install_stand_ins()
+
+
+# dataframe of a request: header, params count, then every param as <I
+def request(device_id, operation_id, command_id, params=(), protocol_id=PROTOCOL_FRAMED):
+    return (bytes([protocol_id, 0x01, device_id, 0x01, operation_id]) + struct.pack("<hB", command_id, len(params))
+            + struct.pack("<%dI" % len(params), *params))
+
+
+class UartClient:
+    """The host end of the central's uart. Framed responses are kept by request id."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self.received = bytearray()
+        self.responses = {}
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                await asyncio.sleep(0.005)
+
+    async def send(self, payload, request_id):
+        await self.write(encode_frame(payload, request_id))
+
+    def _read(self):
+        try:
+            self.received += os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        while b'\x00' in self.received:
+            index = self.received.index(b'\x00')
+            frame = bytes(self.received[:index])
+            del self.received[:index + 1]
+            decoded = decode_frame(frame) if frame else None
+            if decoded is not None:
+                self.responses.setdefault(decoded[0], []).append(bytes(decoded[1]))
+
+    # the responses to request_id once `count` arrived, or those that came within timeout_s
+    async def wait(self, request_id, count=1, timeout_s=5):
+        deadline = time.monotonic() + timeout_s
+        while len(self.responses.get(request_id, ())) < count and time.monotonic() < deadline:
+            self._read()
+            await asyncio.sleep(0.005)
+        return self.responses.get(request_id, [])
+
+    # the response to one request, forgotten once returned so the request id can be used again
+    async def ask(self, payload, request_id, timeout_s=5):
+        await self.send(payload, request_id)
+        responses = await self.wait(request_id, 1, timeout_s)
+        return responses.pop(0) if responses else None
+
+    def close(self):
+        os.close(self.fd)
+
+
+# runs client_main(client, emulation) against a central with `nodes` sensor nodes, returns its result
+def run_emulated(client_main, nodes=0):
+    async def main():
+        emulation = pico_emulator.Emulation(nodes, pace=False)
+        await emulation.start()
+        client = UartClient(emulation.uart.slave_path)
+        try:
+            return await client_main(client, emulation)
+        finally:
+            client.close()
+            emulation.close()
+
+    return asyncio.run(main())
@@ -0,0 +1,24 @@
+import numpy as np
+from decimation import min_max_decimate
+
+
+def test_out_of_order_timestamps():
+    # timestamps rebuilt from sample ages, the second push stepping back over the end of the first
+    xs = np.concatenate((np.arange(0, 1000, 1.0), np.arange(900, 2000, 1.0)))
+    ys = np.sin(xs / 50)
+    ys[1500] = 10.0
+    ys[300] = -10.0
+    out_xs, out_ys = min_max_decimate(xs, ys, 500, 1800, 50)
+    assert np.all(np.diff(out_xs) >= 0)
+    assert out_xs[0] <= 500 and out_xs[-1] >= 1800
+    # the spikes inside the visible range survive, the one before it is cut off
+    assert out_ys.max() == 10.0
+    assert out_ys.min() > -10.0
+
+
+def test_out_of_order_few_points():
+    xs = np.array([3.0, 1.0, 2.0, 5.0, 4.0])
+    ys = np.array([30.0, 10.0, 20.0, 50.0, 40.0])
+    out_xs, out_ys = min_max_decimate(xs, ys, 2, 4, 10)
+    assert out_xs.tolist() == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert out_ys.tolist() == [10.0, 20.0, 30.0, 40.0, 50.0]
@@ -0,0 +1,68 @@
+import asyncio
+import struct
+
+import pico_emulator
+from emulated import request, run_emulated
+
+# central's own sensor and the first sensor node
+CENTRAL = 0x01
+NODE = 0x02
+
+
+# pushes `samples` samples straight into the node's series rings, as hours of sensor_task would
+def fill_series(node, samples):
+    for i in range(samples):
+        node.namespace['humidity_series'].push(40 + i % 7 * 0.25)
+        node.namespace['temperature_series'].push(21 + i % 5 * 0.01)
+        node.namespace['pressure_series'].push(1013 + i % 11 * 0.03)
+
+
+# the response of device to command_id once its BLE link answers (error id 0x01 until then)
+async def ask_node(client, device_id, command_id, params=(), timeout_s=30):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    request_id = 0
+    while True:
+        request_id += 1
+        response = await client.ask(request(device_id, 0x01, command_id, params), request_id)
+        if response is not None and (response[-1] != 0x01 or loop.time() > deadline):
+            return response
+        await asyncio.sleep(0.2)
+
+
+def test_series_window_pages_past_one_response():
+    async def client_main(client, emulation):
+        fill_series(emulation.nodes[0], 240)
+        first = await ask_node(client, NODE, 0x0D, [20])
+        older = await ask_node(client, NODE, 0x0D, [20, 20])
+        return first, older
+
+    first, older = run_emulated(client_main, nodes=1)
+    assert first[-1] == 0x00 and older[-1] == 0x00
+    held = struct.unpack_from("<H", first, 9)[0]
+    assert first[7] == 20 and held >= 240
+    assert older[7] == 20
+    assert len(first) == 9 + 2 + 20 * 6 + 1
+    # humidity blocks: the second window ends where the first starts
+    newest = struct.unpack_from("<20H", first, 11)
+    oldest = struct.unpack_from("<20H", older, 11)
+    assert newest != oldest
+
+
+def test_time_series_without_mtu_exchange(monkeypatch):
+    async def no_exchange(self, mtu=None, timeout_ms=1000):
+        raise OSError("MTU exchange refused")
+
+    monkeypatch.setattr(pico_emulator.DeviceConnection, 'exchange_mtu', no_exchange)
+
+    async def client_main(client, emulation):
+        fill_series(emulation.nodes[0], 240)
+        time_series = await ask_node(client, NODE, 0x05)
+        window = await ask_node(client, NODE, 0x0D)
+        return time_series, window
+
+    time_series, window = run_emulated(client_main, nodes=1)
+    assert time_series[-1] == 0x00 and time_series[7] == 30
+    # the whole series was paged over 20 byte notifications, as much of it as one response fits comes back
+    assert window[-1] == 0x00 and struct.unpack_from("<H", window, 9)[0] >= 240
+    assert window[7] == (1024 - 1 - 11) // 6
@@ -0,0 +1,50 @@
+from emulated import request, run_emulated
+
+SUBSCRIBE = 0x04
+UNSUBSCRIBE = 0x05
+# the central's subscriptions at once: the dashboard's snapshot and samples of the central and four sensor nodes
+MAX_SUBSCRIPTIONS = 6
+
+
+def subscribe(command_id, params=()):
+    return request(0x01, SUBSCRIBE, command_id, [1000, 0] + list(params))
+
+
+def unsubscribe(request_id):
+    return request(0x01, UNSUBSCRIBE, 0x0B, [request_id])
+
+
+def test_subscribe_refused_once_slots_run_out():
+    async def client_main(client, emulation):
+        pushed = [await client.ask(subscribe(0x0B), request_id) for request_id in range(1, MAX_SUBSCRIPTIONS + 1)]
+        refused = await client.ask(subscribe(0x0B), 100)
+        # the refusal is the only answer, no push follows it
+        later = await client.wait(100, timeout_s=1.5)
+        unsubscribed = await client.ask(unsubscribe(1), 101)
+        accepted = await client.ask(subscribe(0x0B), 102)
+        return pushed, refused, later, unsubscribed, accepted
+
+    pushed, refused, later, unsubscribed, accepted = run_emulated(client_main)
+    assert all(push is not None and push[-1] == 0x00 for push in pushed)
+    assert refused[4] == SUBSCRIBE and refused[7] == 0x00 and refused[-1] == 0x05
+    assert later == []
+    assert unsubscribed[-1] == 0x00
+    assert accepted[-1] == 0x00 and accepted[7] == 3
+
+
+def test_subscription_with_refused_params_ends():
+    async def client_main(client, emulation):
+        # aggregation scope 0x07 is not kept on any device
+        refused_params = await client.ask(subscribe(0x02, [0x07, 0]), 1)
+        later = await client.wait(1, timeout_s=1.5)
+        # its slot is free again: every other subscription still fits
+        pushed = [await client.ask(subscribe(0x0B), request_id) for request_id in range(2, MAX_SUBSCRIPTIONS + 2)]
+        unsubscribed = await client.ask(unsubscribe(1), 100)
+        return refused_params, later, pushed, unsubscribed
+
+    refused_params, later, pushed, unsubscribed = run_emulated(client_main)
+    assert refused_params[4] == SUBSCRIBE and refused_params[-1] == 0x03
+    assert later == []
+    assert all(push is not None and push[-1] == 0x00 for push in pushed)
+    # error id 0x03: the central holds no subscription with that id any more
+    assert unsubscribed[-1] == 0x03
@@ -0,0 +1,36 @@
+from emulated import request, run_emulated
+from custom_protocol import encode_frame
+
+# the schema command of the central itself, answered without BLE or a fresh sample
+SCHEMA = request(0x01, 0x01, 0x0B)
+
+
+def test_noise_byte_between_frames():
+    async def client_main(client, emulation):
+        assert await client.ask(SCHEMA, 1) is not None
+        await client.write(b'\x55')
+        for request_id in range(2, 42):
+            await client.send(SCHEMA, request_id)
+        return [request_id for request_id in range(2, 42) if not await client.wait(request_id)]
+
+    assert run_emulated(client_main) == []
+
+
+def test_truncated_frame_between_frames():
+    async def client_main(client, emulation):
+        assert await client.ask(SCHEMA, 1) is not None
+        await client.write(encode_frame(SCHEMA, 2)[:-5])
+        answered = await client.ask(SCHEMA, 3)
+        return answered, await client.wait(2, timeout_s=0.5)
+
+    answered, truncated = run_emulated(client_main)
+    assert answered is not None
+    assert truncated == []
+
+
+def test_framed_request_after_garbage_and_newline_frame():
+    async def client_main(client, emulation):
+        await client.write(b'\x55\x55\x00' + request(0x01, 0x01, 0x0B, protocol_id=0x01) + b'\n')
+        return await client.ask(SCHEMA, 1)
+
+    assert run_emulated(client_main) is not None